@@ -0,0 +1,190 @@
+"""
+Recording every API call of a real run, and playing them back later without a network, so a
+change can be measured against the same production-shaped traffic again and again (and in CI)
+without spending any rate limit.
+
+A cassette is gzip-compressed NDJSON: a header line, then a line per request sent, holding the
+response's status, headers and body, and how long it took to come back. Credentials are never
+recorded. Requests are matched on replay by method, URL, body and the few headers that change
+what comes back (`Accept` and `Range`); a request sent more than once gets its responses in the
+order they were recorded, the last one over again once they run out.
+
+Recording goes through `RecordingAdapter` and playing back through `ReplayAdapter`, either as
+fast as possible or taking as long as each call did when it was recorded; `GithubHttp` mounts
+one or the other when given `record` or `replay`.
+"""
+import atexit
+import base64
+import collections
+import gzip
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+
+FORMAT = 'github-macros-cassette'
+VERSION = 1
+
+# Part of what was asked for, rather than how it was sent
+MATCH_HEADERS = ('Accept', 'Range')
+# Only true of the original connection, or of a body we've already decoded
+DROP_HEADERS = ('connection', 'content-encoding', 'content-length', 'keep-alive', 'set-cookie', 'transfer-encoding')
+
+
+class CassetteMiss(LookupError):
+    """
+    Raised when a request is played back that wasn't recorded
+    """
+
+
+def request_key(method, url, headers=None, body=None):
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    headers = headers or {}
+    return '{method} {url} {headers} {body}'.format(
+        method=method.upper(), url=url, body=hashlib.sha1(body).hexdigest() if body else '-',
+        headers=json.dumps([headers.get(name) for name in MATCH_HEADERS]))
+
+
+class Cassette(object):
+    """
+    The exchanges of one run, by `request_key()`
+
+    param:: path: Where the cassette is kept
+    """
+
+    def __init__(self, path, exchanges=None):
+        self.path = path
+        self.exchanges = collections.defaultdict(collections.deque)
+        for exchange in exchanges or []:
+            self.exchanges[exchange['key']].append(exchange)
+        self._out = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path):
+        with gzip.open(path, 'rt') as f:
+            header = json.loads(f.readline() or '{}')
+            if header.get('format') != FORMAT or header.get('version') != VERSION:
+                raise ValueError('{} is not a version {} cassette'.format(path, VERSION))
+            return cls(path, (json.loads(line) for line in f if line.strip()))
+
+    def record(self, request, resp, elapsed):
+        """
+        Adds an exchange, written out as it happens (to a temporary file, until `close()`)
+        """
+        exchange = collections.OrderedDict([
+            ('key', request_key(request.method, request.url, request.headers, request.body)),
+            ('status', resp.status_code),
+            ('reason', resp.reason),
+            ('headers', dict((k, v) for k, v in resp.headers.items() if k.lower() not in DROP_HEADERS)),
+            ('elapsed', round(elapsed, 4)),
+        ])
+        try:
+            exchange['body'] = resp.content.decode('utf-8')
+        except UnicodeDecodeError:
+            exchange['body64'] = base64.b64encode(resp.content).decode('ascii')
+        line = json.dumps(exchange, separators=(',', ':'))
+
+        with self._lock:
+            if self._out is None:
+                self._out = gzip.open(self.path + '.part', 'wt')
+                self._out.write(json.dumps({'format': FORMAT, 'version': VERSION, 'created_at': time.time()}) + '\n')
+            self._out.write(line + '\n')
+
+    def play(self, request):
+        """
+        The next recorded exchange for the request
+        """
+        key = request_key(request.method, request.url, request.headers, request.body)
+        with self._lock:
+            recorded = self.exchanges.get(key)
+            if not recorded:
+                raise CassetteMiss('{} {} is not in the cassette'.format(request.method, request.url))
+            return recorded.popleft() if len(recorded) > 1 else recorded[0]
+
+    def close(self):
+        """
+        Moves a recording into place, so an interrupted run never leaves a torn cassette behind
+        """
+        with self._lock:
+            if self._out is not None:
+                self._out.close()
+                self._out = None
+                os.replace(self.path + '.part', self.path)
+
+
+class RecordingAdapter(HTTPAdapter):
+    """
+    Sends requests as usual, recording each response into a `Cassette`. Bodies are read whole,
+    even those that were asked to be streamed.
+    """
+
+    def __init__(self, cassette, *args, **kwargs):
+        super(RecordingAdapter, self).__init__(*args, **kwargs)
+        self.cassette = cassette
+
+    def send(self, request, **kwargs):
+        started = time.time()
+        resp = super(RecordingAdapter, self).send(request, **kwargs)
+        resp.content  # Read it all, so the time taken includes the body
+        self.cassette.record(request, resp, time.time() - started)
+        return resp
+
+
+class ReplayAdapter(BaseAdapter):
+    """
+    Answers requests from a `Cassette`, refusing to send anything anywhere
+
+    param:: latency: Whether to take as long as each call did when it was recorded
+    """
+
+    def __init__(self, cassette, latency=False):
+        super(ReplayAdapter, self).__init__()
+        self.cassette = cassette
+        self.latency = latency
+
+    def send(self, request, **kwargs):
+        exchange = self.cassette.play(request)
+        if self.latency:
+            time.sleep(exchange['elapsed'])
+
+        body = exchange['body'].encode('utf-8') if 'body' in exchange else base64.b64decode(exchange['body64'])
+        resp = requests.Response()
+        resp.request = request
+        resp.url = request.url
+        resp.status_code = exchange['status']
+        resp.reason = exchange['reason']
+        resp.headers.update(exchange['headers'])
+        resp.encoding = requests.utils.get_encoding_from_headers(resp.headers)
+        resp.raw = io.BytesIO(body)
+        resp._content = body
+        resp._content_consumed = True
+        return resp
+
+    def close(self):
+        pass
+
+
+# Every client recording to (or playing back from) the same file shares the one cassette
+_cassettes = {}
+_cassettes_lock = threading.Lock()
+
+
+def shared(path, recording=False):
+    """
+    The cassette at `path`, loaded (or started, when recording) the first time it's asked for
+    """
+    with _cassettes_lock:
+        if (path, recording) not in _cassettes:
+            if recording:
+                _cassettes[path, recording] = Cassette(path)
+                atexit.register(_cassettes[path, recording].close)
+            else:
+                _cassettes[path, recording] = Cassette.load(path)
+        return _cassettes[path, recording]
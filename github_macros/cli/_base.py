@@ -1,7 +1,16 @@
+from __future__ import print_function
 import argparse
+import os
 import sys
 
+from github_macros.filters import Filter
+from github_macros.hosts import HostClients, default_host, env_suffix, split_tokens
 from github_macros.http import GithubHttp
+from github_macros.inventory import SnapshotMiss, offline_client
+from github_macros.journal import Journal
+from github_macros.models.github import GRAPHQL_REPOSITORY_FIELDS
+from github_macros.reporting import emit
+from github_macros.sharding import Shard, report as shard_report
 
 
 class MyParser(argparse.ArgumentParser):
@@ -11,10 +20,259 @@ class MyParser(argparse.ArgumentParser):
         sys.exit(2)
 
 
-def create_client(username, token):
-    if not username:
-        raise KeyError('Requires Github username to be given via GITHUB_USER variable or command line flag')
-    if not token:
-        raise KeyError('Requires Github personal access token to be given via GITHUB_TOKEN variable or command line flag')
+def env_flag(name, default):
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() not in ('0', 'false', 'no', 'off', '')
 
-    return GithubHttp(username=username, token=token)
+
+def add_transport_args(p):
+    """
+    Adds the HTTP transport tuning flags shared by every command
+    """
+    transport = p.add_argument_group('HTTP transport', 'Tuning for the connection to the GitHub API '
+                                     '(each defaults to the environment variable noted)')
+    transport.add_argument('--pool-size', dest='pool_size', action='store', type=int,
+                           default=int(os.getenv('GITHUB_POOL_SIZE', 10)),
+                           help='Max pooled connections, should be at least the number of concurrent workers (GITHUB_POOL_SIZE)')
+    transport.add_argument('--connect-timeout', dest='connect_timeout', action='store', type=float,
+                           default=float(os.getenv('GITHUB_CONNECT_TIMEOUT', 10)),
+                           help='Seconds to wait for a connection to the API (GITHUB_CONNECT_TIMEOUT)')
+    transport.add_argument('--read-timeout', dest='read_timeout', action='store', type=float,
+                           default=float(os.getenv('GITHUB_READ_TIMEOUT', 60)),
+                           help='Seconds to wait on a stalled response from the API (GITHUB_READ_TIMEOUT)')
+    transport.add_argument('--deadline', dest='deadline', action='store', type=float,
+                           default=float(os.getenv('GITHUB_DEADLINE', 0)) or None,
+                           help='Seconds after which the whole run gives up on further API calls (GITHUB_DEADLINE)')
+    compression = transport.add_mutually_exclusive_group()
+    compression.add_argument('--compression', dest='compression', action='store_true',
+                             default=env_flag('GITHUB_COMPRESSION', True),
+                             help='Ask for gzip-compressed API responses (GITHUB_COMPRESSION, the default)')
+    compression.add_argument('--no-compression', dest='compression', action='store_false')
+    keep_alive = transport.add_mutually_exclusive_group()
+    keep_alive.add_argument('--keep-alive', dest='keep_alive', action='store_true',
+                            default=env_flag('GITHUB_KEEP_ALIVE', True),
+                            help='Reuse connections between API calls (GITHUB_KEEP_ALIVE, the default)')
+    keep_alive.add_argument('--no-keep-alive', dest='keep_alive', action='store_false')
+    adaptive = transport.add_mutually_exclusive_group()
+    adaptive.add_argument('--adaptive', dest='adaptive', action='store_true', default=env_flag('GITHUB_ADAPTIVE', True),
+                          help='Make fewer than --pool-size API calls at once while GitHub pushes back with 5xx and '
+                               'rate limit responses (GITHUB_ADAPTIVE, the default)')
+    adaptive.add_argument('--no-adaptive', dest='adaptive', action='store_false',
+                          help='Let every worker call the API whenever it likes')
+    transport.add_argument('--max-retries', dest='max_retries', action='store', type=int,
+                           default=int(os.getenv('GITHUB_MAX_RETRIES', 5)),
+                           help='Times to retry a single API call after a transient failure (GITHUB_MAX_RETRIES)')
+    transport.add_argument('--retry-budget', dest='retry_budget', action='store', type=int,
+                           default=int(os.getenv('GITHUB_RETRY_BUDGET', 100)),
+                           help='Total retries allowed over the whole run (GITHUB_RETRY_BUDGET)')
+    transport.add_argument('--proxy-socket', dest='proxy_socket', action='store', default=os.getenv('GITHUB_PROXY_SOCKET'),
+                           metavar='PATH', help='Send every API call through the gh-proxy daemon listening on this Unix '
+                                                'socket (GITHUB_PROXY_SOCKET)')
+    cassette = transport.add_mutually_exclusive_group()
+    cassette.add_argument('--record', dest='record', action='store', default=os.getenv('GITHUB_RECORD'), metavar='CASSETTE',
+                          help='Record every API call and its response to a cassette file (GITHUB_RECORD)')
+    cassette.add_argument('--replay', dest='replay', action='store', default=os.getenv('GITHUB_REPLAY'), metavar='CASSETTE',
+                          help='Answer every API call from a recorded cassette file, without the network (GITHUB_REPLAY)')
+    transport.add_argument('--replay-latency', dest='replay_latency', action='store_true',
+                           default=env_flag('GITHUB_REPLAY_LATENCY', False),
+                           help='Take as long over each replayed call as it took when recorded, rather than '
+                                'answering at once (GITHUB_REPLAY_LATENCY)')
+    return transport
+
+
+def add_filter_args(p):
+    """
+    Adds flags for narrowing down which repositories are worked on, and how they are listed
+    """
+    p.add_argument('--where', dest='where', action='store', type=Filter.compile, default=None, metavar='EXPR',
+                   help='Only work on repositories matching this filter, e.g. "not archived and not fork and '
+                        'pushed > 2026-01-01 and language in (Go, Python)"')
+    p.add_argument('--graphql', dest='graphql', action='store_true', default=env_flag('GITHUB_GRAPHQL', False),
+                   help='List repositories through the GraphQL API, fetching only the fields needed (GITHUB_GRAPHQL)')
+
+
+def check_filter_args(p, opts):
+    """
+    Turns away a `--where` filter on fields that `--graphql` can't list, before anything is started
+    """
+    if not opts.graphql or opts.where is None or getattr(opts, 'offline', None):
+        return
+    unknown = sorted(set(opts.where.fields) - set(GRAPHQL_REPOSITORY_FIELDS))
+    if unknown:
+        p.error('--where uses {fields}, which --graphql can\'t list (leave out --graphql to list through '
+                'the REST API)'.format(fields=', '.join(unknown)))
+
+
+def listing_fields(opts, needed):
+    """
+    The repository fields to ask for when listing, or None to fetch them all through the REST API
+    """
+    if getattr(opts, 'offline', None):
+        return None  # A snapshot has every field already
+    return set(needed) if opts.graphql else None
+
+
+def add_shard_args(p):
+    """
+    Adds flags for splitting the repositories to work on across several machines
+    """
+    shard = p.add_argument_group('Sharding', 'Split the repositories across several machines, each '
+                                 'running the same command with a different --shard')
+    shard.add_argument('--shard', dest='shard', action='store', type=Shard.parse, default=None, metavar='i/N',
+                       help='Only work on the i-th of N stable slices of the repositories (e.g., 2/5)')
+    shard.add_argument('--shard-balance', dest='shard_balance', action='store', default='hash', choices=['hash', 'size'],
+                       help='Slice by name alone (hash), or also even out the total repository size of each slice (size)')
+    return shard
+
+
+def shard_from(opts):
+    if opts.shard is not None:
+        opts.shard.balance = opts.shard_balance
+    return opts.shard
+
+
+def add_journal_args(p, default=None):
+    """
+    Adds flags for keeping a journal of finished work, and resuming from it after a failed run
+    """
+    journal = p.add_argument_group('Resuming', 'Keep a journal of finished work, so an interrupted run '
+                                   'can pick up where it left off')
+    journal.add_argument('--journal', dest='journal', action='store', default=os.getenv('GITHUB_JOURNAL', default),
+                         metavar='FILE', help='Where to record finished work (GITHUB_JOURNAL{})'.format(
+                             ', default: {}'.format(default) if default else ''))
+    journal.add_argument('--resume', dest='resume', action='store_true', default=False,
+                         help='Skip work the journal says was finished, unless its inputs have changed since')
+    return journal
+
+
+def open_journal(opts):
+    if opts.resume and not opts.journal:
+        raise KeyError('Requires a journal to be given via GITHUB_JOURNAL variable or --journal flag in order to --resume')
+    if not opts.journal:
+        return None
+    return Journal(opts.journal, resume=opts.resume)
+
+
+def add_offline_args(p):
+    p.add_argument('--offline', dest='offline', action='store', default=None, metavar='SNAPSHOT',
+                   help='Read everything from a snapshot taken by gh-inventory, rather than from the API '
+                        '(no network, and no changes can be made)')
+
+
+def clients_from(opts):
+    """
+    A client for each host named (see `github_macros.hosts`), for the parsed arguments: reading
+    from a snapshot with --offline, otherwise from the API with the credentials and transport
+    settings given. Tokens given as "HOST=TOKEN" go to that host, the rest to the default host.
+    """
+    if getattr(opts, 'offline', None):
+        snapshot_client = offline_client(opts.offline)
+
+        def offline(host):
+            if host != snapshot_client.domain:
+                raise SnapshotMiss('The snapshot was taken of {}, not {}'.format(snapshot_client.domain, host))
+            return snapshot_client
+        return HostClients(offline)
+
+    tokens = split_tokens(opts.gh_token)
+
+    def online(host):
+        username = opts.gh_user if host == default_host() else os.getenv('GITHUB_USER_' + env_suffix(host), opts.gh_user)
+        return create_client(username=username, token=tokens.get(host, []), domain=host, **transport_options(opts))
+    return HostClients(online)
+
+
+def transport_options(opts):
+    """
+    Pulls the settings given by `add_transport_args()` out of parsed arguments, for
+    passing along to `create_client()`
+    """
+    return {
+        'pool_size': opts.pool_size,
+        'connect_timeout': opts.connect_timeout,
+        'read_timeout': opts.read_timeout,
+        'deadline': opts.deadline,
+        'compression': opts.compression,
+        'keep_alive': opts.keep_alive,
+        'max_retries': opts.max_retries,
+        'retry_budget': opts.retry_budget,
+        'adaptive': opts.adaptive,
+        'record': opts.record,
+        'replay': opts.replay,
+        'replay_latency': opts.replay_latency,
+        'proxy_socket': opts.proxy_socket,
+    }
+
+
+def env_tokens(host=None):
+    """
+    A pool of tokens from GITHUB_TOKENS (separated by commas or whitespace), falling back
+    to the single GITHUB_TOKEN
+
+    param:: host: For any host but the default one, read GITHUB_TOKENS_<HOST> and
+                  GITHUB_TOKEN_<HOST> instead (see `github_macros.hosts.env_suffix`)
+    """
+    suffix = '' if not host or host == default_host() else '_' + env_suffix(host)
+    tokens = os.getenv('GITHUB_TOKENS' + suffix, '').replace(',', ' ').split()
+    if not tokens and os.getenv('GITHUB_TOKEN' + suffix):
+        tokens = [os.getenv('GITHUB_TOKEN' + suffix)]
+    return tokens
+
+
+def create_client(username, token, domain=None, **kwargs):
+    """
+    param:: token: A single token, or a list of them (each "TOKEN" or "USERNAME:TOKEN") to
+                   spread API calls across. Falls back to `env_tokens()` when empty.
+    param:: domain: The GitHub host, defaults to GITHUB_DOMAIN (or github.com)
+    """
+    tokens = token if isinstance(token, (list, tuple)) else [token] if token else []
+    tokens = tokens or env_tokens(domain)
+    suffix = '' if not domain or domain == default_host() else '_' + env_suffix(domain)
+    if not tokens and kwargs.get('replay'):
+        return GithubHttp(username=username, token=None, domain=domain, **kwargs)  # Nothing is sent anywhere
+    if not tokens:
+        raise KeyError('Requires Github personal access token to be given via GITHUB_TOKEN{} variable or command line '
+                       'flag'.format(suffix))
+    if not username and any(':' not in t for t in tokens):
+        raise KeyError('Requires Github username to be given via GITHUB_USER{} variable or command line flag'.format(suffix))
+
+    return GithubHttp(username=username, token=tokens if len(tokens) > 1 else tokens[0], domain=domain, **kwargs)
+
+
+def print_stats(client):
+    """
+    Summarizes API usage for the run, so retried outages are visible after the fact
+
+    param:: client: A `GithubHttp`, or `HostClients` for a line per host (named when there are several)
+    """
+    if isinstance(client, HostClients):
+        for host, host_client in client.items():
+            _print_stats(host_client, host, host + ': ' if len(client) > 1 else '')
+    else:
+        _print_stats(client, client.domain)
+
+
+def _print_stats(client, host, prefix=''):
+    msg = 'STATS: {prefix}{requests} API requests, {retries} retries ({left} left in budget), {failures} failed, ' \
+          '{tokens} tokens in pool ({dropped} dropped)'
+    stats = {
+        'requests': client.stats['requests'],
+        'retries': client.stats['retries'],
+        'left': max(0, client.retry_budget - client.stats['retries']),
+        'failures': client.stats['failures'],
+        'tokens': len(client.tokens),
+        'dropped': len(client.tokens.dropped),
+    }
+    text = msg.format(prefix=prefix, **stats)
+    if client.concurrency is not None:
+        text += '\nSTATS: {}API concurrency {}'.format(prefix, client.concurrency)
+        stats['concurrency'] = int(client.concurrency.limit)
+        stats['backoffs'] = client.concurrency.backoffs
+    emit('stats', text, error=True, host=host, **stats)
+
+
+def print_shard(shard, selected, total, errors):
+    emit('shard', shard_report(shard, selected, total, errors).rstrip('\n'), error=True,
+         shard=str(shard), selected=selected, total=total, errors=errors)
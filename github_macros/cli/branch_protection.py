@@ -1,8 +1,20 @@
+import argparse
+import hashlib
+import json
 import os
 import sys
+import threading
 
-from github_macros.cli._base import MyParser, create_client
+from concurrent.futures import ThreadPoolExecutor
+
+from github_macros.cli._base import MyParser, add_filter_args, add_journal_args, add_offline_args, add_shard_args, \
+    add_transport_args, check_filter_args, clients_from, listing_fields, open_journal, print_shard, print_stats, \
+    shard_from
+from github_macros.hosts import host_of, qualified_name
 from github_macros.models.github import GithubOrganization, GithubUser, GithubRepository
+from github_macros.policy import Policy, PolicySet, RULES
+from github_macros.remediation import apply as apply_changes, desired_settings, plan
+from github_macros.reporting import add_format_args, configure as configure_output, emit
 from github_macros import __version__
 
 
@@ -13,21 +25,38 @@ def get_args():
                    help='Prints the program version and exits',
                    version='%(prog)s ' + __version__)
 
-    p.add_argument('--branch', '-b', dest='branches', action='append', default=[], required=True,
-                   help='Branch name in which to check branch protections')
+    p.add_argument('--branch', '-b', dest='branches', action='append', default=[],
+                   help='Branch name, or glob of them (matched case-sensitively, as git does), in which to check branch '
+                        'protections (required unless --policy is given)')
+    p.add_argument('--policy', dest='policies', action='store', type=PolicySet.load, default=None, metavar='FILE',
+                   help='JSON file of policies, each applying its own rules to matching repositories and branches '
+                        '(see doc/protect.rst), all checked in one pass. Rules given as flags also apply to every '
+                        'repository, for the branches given with --branch')
 
     mapping = p.add_argument_group('Repository listing', 'Use these options for choosing '
                                    'how to select your list of repositories to check against '
                                    'for branch protection settings')
     mapping.add_argument('--repository', '-r', dest='repositories', action='append', default=[],
-                         help='GitHub repository in which to check branch protections')
+                         help='GitHub repository in which to check branch protections ([HOST:]OWNER/NAME for other GitHub hosts)')
     mapping.add_argument('--user', '-u', dest='users', action='append', default=[],
-                         help='GitHub user in which to check branch protections for all repositories')
+                         help='GitHub user in which to check branch protections for all repositories ([HOST:]USER for other GitHub hosts)')
     mapping.add_argument('--organization', '-o', dest='organizations', action='append', default=[],
-                         help='GitHub organization in which to update hooks for all repositories')
+                         help='GitHub organization in which to update hooks for all repositories ([HOST:]ORG for other GitHub hosts)')
+
+    remediation = p.add_argument_group('Remediation', 'Change branch protections to follow the rules, rather '
+                                       'than only reporting where they don\'t. Only the settings that are off are '
+                                       'changed, and branches that already follow the rules are left alone')
+    remediation.add_argument('--apply', action='store_true', default=False,
+                             help='Fix every branch that breaks a rule')
+    remediation.add_argument('--dry-run', action='store_true', default=False,
+                             help='Show the API calls --apply would make (as DIFF:: lines) without making them')
+    remediation.add_argument('--jobs', '-j', type=int, default=4,
+                             help='Branch protections to change at the same time with --apply (default: 4)')
 
     p.add_argument('--github-user', dest='gh_user', action='store', default=os.getenv('GITHUB_USER'))
-    p.add_argument('--github-token', dest='gh_token', action='store', default=os.getenv('GITHUB_TOKEN'))
+    p.add_argument('--github-token', dest='gh_token', action='append', default=[],
+                   help='API token, given more than once to rotate between a pool of them, as HOST=TOKEN for other '
+                        'GitHub hosts (defaults to GITHUB_TOKENS or GITHUB_TOKEN, and GITHUB_TOKEN_<HOST> for other hosts)')
 
     # CHECKS:
     status_checks = p.add_argument_group('Commit status checks')
@@ -92,69 +121,245 @@ def get_args():
                       help='Ignore push restrictions for this team (allows multiple invocations of --push-team)')
 
     p.set_defaults(**defaults)
-    return p.parse_args()
-
-
-def index_repos(client, repo_names=None, org_names=None, usernames=None):
+    add_filter_args(p)
+    add_shard_args(p)
+    add_journal_args(p)
+    add_offline_args(p)
+    add_transport_args(p)
+    add_format_args(p)
+
+    opt = p.parse_args()
+    check_filter_args(p, opt)
+    if not opt.branches and opt.policies is None:
+        p.error('one of the arguments --branch/-b --policy is required')
+    if opt.offline and opt.apply and not opt.dry_run:
+        p.error('--apply needs --dry-run when reading from an --offline snapshot')
+    return opt
+
+
+# Each repository is refreshed before it is checked, so the listing only needs enough to find it
+LISTING_FIELDS = ('name', 'owner', 'full_name', 'size')
+
+
+def index_repos(clients, repo_names=None, org_names=None, usernames=None, where=None, fields=None):
+    """
+    Lists every owner (and fetches every repository) at the same time, whichever host it's on
+
+    param:: clients: `github_macros.hosts.HostClients` for the hosts named
+    param:: where: A `github_macros.filters.Filter` the repositories must match
+    param:: fields: Only list these repository fields (through GraphQL)
+    """
+    owners = [GithubOrganization(*clients.resolve(org_name)) for org_name in (org_names if org_names else [])]
+    owners += [GithubUser(*clients.resolve(username)) for username in (usernames if usernames else [])]
+
+    def listing(owner):
+        # owner.iter_repositories() doesn't need us to fetch all the info on the org (or person)
+        if where is not None:
+            return list(where.repositories(owner, fields=fields))
+        return list(owner.iter_repositories(fields=fields))
+
+    def fetch(repo_name):
+        repo = GithubRepository.fetch(*clients.resolve(repo_name))
+        return [repo] if where is None or where(repo) else []
+
+    jobs = [(listing, owner) for owner in owners] + [(fetch, repo_name) for repo_name in (repo_names if repo_names else [])]
     repositories = []
-    for org_name in (org_names if org_names else []):
-        # org.repositories is a lazy-loaded item, so we don't need to fetch all the info on the org
-        org = GithubOrganization(client, org_name)
-        repositories += org.repositories
-
-    for username in (usernames if usernames else []):
-        # user.repositories is a lazy-loaded item, so we don't need to fetch all the info on the person
-        user = GithubUser(client, username)
-        repositories += user.repositories
-
-    for repo_name in (repo_names if repo_names else []):
-        repositories.append(GithubRepository.fetch(client, repo_name))
+    with ThreadPoolExecutor(max_workers=max(1, len(jobs))) as listers:
+        for found in [listers.submit(job, arg) for job, arg in jobs]:
+            repositories += found.result()
 
     return set(repositories)
 
 
-def error(repo, branch, option_name):
-    msg = "ERROR:: {repo} @ {branch} => {opt}\n"
-    sys.stderr.write(msg.format(repo=repo.full_name, branch=branch.name, opt=option_name))
+def rules_fingerprint(policies):
+    """
+    Identifies the set of rules being checked, so a verdict is only reused for the same rules
+    """
+    rules = json.dumps([policy.describe() for policy in policies], sort_keys=True)
+    return hashlib.sha1(rules.encode('utf-8')).hexdigest()
+
+
+def policies_from(opt):
+    """
+    Policies from the --policy file, plus one for the rules given as flags when --branch is given
+    """
+    policies = list(opt.policies or [])
+    if opt.branches:
+        options = argparse.Namespace(**dict((dest, getattr(opt, dest)) for dest, _, _ in RULES.values()))
+        policies.insert(0, Policy(None, ['*'], opt.branches, options))
+    return PolicySet(policies)
+
+
+def error(repo, branch, option_name, opt=None):
+    policy = getattr(opt, 'policy', None)
+    msg = "ERROR:: {repo} @ {branch} => {policy}{opt}"
+    emit('error', msg.format(repo=qualified_name(repo), branch=branch.name, opt=option_name,
+                             policy='[{}] '.format(policy) if policy else ''), error=True,
+         repository=qualified_name(repo), branch=branch.name, policy=policy, message=option_name)
+
+
+def describe(change):
+    return '{method} {path} ({summary})'.format(method=change.method, path=change.path, summary=change.summary)
+
+
+def remediate(client, repo, fixes, errors, journal=None, fingerprint=None, tally=None):
+    """
+    Applies the changes planned for each of the repository's branches, returning the number of
+    errors left over
+
+    param:: fixes: List of (branch, changes, errors they fix)
+    param:: errors: Number of errors found in the repository
+    """
+    for branch, changes, fixable in fixes:
+        failed = apply_changes(client, changes)
+        if failed is None:
+            for change in changes:
+                emit('fixed', 'FIXED:: {repo} @ {branch} => {change}'.format(
+                    repo=qualified_name(repo), branch=branch.name, change=describe(change)), error=True,
+                    repository=qualified_name(repo), branch=branch.name, method=change.method, path=change.path,
+                    summary=change.summary)
+            errors -= fixable
+        else:
+            change, resp = failed
+            error(repo, branch, 'Failed to {change}: {status} {reason}'.format(
+                change=describe(change), status=resp.status_code, reason=resp.reason))
+
+    if journal is not None:
+        journal.record('protect', qualified_name(repo), fingerprint, errors=errors,
+                       policies=sorted((tally or {}).items(), key=lambda item: str(item[0])))
+    return errors
 
 
 def main():
     opt = get_args()
-    client = create_client(username=opt.gh_user, token=opt.gh_token)
+    configure_output(opt)
+    clients = clients_from(opt)
 
     # collecting repo objects for all the things
-    repositories = index_repos(client=client, repo_names=opt.repositories,
-                               org_names=opt.organizations, usernames=opt.users)
-    all_errors = 0
-
-    for repo in repositories:
+    repositories = index_repos(clients=clients, repo_names=opt.repositories,
+                               org_names=opt.organizations, usernames=opt.users, where=opt.where,
+                               fields=listing_fields(opt, LISTING_FIELDS))
+    total_repositories = len(repositories)
+    shard = shard_from(opt)
+    if shard is not None:
+        repositories = shard.select(sorted(repositories, key=lambda r: qualified_name(r).lower()))
+    totals = {'errors': 0, 'repos_with_errors': 0}
+    journal = open_journal(opt)
+    policies = policies_from(opt)
+    fingerprint = rules_fingerprint(policies)
+    # Policy name => [errors, branches checked, repositories checked]
+    tally = dict((policy.name, [0, 0, 0]) for policy in policies)
+    remediating = opt.apply or opt.dry_run
+    writing = opt.apply and not opt.dry_run
+    # Writes are spread over a few workers while the next repositories are being checked
+    writers = ThreadPoolExecutor(max_workers=max(1, opt.jobs))
+    pending = []
+    lock = threading.Lock()
+
+    def add_tally(counts_by_policy):
+        with lock:
+            for name, counts in counts_by_policy:
+                tally[name] = [total + count for total, count in zip(tally[name], counts)]
+
+    def check(repo):
         # print('REPO: {name}'.format(name=str(repo.full_name)))
+        verdict = journal.get('protect', qualified_name(repo)) if opt.resume else None
+        if verdict is not None and verdict['fingerprint'] == fingerprint:
+            emit('skip', 'SKIP:: {repo} => Checked in an earlier run ({n} errors)'.format(repo=qualified_name(repo), n=verdict['errors']),
+                 error=True, repository=qualified_name(repo), errors=verdict['errors'], reason='resumed')
+            with lock:
+                totals['errors'] += verdict['errors']
+                totals['repos_with_errors'] += 1 if verdict['errors'] else 0
+            add_tally(verdict.get('policies', []))
+            return
+
+        repo_policies = policies.for_repository(repo)
+        if not repo_policies:
+            return
+
         repo.refresh()
         repo_errors = 0
+        repo_tally = dict((policy.name, [0, 0, 1]) for policy in repo_policies)
+        fixes = []
 
         for branch in repo.branches:
-            if branch.name not in opt.branches:
+            branch_policies = policies.for_branch(repo_policies, branch.name)
+            if not branch_policies:
                 continue
             errors = 0
 
-            if not branch.protection.enabled:
+            # Fetched once, however many policies it is checked against
+            protection = branch.protection
+            if not protection.enabled:
                 error(repo, branch, 'Branch protection is disabled')
 
-            errors += repo_push_checks(branch.protection, opt)
-            errors += repo_code_review(branch.protection, opt)
-            errors += repo_status_checks(branch.protection, opt)
-            errors += repo_admin_exemptions(branch.protection, opt)
-
-            if errors > 0:
+            for policy in branch_policies:
+                policy_errors = repo_push_checks(protection, policy.options)
+                policy_errors += repo_code_review(protection, policy.options)
+                policy_errors += repo_status_checks(protection, policy.options)
+                policy_errors += repo_admin_exemptions(protection, policy.options)
+                repo_tally[policy.name][0] += policy_errors
+                repo_tally[policy.name][1] += 1
+                errors += policy_errors
+
+            if errors > 0 and remediating:
+                settings, conflicts = desired_settings(branch_policies)
+                for option in conflicts:
+                    error(repo, branch, 'Policies disagree on {}, leaving it as it is'.format(option))
+                changes = plan(protection, settings)
+                for change in (changes if not writing else []):
+                    emit('diff', 'DIFF:: {repo} @ {branch} => {change}'.format(
+                        repo=qualified_name(repo), branch=branch.name, change=describe(change)), error=True,
+                        repository=qualified_name(repo), branch=branch.name, method=change.method, path=change.path,
+                        body=change.body, summary=change.summary)
+                fixes.append((branch, changes, 0 if conflicts else errors))
+            elif errors > 0:
                 fix_url = '{base}/settings/branches/{branch}'.format(base=repo.url, branch=branch.name)
                 msg = '===============> Fix it: {url} <==============='
-                sys.stderr.write(msg.format(url=fix_url) + '\n\n')
+                emit('fix', msg.format(url=fix_url) + '\n', error=True, repository=qualified_name(repo), branch=branch.name,
+                     errors=errors, url=fix_url)
 
             repo_errors += errors
 
-        all_errors += repo_errors
+        add_tally(repo_tally.items())
+        if not writing:
+            fixes = []
+        with lock:
+            pending.append(writers.submit(remediate, repo.http, repo, fixes, repo_errors,
+                                          journal=journal, fingerprint=fingerprint, tally=repo_tally))
+
+    def check_all(host_repositories):
+        for repo in host_repositories:
+            check(repo)
+
+    # Each host is checked at the same time as the others, by its own client
+    by_host = {}
+    for repo in repositories:
+        by_host.setdefault(host_of(repo), []).append(repo)
+    with ThreadPoolExecutor(max_workers=max(1, len(by_host))) as checkers:
+        for checked in [checkers.submit(check_all, host_repositories) for host_repositories in by_host.values()]:
+            checked.result()
+
+    for future in pending:
+        repo_errors = future.result()
+        totals['errors'] += repo_errors
+        totals['repos_with_errors'] += 1 if repo_errors else 0
+    writers.shutdown()
+
+    if journal is not None:
+        journal.close()
+
+    if opt.policies is not None:
+        for policy in policies:
+            errors, branches, repos = tally[policy.name]
+            emit('policy', 'POLICY:: {name} => {errors} errors on {branches} branches of {repos} repositories'.format(
+                name=policy.name or 'command line', errors=errors, branches=branches, repos=repos), error=True,
+                policy=policy.name, errors=errors, branches=branches, repositories=repos)
 
-    sys.exit(0 if all_errors == 0 else 1)
+    print_stats(clients)
+    if shard is not None:
+        print_shard(shard, len(repositories), total_repositories, totals['repos_with_errors'])
+    sys.exit(0 if totals['errors'] == 0 else 1)
 
 
 # RULE CHECKERS
@@ -169,9 +374,9 @@ def repo_push_checks(protection, opt):
 
     if protection.push_restrictions != opt.restrict_push:
         if protection.push_restrictions:
-            error(repo, branch, 'Push restrictions are enabled')
+            error(repo, branch, 'Push restrictions are enabled', opt)
         else:
-            error(repo, branch, 'Push restrictions are disabled')
+            error(repo, branch, 'Push restrictions are disabled', opt)
         errors += 1
 
     if not opt.restrict_push:
@@ -193,9 +398,9 @@ def repo_code_review(protection, opt):
 
     if protection.required_code_review != opt.require_code_review:
         if protection.required_code_review:
-            error(repo, branch, 'Mandatory code review is enabled')
+            error(repo, branch, 'Mandatory code review is enabled', opt)
         else:
-            error(repo, branch, 'Mandatory code review is disabled')
+            error(repo, branch, 'Mandatory code review is disabled', opt)
         errors += 1
 
     if not opt.require_code_review:
@@ -204,9 +409,9 @@ def repo_code_review(protection, opt):
     if opt.auto_dismiss_review is not None and \
             protection.dismiss_stale_reviews != opt.auto_dismiss_review:
         if protection.dismiss_stale_reviews:
-            error(repo, branch, 'Reviews are automatically dismissed when new code is pushed')
+            error(repo, branch, 'Reviews are automatically dismissed when new code is pushed', opt)
         else:
-            error(repo, branch, 'Reviews remain valid when new code is pushed')
+            error(repo, branch, 'Reviews remain valid when new code is pushed', opt)
         errors += 1
 
     return errors
@@ -220,14 +425,14 @@ def repo_status_checks(protection, opt):
     if opt.branch_up_to_date is not None:
         if protection.up_to_date != opt.branch_up_to_date:
             if protection.up_to_date:
-                error(repo, branch, 'Branch must be up-to-date with upstream')
+                error(repo, branch, 'Branch must be up-to-date with upstream', opt)
             else:
-                error(repo, branch, 'Branch can be, but is not mandated to be, up-to-date with upstream')
+                error(repo, branch, 'Branch can be, but is not mandated to be, up-to-date with upstream', opt)
             errors += 1
 
     for check in opt.contexts:
         if check not in protection.contexts:
-            error(repo, branch, 'Branch is missing the "{}" check'.format(check))
+            error(repo, branch, 'Branch is missing the "{}" check'.format(check), opt)
             errors += 1
 
     return errors
@@ -241,9 +446,9 @@ def repo_admin_exemptions(protection, opt):
     if opt.except_admins is not None:
         if opt.except_admins != protection.except_admins:
             if protection.except_admins:
-                error(repo, branch, 'Administrators are exempt from branch protections')
+                error(repo, branch, 'Administrators are exempt from branch protections', opt)
             else:
-                error(repo, branch, 'Administrators must also follow branch protections')
+                error(repo, branch, 'Administrators must also follow branch protections', opt)
             errors += 1
 
     return errors
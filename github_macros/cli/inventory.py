@@ -0,0 +1,170 @@
+from __future__ import print_function
+import os
+import sys
+
+from concurrent.futures import ThreadPoolExecutor
+
+from github_macros.cli._base import MyParser, add_filter_args, add_transport_args, check_filter_args, create_client, \
+    listing_fields, print_stats, transport_options
+from github_macros.inventory import REPOSITORY_COLUMNS, Snapshot, SnapshotMiss, permission_name
+from github_macros.models.github import GithubOrganization, GithubRepository, GithubUser
+from github_macros.policy import glob_matcher
+from github_macros.reporting import add_format_args, configure as configure_output, emit
+from github_macros import __version__
+
+SNAPSHOT_FILE = 'inventory.json.gz'
+
+# Everything a snapshot keeps of each repository, by REST name
+LISTING_FIELDS = tuple(column for column in REPOSITORY_COLUMNS if column != 'owner_type')
+
+
+def get_args():
+    p = MyParser()
+    p.add_argument('--version', '-v', action='version',
+                   help='Prints the program version and exits',
+                   version='%(prog)s ' + __version__)
+
+    p.add_argument('--output', '-O', dest='output', action='store', default=SNAPSHOT_FILE, metavar='SNAPSHOT',
+                   help='Where to write the snapshot (default: {})'.format(SNAPSHOT_FILE))
+
+    mapping = p.add_argument_group('Repository listing', 'Use these options for choosing '
+                                   'which repositories go into the snapshot')
+    mapping.add_argument('--repository', '-r', dest='repositories', action='append', default=[],
+                         help='GitHub repository to include in the snapshot')
+    mapping.add_argument('--user', '-u', dest='users', action='append', default=[],
+                         help='GitHub user whose repositories to include in the snapshot')
+    mapping.add_argument('--organization', '-o', dest='organizations', action='append', default=[],
+                         help='GitHub organization whose repositories (and teams) to include in the snapshot')
+
+    contents = p.add_argument_group('Snapshot contents')
+    contents.add_argument('--branch', '-b', dest='branches', action='append', default=[],
+                          help='Only keep branches with names matching this glob, case-sensitively (allows multiple '
+                               'invocations of --branch, default: all branches)')
+    contents.add_argument('--no-branches', dest='with_branches', action='store_false', default=True,
+                          help='Leave out branches and their protection')
+    contents.add_argument('--no-teams', dest='with_teams', action='store_false', default=True,
+                          help='Leave out organization teams and their repository permissions')
+    contents.add_argument('--jobs', '-j', type=int, default=8,
+                          help='Repositories (and teams) to read at the same time (default: 8)')
+
+    p.add_argument('--github-user', dest='gh_user', action='store', default=os.getenv('GITHUB_USER'))
+    p.add_argument('--github-token', dest='gh_token', action='append', default=[],
+                   help='API token, given more than once to rotate between a pool of them '
+                        '(defaults to GITHUB_TOKENS or GITHUB_TOKEN)')
+
+    add_filter_args(p)
+    add_transport_args(p)
+    add_format_args(p)
+
+    opts = p.parse_args()
+    check_filter_args(p, opts)
+    if not (opts.repositories or opts.users or opts.organizations):
+        p.error('one of the arguments --repository/-r --user/-u --organization/-o is required')
+    return opts
+
+
+def read_branches(client, repo, covers=None):
+    """
+    The repository's branches, each with its protection document if it is protected
+
+    param:: covers: Only keep branches whose names this matches
+    """
+    branches = []
+    for item in client.paginate('/repos/{r}/branches'.format(r=repo.full_name)):
+        if covers is not None and not covers(item['name']):
+            continue
+        protection = None
+        # Unprotected branches have nothing more to fetch (it would only be a 404)
+        if item.get('protected') or (item.get('protection') or {}).get('enabled'):
+            resp = client.get('/repos/{r}/branches/{b}/protection'.format(r=repo.full_name, b=item['name']))
+            if resp.status_code == 200:
+                protection = resp.json()
+            elif resp.status_code not in (403, 404):
+                resp.raise_for_status()
+        branches.append((item, protection))
+    return branches
+
+
+def read_team_repositories(client, team):
+    return [(item['full_name'], permission_name(item.get('permissions')))
+            for item in client.paginate('/teams/{team_id}/repos'.format(team_id=team['id']))]
+
+
+def main():
+    opts = get_args()
+    configure_output(opts)
+    client = create_client(username=opts.gh_user, token=opts.gh_token, **transport_options(opts))
+
+    snapshot = Snapshot(domain=client.domain)
+    workers = ThreadPoolExecutor(max_workers=max(1, opts.jobs))
+    fields = listing_fields(opts, LISTING_FIELDS)
+    covers = glob_matcher(opts.branches, ignore_case=False) if opts.branches else None
+    branch_reads = []
+
+    def add(repo):
+        index = snapshot.add_repository(repo)
+        if opts.with_branches:
+            branch_reads.append((index, workers.submit(read_branches, client, repo, covers)))
+
+    owners = [GithubOrganization(client, org_name) for org_name in opts.organizations]
+    owners += [GithubUser(client, username) for username in opts.users]
+    for owner in owners:
+        is_org = isinstance(owner, GithubOrganization)
+        snapshot.add_owner(owner.name, 'Organization' if is_org else 'User', teams=is_org and opts.with_teams)
+        listing = opts.where.repositories(owner, fields=fields) if opts.where is not None \
+            else owner.iter_repositories(fields=fields)
+        count = 0
+        for repo in listing:
+            add(repo)
+            count += 1
+        emit('owner', '{label}: {name} ({count} repositories)'.format(label='  ORG' if is_org else ' USER', name=owner.name, count=count),
+             owner=owner.name, owner_type='Organization' if is_org else 'User', repositories=count)
+
+    for repo_name in opts.repositories:
+        try:
+            snapshot.repository(repo_name)
+            continue  # Already in from its owner's listing
+        except SnapshotMiss:
+            pass
+        repo = GithubRepository.fetch(client, repo_name)
+        if opts.where is None or opts.where(repo):
+            add(repo)
+            emit('repo', ' REPO: {name}'.format(name=repo.full_name), repository=repo.full_name)
+
+    team_reads = []
+    if opts.with_teams:
+        for org_name in opts.organizations:
+            for team in client.paginate('/orgs/{org}/teams'.format(org=org_name)):
+                index = snapshot.add_team(org_name, team)
+                team_reads.append((index, workers.submit(read_team_repositories, client, team)))
+
+    protected = 0
+    for index, future in branch_reads:
+        for item, protection in future.result():
+            snapshot.add_branch(index, item, protection)
+            protected += 1 if protection is not None else 0
+    for index, future in team_reads:
+        for full_name, permission in future.result():
+            try:
+                snapshot.add_team_repository(index, snapshot.repository(full_name), permission)
+            except SnapshotMiss:
+                pass  # Belongs to someone else, or was left out by --where
+    workers.shutdown()
+
+    snapshot.save(opts.output)
+    msg = 'SNAPSHOT: {path} => {repositories} repositories, {branches} branches ({protected} protected), {teams} teams ({size} KB)'
+    summary = {
+        'path': opts.output,
+        'repositories': len(snapshot.tables['repositories']),
+        'branches': len(snapshot.tables['branches']),
+        'protected': protected,
+        'teams': len(snapshot.tables['teams']),
+        'size': int(round(os.path.getsize(opts.output) / 1024.0)),
+    }
+    emit('snapshot', msg.format(**summary), **summary)
+    print_stats(client)
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
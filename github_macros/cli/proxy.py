@@ -0,0 +1,68 @@
+import os
+import signal
+import sys
+
+from github_macros.cli._base import MyParser
+from github_macros.proxy import ProxyServer
+from github_macros.reporting import add_format_args, configure as configure_output, emit
+from github_macros import __version__
+
+
+def get_args():
+    p = MyParser()
+    p.add_argument('--version', '-v', action='version',
+                   help='Prints the program version and exits',
+                   version='%(prog)s ' + __version__)
+
+    p.add_argument('--socket', dest='socket', action='store', default=os.getenv('GITHUB_PROXY_SOCKET'), metavar='PATH',
+                   help='Unix socket to listen on, the same one the other commands are given (GITHUB_PROXY_SOCKET)')
+    p.add_argument('--pool-size', dest='pool_size', action='store', type=int,
+                   default=int(os.getenv('GITHUB_POOL_SIZE', 20)),
+                   help='Connections kept open to each GitHub host (GITHUB_POOL_SIZE, default: 20)')
+    p.add_argument('--connect-timeout', dest='connect_timeout', action='store', type=float,
+                   default=float(os.getenv('GITHUB_CONNECT_TIMEOUT', 10)),
+                   help='Seconds to wait for a connection to the API (GITHUB_CONNECT_TIMEOUT)')
+    p.add_argument('--read-timeout', dest='read_timeout', action='store', type=float,
+                   default=float(os.getenv('GITHUB_READ_TIMEOUT', 60)),
+                   help='Seconds to wait on a stalled response from the API (GITHUB_READ_TIMEOUT)')
+    p.add_argument('--max-age', dest='max_age', action='store', type=float, default=0,
+                   help='Seconds a cached response is answered with before asking GitHub whether it changed '
+                        '(default: 0, always ask, which costs no rate limit when it hasn\'t)')
+    p.add_argument('--cache-mb', dest='cache_mb', action='store', type=int, default=256,
+                   help='Megabytes of responses to keep cached (default: 256)')
+
+    add_format_args(p)
+
+    opts = p.parse_args()
+    if not opts.socket:
+        p.error('Requires a socket to be given via GITHUB_PROXY_SOCKET variable or --socket flag')
+    return opts
+
+
+def stop(signum, frame):
+    raise KeyboardInterrupt()
+
+
+def main():
+    opts = get_args()
+    configure_output(opts)
+    server = ProxyServer(opts.socket, pool_size=opts.pool_size, timeout=(opts.connect_timeout, opts.read_timeout),
+                         max_age=opts.max_age, cache_bytes=opts.cache_mb * 1024 * 1024)
+    signal.signal(signal.SIGTERM, stop)
+    emit('serve', 'SERVE: Proxying API calls on {}'.format(opts.socket), socket=opts.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+    stats = dict((stat, server.stats[stat]) for stat in ('requests', 'upstream', 'cached', 'revalidated', 'coalesced', 'held'))
+    msg = 'STATS: {requests} API requests, {upstream} sent on to GitHub, {cached} answered from the cache, ' \
+          '{revalidated} revalidated, {coalesced} coalesced, {held} held back for the rate limit'
+    emit('stats', msg.format(**stats), error=True, **stats)
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
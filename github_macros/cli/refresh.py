@@ -1,12 +1,45 @@
+from __future__ import print_function
+import collections
+import contextlib
+import itertools
+import json
 import os
+import queue
+import re
+import sys
+import threading
+import time
+from urllib.parse import urlparse
 
-from github_macros.cli._base import MyParser, create_client
-from github_macros.models.github import GithubOrganization, GithubUser
+import requests
+
+from github_macros.cli._base import MyParser, add_filter_args, add_journal_args, add_shard_args, add_transport_args, \
+    check_filter_args, clients_from, listing_fields, open_journal, print_shard, print_stats, shard_from
+from github_macros.concurrency import AdaptiveLimit
+from github_macros.git_server import GitServer
+from github_macros.hosts import default_host, host_of, qualified_name, qualify
+from github_macros.maintenance import Maintenance
+from github_macros.models.github import GithubOrganization, GithubRepository, GithubUser
+from github_macros.reporting import add_format_args, configure as configure_output, emit
+from github_macros.submodules import update as update_submodules
+from github_macros.webhook import WebhookServer
 from github_macros import __version__
 
 from sh.contrib import git as git_cmd
 import sh
 
+_DONE = object()  # Tells a worker the queue has been drained for good
+
+HISTORY_FILE = '.gh-refresh-history.json'
+JOURNAL_FILE = '.gh-refresh-journal'
+WEBHOOK_EVENTS = ('push', 'create', 'delete', 'repository')
+WATCH_EVENTS = ('PushEvent', 'CreateEvent')
+# All we need to know about a repository to clone/update and schedule it
+LISTING_FIELDS = ('name', 'owner', 'full_name', 'ssh_url', 'pushed_at', 'size')
+# What git says when the server pushes back (5xx, rate limits), as opposed to a problem with the
+# repository itself, or the network on our side
+GIT_OVERLOADED = re.compile(r'returned error: (5\d\d|429)|too many requests|rate limit', re.IGNORECASE)
+
 
 def git(*args, **kwargs):
     exc = None
@@ -20,42 +53,77 @@ def git(*args, **kwargs):
         raise exc
 
 
+def git_overloaded(e):
+    if isinstance(e, sh.ErrorReturnCode):
+        return bool(GIT_OVERLOADED.search(e.stderr.decode('utf-8', 'replace')))
+    return False
+
+
+def owner_label(owner):
+    return qualify(host_of(owner), owner.name)
+
+
+def owner_path(owner):
+    """
+    Where the owner's repositories are mirrored, under a directory named after its host unless
+    that's the default host
+    """
+    host = host_of(owner)
+    return owner.name if host == default_host() else os.path.join(host, owner.name)
+
+
+def repo_path(repo):
+    return os.path.join(owner_path(repo.owner), repo.name)
+
+
 def git_ref_resolve(repo, ref):
-    path = os.path.join(repo.owner.name, repo.name)
+    path = repo_path(repo)
     try:
         return git('-C', path, 'rev-parse', '--abbrev-ref', ref).strip()
     except sh.ErrorReturnCode:
         return None
 
 
-def clone(repo, fake=False, clobber=False):
+def clone(repo, fake=False, clobber=False, timeout=None, submodule_jobs=None):
     """
+    param:: timeout: Seconds after which a fetch or clone is given up on
+    param:: submodule_jobs: Also check out submodules (recursively), this many at a time, taking
+                            what the mirror already has from it (see `github_macros.submodules`)
     """
-    path = os.path.join(repo.owner.name, repo.name)
+    path = repo_path(repo)
+    network = {'_timeout': timeout} if timeout else {}
 
     if os.path.exists(path):
-        print(' REPO: Updating {repo}'.format(repo=repo.full_name))
+        emit('repo', ' REPO: Updating {repo}'.format(repo=qualified_name(repo)), repository=qualified_name(repo),
+             action='update', dry_run=fake or None)
         if fake:
             return
-        git('-C', path, 'fetch', 'origin')
-        if not clobber:
-            return
+        git('-C', path, 'fetch', 'origin', **network)
 
-        branch_name = git_ref_resolve(repo, 'HEAD')
+        if clobber:
+            branch_name = git_ref_resolve(repo, 'HEAD')
 
-        if branch_name == 'master':
-            git('-C', path, 'reset', '--hard', 'origin/master')
-        elif branch_name:
-            git('-C', path, 'branch', '-f', 'master', 'origin/master')
-        elif git_ref_resolve(repo, 'origin/master'):
-            git('-C', path, 'pull', 'origin', 'master')
+            if branch_name == 'master':
+                git('-C', path, 'reset', '--hard', 'origin/master')
+            elif branch_name:
+                git('-C', path, 'branch', '-f', 'master', 'origin/master')
+            elif git_ref_resolve(repo, 'origin/master'):
+                git('-C', path, 'pull', 'origin', 'master', **network)
 
     else:
         os.makedirs(path)
-        print(' REPO: Cloning {repo}'.format(repo=repo.full_name))
+        emit('repo', ' REPO: Cloning {repo}'.format(repo=qualified_name(repo)), repository=qualified_name(repo),
+             action='clone', dry_run=fake or None)
         if fake:
             return
-        git('clone', repo.clone_url, path)
+        git('clone', repo.clone_url, path, **network)
+
+    if submodule_jobs:
+        checked_out, mirrored = update_submodules(path, os.getcwd(), jobs=submodule_jobs, timeout=timeout)
+        if checked_out:
+            emit('submodules', '  SUB: {repo} => {n} submodules ({mirrored} from the mirror)'.format(
+                repo=qualified_name(repo), n=checked_out, mirrored=mirrored), repository=qualified_name(repo),
+                submodules=checked_out, mirrored=mirrored)
 
 
 def get_args():
@@ -65,67 +133,590 @@ def get_args():
                    version='%(prog)s ' + __version__)
 
     p.add_argument('--user', '-u', dest='users', action='append', default=[os.getenv('GITHUB_USER')] if os.getenv('GITHUB_USER') else [],
-                   help='GitHub user from which to clone/update all repositories')
+                   help='GitHub user from which to clone/update all repositories ([HOST:]USER for other GitHub hosts)')
     p.add_argument('--organization', '-o', dest='organizations', action='append', default=[],
-                   help='GitHub organization from which to clone/update all repositories')
+                   help='GitHub organization from which to clone/update all repositories ([HOST:]ORG for other GitHub hosts)')
     p.add_argument('--base-dir', dest='base_directory', action='store', default=os.getcwd(),
-                   help='The directory where repositories will be cloned in a Github-like directory structure')
+                   help='The directory where repositories will be cloned in a Github-like directory structure '
+                        '(with those from other GitHub hosts under a directory named after the host)')
 
     p.add_argument('--github-user', dest='gh_user', action='store', default=os.getenv('GITHUB_USER'))
-    p.add_argument('--github-token', dest='gh_token', action='store', default=os.getenv('GITHUB_TOKEN'))
+    p.add_argument('--github-token', dest='gh_token', action='append', default=[],
+                   help='API token, given more than once to rotate between a pool of them, as HOST=TOKEN for other '
+                        'GitHub hosts (defaults to GITHUB_TOKENS or GITHUB_TOKEN, and GITHUB_TOKEN_<HOST> for other hosts)')
 
     p.add_argument('--dry-run', dest='dry_run', action='store_true', default=False)
 
     p.add_argument('--clobber', '-F', dest='clobber', action='store_true', default=False,
                    help='Overwrite existing working copy for each repository')
+    p.add_argument('--jobs', '-j', dest='jobs', action='store', type=int, default=4,
+                   help='Number of repositories to clone/update at the same time')
+    p.add_argument('--schedule', dest='schedule', action='store', default='size', choices=['size', 'history', 'api'],
+                   help='Order in which to work through repositories: largest first (size), longest '
+                        'previous run first (history, recorded in {}), or as listed (api)'.format(HISTORY_FILE))
+    p.add_argument('--git-timeout', dest='git_timeout', action='store', type=float, default=0,
+                   help='Seconds after which a single clone/update is given up on (0 for no limit)')
+    p.add_argument('--max-inflight-mb', dest='max_inflight_mb', action='store', type=int, default=0,
+                   help='Max megabytes of repositories being freshly cloned at once (0 for no limit)')
+    p.add_argument('--submodules', dest='submodules', action='store_true', default=False,
+                   help='Also check out submodules, recursively, borrowing from the mirror for any that are mirrored')
+    p.add_argument('--submodule-jobs', dest='submodule_jobs', action='store', type=int, default=4,
+                   help='Number of submodules of a repository to check out at the same time (default: 4)')
+
+    upkeep = p.add_argument_group('Maintenance', 'After each update, repositories that have piled up packs or loose '
+                                  'objects are tidied up at low priority, so fetching them stays fast')
+    upkeep.add_argument('--no-maintenance', dest='maintenance', action='store_false', default=True,
+                        help='Leave repositories as fetched')
+    upkeep.add_argument('--maintenance-jobs', dest='maintenance_jobs', action='store', type=int, default=1,
+                        help='Number of repositories to tidy up at the same time (default: 1)')
+    upkeep.add_argument('--max-packs', dest='max_packs', action='store', type=int, default=10,
+                        help='Packs a repository may have before the smaller ones are rolled together (default: 10)')
+    upkeep.add_argument('--max-loose', dest='max_loose', action='store', type=int, default=100,
+                        help='Loose objects a repository may have before they are packed (default: 100)')
+    upkeep.add_argument('--max-loose-mb', dest='max_loose_mb', action='store', type=int, default=50,
+                        help='Megabytes of loose objects a repository may have before they are packed, whatever '
+                             'their number (0 for no limit, default: 50)')
+
+    add_filter_args(p)
+    add_shard_args(p)
+    add_journal_args(p, default=JOURNAL_FILE)
+
+    serve = p.add_argument_group('Keep running', 'Keep running after the sweep, only updating the '
+                                 'repositories that change, as told by webhooks or the events API')
+    serve_mode = serve.add_mutually_exclusive_group()
+    serve_mode.add_argument('--serve', dest='serve', action='store', default=None, metavar='[HOST:]PORT',
+                            help='Address to listen on for push/create/delete/repository webhook deliveries')
+    serve_mode.add_argument('--watch', dest='watch', action='store', type=int, nargs='?', default=None, const=60,
+                            metavar='SECONDS', help='Poll the events API of each organization and user '
+                                                    '(every 60 seconds, unless GitHub asks for longer)')
+    serve.add_argument('--serve-git', dest='serve_git', action='store', default=None, metavar='[HOST:]PORT',
+                       help='Also serve the mirror to git clients over HTTP on this address, cloning or updating '
+                            'repositories on demand (read-only, and from the start of the sweep)')
+    serve.add_argument('--serve-git-max-age', dest='serve_git_max_age', action='store', type=float, default=60,
+                       metavar='SECONDS', help='How long since a repository was last fetched before it\'s updated '
+                                               'again for a client listing its refs (default: 60)')
+    serve.add_argument('--webhook-secret', dest='webhook_secret', action='store', default=os.getenv('GITHUB_WEBHOOK_SECRET'),
+                       help='Secret configured on the webhook, for checking signatures (GITHUB_WEBHOOK_SECRET)')
+
+    add_transport_args(p)
+    add_format_args(p)
+
+    opts = p.parse_args()
+    check_filter_args(p, opts)
+    if opts.serve and not opts.webhook_secret:
+        p.error('--serve requires --webhook-secret (or GITHUB_WEBHOOK_SECRET) to verify deliveries')
+    if opts.serve_git and opts.dry_run:
+        p.error('--serve-git has nothing to serve on a dry run')
+    return opts
+
+
+class ByteBudget(object):
+    """
+    Caps the kilobytes of repositories being cloned at once, so a few huge repositories can't
+    saturate the disk and network between them. A single repository larger than the whole
+    budget still runs, just on its own.
+    """
+
+    def __init__(self, limit_kb):
+        self.limit_kb = limit_kb
+        self.in_flight = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, kb):
+        if not self.limit_kb:
+            return
+        with self._cond:
+            while self.in_flight and self.in_flight + kb > self.limit_kb:
+                self._cond.wait()
+            self.in_flight += kb
+
+    def release(self, kb):
+        if not self.limit_kb:
+            return
+        with self._cond:
+            self.in_flight -= kb
+            self._cond.notify_all()
+
+
+class CloneScheduler(object):
+    """
+    Hands out clone/update work longest-job-first, so a huge repository found late in the
+    listing doesn't end up running alone at the end and setting the total run time. A repository
+    already waiting in the queue is not queued a second time.
+
+    Strategies:
+      * api: in the order the API listed them
+      * size: largest repository (as reported by GitHub) first
+      * history: longest recorded clone/update first, with never-seen repositories ahead of
+        those by size
+
+    With a `limit`, fewer workers run at once while the server pushes back on clones and fetches
+    (see `GIT_OVERLOADED`), going back up as they succeed again.
+    """
+
+    def __init__(self, strategy='size', history=None, max_inflight_kb=0, shard=None, where=None, limit=None):
+        self.strategy = strategy
+        self.shard = shard
+        self.where = where
+        self.history = history if history is not None else {}
+        self.budget = ByteBudget(max_inflight_kb)
+        self.limit = limit
+        self._queue = queue.PriorityQueue()
+        self._seq = itertools.count()  # Ties (and the 'api' strategy) go in listing order
+        self._lock = threading.Lock()
+        self._pending = set([])
+
+    def priority(self, repo):
+        if self.strategy == 'size':
+            return (-(repo.size or 0),)
+        if self.strategy == 'history':
+            if qualified_name(repo) not in self.history:
+                return (0, -(repo.size or 0))
+            return (1, -self.history[qualified_name(repo)])
+        return ()
+
+    def selects(self, repo):
+        """
+        Whether the repository is this shard's to mirror, and matches the `--where` filter
+        """
+        if self.shard is not None and not self.shard.contains(repo):
+            return False
+        return self.where is None or self.where(repo)
+
+    def put(self, repo):
+        """
+        Returns False when the repository was already waiting to be worked on, belongs to
+        another shard, or doesn't match the `--where` filter
+        """
+        if not self.selects(repo):
+            return False
+        with self._lock:
+            if qualified_name(repo) in self._pending:
+                return False
+            self._pending.add(qualified_name(repo))
+        self._queue.put((self.priority(repo), next(self._seq), repo))
+        return True
+
+    def close(self, workers):
+        for _ in range(workers):
+            self._queue.put(((float('inf'),), next(self._seq), _DONE))
+
+    def get(self):
+        repo = self._queue.get()[-1]
+        if repo is not _DONE:
+            # Once work has started, a newer event for it needs another pass
+            with self._lock:
+                self._pending.discard(qualified_name(repo))
+        return repo
+
+    def task_done(self):
+        self._queue.task_done()
+
+    def join(self):
+        """
+        Blocks until everything queued so far has been worked on
+        """
+        self._queue.join()
+
+    @contextlib.contextmanager
+    def running(self, repo):
+        # Only fresh clones transfer the whole repository
+        kb = 0 if os.path.exists(repo_path(repo)) else (repo.size or 0)
+        self.budget.acquire(kb)
+        # Clones take as long as the repository is large, so only failures say anything about the server
+        slot = self.limit.acquire() if self.limit is not None else None
+        started = time.time()
+        try:
+            yield
+        except Exception as e:
+            if slot is not None:
+                slot.overloaded = git_overloaded(e)
+            raise
+        finally:
+            if slot is not None:
+                self.limit.release(slot)
+            self.budget.release(kb)
+        with self._lock:
+            self.history[qualified_name(repo)] = round(time.time() - started, 3)
+
+
+def load_history(path=HISTORY_FILE):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_history(history, path=HISTORY_FILE):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(history, f, indent=0, sort_keys=True)
+    os.rename(path + '.tmp', path)
+
+
+def list_repositories(owner, label, work, managed_directories, failures, tally=None, fields=None, held=None):
+    """
+    Producer: feeds each repository to the work queue as soon as its page of the API listing
+    arrives, rather than waiting on the whole listing
+
+    param:: held: Collects the repositories here instead, for when nothing can be queued before
+                  every owner has been listed (balancing shards by size, see `Shard.select()`)
+    """
+    emit('owner', '{label}: {name}'.format(label=label, name=owner_label(owner)), owner=owner_label(owner),
+         kind=label.strip().lower())
+    tally = tally if tally is not None else collections.Counter()
+    try:
+        if work.where is not None:
+            repos = work.where.repositories(owner, fields=fields)
+        else:
+            repos = owner.iter_repositories(fields=fields)
+
+        for repo in repos:
+            # Other shards' repositories aren't extra, so they're still accounted for here
+            managed_directories.add(repo_path(repo))
+            tally['listed'] += 1
+            if held is not None:
+                held.append(repo)
+            elif work.put(repo):
+                tally['selected'] += 1
+    except Exception as e:
+        failures.append(owner_label(owner))
+        emit('error', 'ERROR: {name} => {e}'.format(name=owner_label(owner), e=e), error=True, owner=owner_label(owner),
+             message=str(e))
+
+
+def refresh_fingerprint(repo, opts):
+    """
+    Everything that would make another clone/update of the repository do something new
+    """
+    fingerprint = '{pushed}|clobber={clobber}'.format(pushed=repo.pushed_at.isoformat() if repo.pushed_at else None,
+                                                      clobber=opts.clobber)
+    return fingerprint + '|submodules' if opts.submodules else fingerprint
+
 
-    return p.parse_args()
+@contextlib.contextmanager
+def maintenance_paused(maintenance, path):
+    if maintenance is None:
+        yield
+        return
+    with maintenance.locked(path):
+        yield
+
+
+def clone_worker(work, opts, failures, journal=None, maintenance=None):
+    """
+    Consumer: clones or updates repositories until told there are no more coming
+    """
+    while True:
+        repo = work.get()
+        if repo is _DONE:
+            return
+        try:
+            fingerprint = refresh_fingerprint(repo, opts)
+            path = repo_path(repo)
+            if opts.resume and journal.done('refresh', qualified_name(repo), fingerprint) and os.path.exists(path):
+                emit('skip', ' SKIP: {repo} is unchanged since it was last updated'.format(repo=qualified_name(repo)),
+                     repository=qualified_name(repo), reason='unchanged')
+                continue
+
+            updating = os.path.exists(path)
+            with maintenance_paused(maintenance, path), work.running(repo):
+                clone(repo, fake=opts.dry_run, clobber=opts.clobber, timeout=opts.git_timeout,
+                      submodule_jobs=max(1, opts.submodule_jobs) if opts.submodules else None)
+
+            # A fresh clone is already as tidy as it gets
+            if maintenance is not None and updating and not opts.dry_run:
+                maintenance.put(path)
+            if journal is not None and not opts.dry_run:
+                journal.record('refresh', qualified_name(repo), fingerprint)
+        except Exception as e:
+            failures.append(qualified_name(repo))
+            emit('error', 'ERROR: {name} => {e}'.format(name=qualified_name(repo), e=e), error=True,
+                 repository=qualified_name(repo), message=str(e))
+        finally:
+            work.task_done()
+
+
+def webhook_receiver(clients, work, owner_names):
+    """
+    Turns webhook deliveries into targeted clone/update work for just the repository affected
+
+    param:: clients: `HostClients` of the hosts being mirrored, deliveries from others are ignored
+    """
+    def on_event(event, payload):
+        if event not in WEBHOOK_EVENTS or not payload.get('repository'):
+            return False
+
+        host = urlparse(payload['repository'].get('html_url') or '').hostname or default_host()
+        if host not in clients:
+            return False
+        # `deserialize()` consumes parts of the payload
+        repo = GithubRepository.deserialize(clients.get(host), dict(payload['repository']))
+        if owner_names and owner_label(repo.owner).lower() not in owner_names:
+            return False
+        if event == 'repository' and payload.get('action') in ('deleted', 'archived'):
+            emit('hook', ' HOOK: {repo} was {action}, leaving the local copy alone'.format(repo=qualified_name(repo), action=payload['action']),
+                 event=event, action=payload['action'], repository=qualified_name(repo), queued=False)
+            return False
+
+        queued = work.put(repo)
+        emit('hook', ' HOOK: {event} {repo}{dup}'.format(event=event, repo=qualified_name(repo), dup='' if queued else ' (already queued)'),
+             event=event, repository=qualified_name(repo), queued=queued)
+        return True
+
+    return on_event
+
+
+def git_cache(clients, work, owner_names, opts, maintenance=None):
+    """
+    Clones or updates a repository a git client asked for, right away, for `GitServer`
+
+    param:: owner_names: Lowercased labels of the organizations and users being mirrored, the
+                         only ones whose repositories are served
+    """
+    def refresh(host, full_name):
+        if host not in clients:
+            return None
+        if qualify(host, full_name.split('/')[0]).lower() not in owner_names:
+            return None
+        try:
+            # Also has the names as GitHub spells them, which is how they're laid out on disk
+            repo = GithubRepository.fetch(clients.get(host), full_name)
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                return None
+            raise
+        if not work.selects(repo):
+            return None
+
+        path = repo_path(repo)
+        updating = os.path.exists(path)
+        try:
+            with maintenance_paused(maintenance, path):
+                clone(repo, clobber=opts.clobber, timeout=opts.git_timeout,
+                      submodule_jobs=max(1, opts.submodule_jobs) if opts.submodules else None)
+        except Exception as e:
+            emit('error', 'ERROR: {name} => {e}'.format(name=qualified_name(repo), e=e), error=True,
+                 repository=qualified_name(repo), message=str(e))
+            if not os.path.isdir(os.path.join(path, '.git')):
+                raise
+            # Likely being updated by a worker at the same time; what the mirror has will do
+            return path
+
+        if maintenance is not None and updating:
+            maintenance.put(path)
+        return path
+
+    return refresh
+
+
+def watch_cursors(owners):
+    """
+    Marks where each owner's events feed is right now, so changes from here on can be picked up
+    """
+    cursors = {}
+    for _, owner in owners:
+        poll = owner.poll_events()
+        newest = max([int(event['id']) for event in poll.events] or [0])
+        cursors[owner_label(owner)] = {'etag': poll.etag, 'since': newest}
+    return cursors
+
+
+def watch(owners, cursors, work, failures, interval, fields=None):
+    """
+    Polls each owner's events feed (cheaply, with ETags), only updating repositories that saw
+    pushes or new branches/tags since the last poll. If more happened than the feed holds,
+    falls back to a full sweep of that owner.
+    """
+    while True:
+        wait = interval
+        for label, owner in owners:
+            cursor = cursors[owner_label(owner)]
+            try:
+                poll = owner.poll_events(etag=cursor['etag'], since=cursor['since'])
+            except Exception as e:
+                emit('error', 'ERROR: {name} => {e}'.format(name=owner_label(owner), e=e), error=True,
+                     owner=owner_label(owner), message=str(e))
+                continue
+
+            wait = max(wait, poll.poll_interval)
+            cursor['etag'] = poll.etag
+            if poll.events:
+                cursor['since'] = max(int(event['id']) for event in poll.events)
+
+            if not poll.complete:
+                emit('watch', 'WATCH: Missed events for {name}, checking every repository'.format(name=owner_label(owner)),
+                     owner=owner_label(owner), complete=False)
+                list_repositories(owner, label, work, set([]), failures, fields=fields)
+                continue
+
+            changed = []
+            for event in reversed(poll.events):
+                full_name = event['repo']['name']
+                if event['type'] not in WATCH_EVENTS or full_name in changed:
+                    continue
+                if full_name.split('/')[0].lower() != owner.name.lower():
+                    continue  # e.g., a user pushing to someone else's repository
+                changed.append(full_name)
+
+            for full_name in changed:
+                try:
+                    work.put(GithubRepository.fetch(owner.http, full_name))
+                except Exception as e:
+                    failures.append(qualify(host_of(owner), full_name))
+                    emit('error', 'ERROR: {name} => {e}'.format(name=qualify(host_of(owner), full_name), e=e), error=True,
+                         repository=qualify(host_of(owner), full_name), message=str(e))
+
+        time.sleep(wait)
+
+
+def parse_address(spec):
+    host, _, port = spec.rpartition(':')
+    return (host or '127.0.0.1', int(port))
+
+
+def report_maintenance(path, tasks, counts):
+    emit('maintenance', 'MAINT: {repo} => {tasks} (had {packs} packs, {loose} loose objects)'.format(
+        repo=path.replace(os.sep, '/'), tasks=', '.join(tasks), packs=counts.packs, loose=counts.loose),
+        path=path.replace(os.sep, '/'), tasks=tasks, packs=counts.packs, loose=counts.loose)
+
+
+def report_maintenance_error(path, e):
+    # The mirror is still good, just not as quick to fetch, so this isn't a failure of the run
+    emit('error', 'ERROR: {repo} => maintenance: {e}'.format(repo=path.replace(os.sep, '/'), e=e), error=True,
+         path=path.replace(os.sep, '/'), message='maintenance: {}'.format(e))
+
+
+def start_thread(target, *args):
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True  # Don't hold up Ctrl-C
+    thread.start()
+    return thread
 
 
 def main():
     opts = get_args()
+    configure_output(opts)
     os.chdir(opts.base_directory)
-    client = create_client(username=opts.gh_user, token=opts.gh_token)
+    clients = clients_from(opts)
 
-    for org_name in set(opts.organizations):
-        # org.repositories is a lazy-loaded item, so we don't need to fetch all the info on the org
-        org = GithubOrganization(client, org_name)
-        managed_directories = set([])
+    # org.repositories is a lazy-loaded item, so we don't need to fetch all the info on the org (or person)
+    owners = [('  ORG', GithubOrganization(*clients.resolve(spec))) for spec in sorted(set(opts.organizations))]
+    owners += [(' USER', GithubUser(*clients.resolve(spec))) for spec in sorted(set(opts.users))]
 
-        print('  ORG: {org}'.format(org=org.name))
-        for repo in org.repositories:
-            managed_directories.add(os.path.join(repo.owner.name, repo.name))
-            clone(repo, fake=opts.dry_run, clobber=opts.clobber)
+    # Every owner is listed at the same time (each host with its own client), with git workers
+    # draining the queue as the API pages come in, so API and git network time overlap instead of adding up
+    # Take note of where the events feeds are before the sweep, so nothing happening during it is missed
+    cursors = watch_cursors(owners) if opts.watch is not None else None
 
-        # list directories in {org.name} directory
-        for directory_name in os.listdir(org.name):
-            full_path = os.path.join(org.name, directory_name)
+    history = load_history()
+    work = CloneScheduler(strategy=opts.schedule, history=history, max_inflight_kb=opts.max_inflight_mb * 1024,
+                          shard=shard_from(opts), where=opts.where,
+                          limit=AdaptiveLimit(max(1, opts.jobs)) if opts.adaptive else None)
+    failures = []
+    tally = collections.Counter()
+    managed_directories = dict((owner_label(owner), set([])) for _, owner in owners)
+    fields = listing_fields(opts, LISTING_FIELDS)
+    # Balancing shards by size needs every owner's listing before anything can be assigned
+    held = [] if work.shard is not None and work.shard.balance == 'size' else None
+    producers = [start_thread(list_repositories, owner, label, work, managed_directories[owner_label(owner)], failures, tally,
+                              fields, held)
+                 for label, owner in owners]
+    # A dry run has nothing to record, and shouldn't start the journal over either
+    journal = open_journal(opts) if opts.resume or not opts.dry_run else None
+    maintenance = None
+    if opts.maintenance and not opts.dry_run:
+        maintenance = Maintenance(jobs=opts.maintenance_jobs, max_packs=opts.max_packs, max_loose=opts.max_loose,
+                                  max_loose_kb=opts.max_loose_mb * 1024, report=report_maintenance, on_error=report_maintenance_error)
+    workers = [start_thread(clone_worker, work, opts, failures, journal, maintenance) for _ in range(max(1, opts.jobs))]
+
+    owner_names = set(owner_label(owner).lower() for _, owner in owners)
+    git_server = None
+    if opts.serve_git:
+        git_server = GitServer(parse_address(opts.serve_git), os.getcwd(),
+                               git_cache(clients, work, owner_names, opts, maintenance), max_age=opts.serve_git_max_age,
+                               owners=owner_names)
+        start_thread(git_server.serve_forever)
+        emit('serve', 'SERVE: Serving the mirror to git on http://{}:{}/'.format(*git_server.server_address),
+             address='{}:{}'.format(*git_server.server_address), protocol='git')
+
+    for thread in producers:
+        thread.join()
+    if held is not None:
+        work.shard.select(held)
+        tally['selected'] += sum(1 for repo in held if work.put(repo))
+    work.join()
+
+    for _, owner in owners:
+        # list directories in the owner's directory (unless filtered, when we never heard of some)
+        if opts.where is not None or not os.path.isdir(owner_path(owner)):
+            continue
+        for directory_name in sorted(os.listdir(owner_path(owner))):
+            full_path = os.path.join(owner_path(owner), directory_name)
             if not os.path.isdir(full_path):
                 continue
-            if full_path in managed_directories:
+            if full_path in managed_directories[owner_label(owner)]:
                 continue
 
-            print('EXTRA: {directory}'.format(directory=full_path))
+            emit('extra', 'EXTRA: {directory}'.format(directory=full_path), path=full_path.replace(os.sep, '/'))
 
-    for username in set(opts.users):
-        # user.repositories is a lazy-loaded item, so we don't need to fetch all the info on the person
-        user = GithubUser(client, username)
-        managed_directories = set([])
+    if not opts.dry_run:
+        save_history(history)
 
-        print(' USER: {user}'.format(user=user.name))
-        for repo in user.repositories:
-            managed_directories.add(os.path.join(repo.owner.name, repo.name))
-            clone(repo, fake=opts.dry_run, clobber=opts.clobber)
+    if opts.serve:
+        server = WebhookServer(parse_address(opts.serve), webhook_receiver(clients, work, owner_names),
+                               secret=opts.webhook_secret)
+        emit('serve', 'SERVE: Listening for webhooks on {}:{}'.format(*server.server_address),
+             address='{}:{}'.format(*server.server_address))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            work.join()
+            if not opts.dry_run:
+                save_history(history)
+    elif opts.watch is not None:
+        emit('watch', 'WATCH: Polling events every {} seconds (or as often as GitHub allows)'.format(opts.watch),
+             interval=opts.watch)
+        try:
+            watch(owners, cursors, work, failures, opts.watch, fields)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            work.join()
+            if not opts.dry_run:
+                save_history(history)
+    elif git_server is not None:
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
 
-        # list directories in {user.name} directory
-        for directory_name in os.listdir(user.name):
-            full_path = os.path.join(user.name, directory_name)
-            if not os.path.isdir(full_path):
-                continue
-            if full_path in managed_directories:
-                continue
+    if git_server is not None:
+        git_server.shutdown()
+        git_server.server_close()
+
+    work.close(len(workers))
+    for thread in workers:
+        thread.join()
+    if maintenance is not None:
+        maintenance.close()
+    if journal is not None:
+        journal.close()
 
-            print('EXTRA: {directory}'.format(directory=full_path))
+    print_stats(clients)
+    if git_server is not None:
+        stats = dict((stat, git_server.stats[stat]) for stat in ('requests', 'updates', 'coalesced'))
+        emit('stats', 'STATS: {requests} git requests, {updates} updates on demand, {coalesced} coalesced'.format(**stats),
+             error=True, **stats)
+    if work.limit is not None:
+        emit('stats', 'STATS: git concurrency {}'.format(work.limit), error=True, git_concurrency=int(work.limit.limit),
+             backoffs=work.limit.backoffs)
+    if work.shard is not None:
+        print_shard(work.shard, tally['selected'], tally['listed'], len(set(failures)))
+    sys.exit(1 if failures else 0)
 
 
 if __name__ == '__main__':
@@ -1,7 +1,14 @@
+import collections
 import os
 import re
+import sys
 
-from github_macros.cli._base import MyParser, create_client
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from github_macros.cli._base import MyParser, add_transport_args, create_client, print_stats, transport_options
+from github_macros.downloads import asset_path, fetch
+from github_macros.policy import glob_matcher
+from github_macros.reporting import add_format_args, configure as configure_output, emit
 from github_macros import __version__
 
 
@@ -17,8 +24,9 @@ def get_args():
 
     p.add_argument('--github-user', dest='gh_user',
                    action='store', default=os.getenv('GITHUB_USER'))
-    p.add_argument('--github-token', dest='gh_token',
-                   action='store', default=os.getenv('GITHUB_TOKEN'))
+    p.add_argument('--github-token', dest='gh_token', action='append', default=[],
+                   help='API token, given more than once to rotate between a pool of them '
+                        '(defaults to GITHUB_TOKENS or GITHUB_TOKEN)')
 
     p.add_argument('--prefix', dest='pfx', action='store', default='v',
                    help='Version prefix applied to semver tags')
@@ -27,10 +35,47 @@ def get_args():
 
     p.add_argument('--latest', dest='latest', action='store_true', default=False,
                    help='Grab only the latest release')
+    p.add_argument('--asset', dest='assets', action='append', default=[], metavar='GLOB',
+                   help='Only the assets with names matching this glob (allows multiple invocations of --asset)')
+
+    p.add_argument('--jobs', '-j', dest='jobs', action='store', type=int, default=8,
+                   help='Repositories to look up, and assets to download, at the same time (default: 8)')
+
+    download = p.add_argument_group('Downloading', 'Fetch the assets rather than listing them')
+    download.add_argument('--download', dest='download', action='store', default=None, metavar='DIR',
+                          help='Download each asset to DIR/TAG/NAME (DIR/OWNER/REPO/TAG/NAME for several repositories), '
+                               'skipping those already there and unchanged, and resuming those left unfinished')
+
+    p.add_argument('repos', metavar='REPO', action='store', nargs='*',
+                   help='The target repositories for which to find the latest version (e.g., "postmodern/chruby"), '
+                        'or "-" to read them from stdin, one per line')
+    p.add_argument('--repos-file', '-f', dest='repos_file', action='store', default=None, metavar='FILE',
+                   help='Also look up the repositories listed in FILE, one per line')
+
+    add_transport_args(p)
+    add_format_args(p)
+
+    opts = p.parse_args()
+    if not (opts.repos or opts.repos_file):
+        p.error('at least one REPO, or --repos-file, is required')
+    return opts
+
 
-    p.add_argument('repo', metavar='REPO', action='store', help='The target repository for which to find the latest version (e.g., "postmodern/chruby")')
+def read_names(lines):
+    """
+    Repository names, one per line, leaving out blank lines and "#" comments
+    """
+    return [line for line in (line.split('#', 1)[0].strip() for line in lines) if line]
 
-    return p.parse_args()
+
+def read_repositories(opts):
+    names = []
+    for spec in opts.repos:
+        names += read_names(sys.stdin) if spec == '-' else [spec]
+    if opts.repos_file:
+        with open(opts.repos_file) as f:
+            names += read_names(f)
+    return list(collections.OrderedDict.fromkeys(names))
 
 
 def get_releases(repo, client, pattern=r'^v\d+\.\d+\.\d+'):
@@ -61,30 +106,92 @@ def get_releases(repo, client, pattern=r'^v\d+\.\d+\.\d+'):
     )
 
 
-def show_release_info(release, client):
+def get_assets(release, client, covers=None):
+    """
+    param:: covers: Only keep assets whose names this matches
+    """
     response = client.get(release['assets_url'], params={'per_page': 999})
     response.raise_for_status()
-    assets = response.json()
+    return [asset for asset in response.json() if covers is None or covers(asset['name'])]
+
 
-    for asset in assets:
-        print('{tag}\t{name}\t{url}'.format(tag=release['tag_name'], name=asset['name'], url=asset['browser_download_url']))
+def get_wanted(repo, client, opts, pattern, covers=None):
+    """
+    The releases of a repository that are asked for, each with its assets
+    """
+    releases = get_releases(repo, client, pattern=pattern)
+    if opts.latest:
+        releases = releases[-1:]
+    return [(release, get_assets(release, client, covers)) for release in releases]
+
+
+def show_release_info(repo, release, asset, label=''):
+    emit('asset', '{label}{tag}\t{name}\t{url}'.format(label=label, tag=release['tag_name'], name=asset['name'],
+                                                         url=asset['browser_download_url']),
+         repository=repo, tag=release['tag_name'], name=asset['name'], url=asset['browser_download_url'],
+         size=asset.get('size'))
+
+
+def download_asset(repo, release, asset, client, directory, label=''):
+    """
+    Returns whether the asset is now in `directory`
+    """
+    try:
+        result = fetch(client, asset, asset_path(directory, release, asset))
+    except Exception as e:
+        emit('error', 'ERROR: {label}{tag}\t{name} => {error}'.format(label=label, tag=release['tag_name'], name=asset['name'],
+                                                                      error=e),
+             error=True, repository=repo, tag=release['tag_name'], name=asset['name'], message=str(e))
+        return False
+    emit('download', '{label}{tag}\t{name}\t{path}'.format(label=label, tag=release['tag_name'], name=asset['name'],
+                                                           path=result.path),
+         repository=repo, tag=release['tag_name'], name=asset['name'], path=result.path, size=result.size,
+         action=result.action, offset=result.offset or None)
+    return True
 
 
 def main():
     opts = get_args()
-    client = create_client(username=opts.gh_user, token=opts.gh_token)
+    configure_output(opts)
+    client = create_client(username=opts.gh_user, token=opts.gh_token, **transport_options(opts))
     if opts.version_pattern:
         version_pattern = opts.version_pattern
     else:
         version_pattern = '^{}'.format(opts.pfx) + r'\d+\.\d+\.\d+'
-
-    if opts.latest:
-        releases = get_releases(opts.repo, client, pattern=version_pattern)
-        if len(releases) > 0:
-            show_release_info(releases[-1], client)
-    else:
-        for release in get_releases(opts.repo, client, pattern=version_pattern):
-            show_release_info(release, client)
+    covers = glob_matcher(opts.assets) if opts.assets else None
+    repos = read_repositories(opts)
+    several = len(repos) > 1
+
+    failed = 0
+    downloads = []
+    # Every repository is looked up over the same pooled connections, and its assets reported (or
+    # queued for download) as soon as it's done, whatever order the rest finish in
+    with ThreadPoolExecutor(max_workers=max(1, opts.jobs)) as lookups, \
+            ThreadPoolExecutor(max_workers=max(1, opts.jobs)) as downloaders:
+        wanted = {lookups.submit(get_wanted, repo, client, opts, version_pattern, covers): repo for repo in repos}
+        for future in as_completed(wanted):
+            repo = wanted[future]
+            label = repo + '\t' if several else ''
+            try:
+                releases = future.result()
+            except Exception as e:
+                emit('error', 'ERROR: {repo} => {error}'.format(repo=repo, error=e), error=True, repository=repo,
+                     message=str(e))
+                failed += 1
+                continue
+
+            for release, assets in releases:
+                for asset in assets:
+                    if opts.download:
+                        directory = os.path.join(opts.download, repo) if several else opts.download
+                        downloads.append(downloaders.submit(download_asset, repo, release, asset, client, directory, label))
+                    else:
+                        show_release_info(repo, release, asset, label)
+        failed += sum(1 for future in downloads if not future.result())
+
+    print_stats(client)
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
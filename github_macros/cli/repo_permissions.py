@@ -1,67 +1,280 @@
+from __future__ import print_function
+import argparse
+import collections
+import json
 import os
+import sys
 
-from github_macros.cli._base import MyParser, create_client
+from concurrent.futures import ThreadPoolExecutor
+
+from github_macros.cli._base import MyParser, add_filter_args, add_journal_args, add_offline_args, add_shard_args, \
+    add_transport_args, check_filter_args, clients_from, listing_fields, open_journal, print_shard, print_stats, \
+    shard_from
+from github_macros.hosts import qualified_name
+from github_macros.inventory import permission_name
 from github_macros.models.github import GithubOrganization
+from github_macros.reporting import add_format_args, configure as configure_output, emit
 from github_macros import __version__
 
 
+# All a grant needs to know about each repository
+LISTING_FIELDS = ('name', 'owner', 'full_name', 'size')
+
+PERMISSIONS = {
+    'read': 'pull',
+    'write': 'push',
+    'admin': 'admin',
+}
+
+# OAuth scopes that granting a team access needs
+GRANT_SCOPES = ('admin:org',)
+
+Grant = collections.namedtuple('Grant', ('organization', 'team', 'permission'))
+
+
+def parse_grant(spec):
+    """
+    param:: spec: "ORG/TEAM" or "ORG/TEAM:PERMISSION" (permission defaults to write), with the
+                  organization given as "HOST:ORG" when it's on another GitHub host
+    """
+    org, _, target = spec.partition('/')
+    team, _, permission = target.partition(':')
+    permission = permission or 'write'
+    if not org.rpartition(':')[2] or not team or permission not in PERMISSIONS:
+        raise argparse.ArgumentTypeError('Invalid grant {!r}: expected [HOST:]ORG/TEAM[:{}]'.format(
+            spec, '|'.join(sorted(PERMISSIONS))))
+    return Grant(org, team, permission)
+
+
+def load_grants(path):
+    """
+    Reads a mapping file of organization => team slug => permission, e.g.::
+
+        {"acme": {"developers": "write", "operations": "admin"}, "acme-labs": {"developers": "read"}}
+    """
+    try:
+        with open(path) as f:
+            mapping = json.load(f)
+        return [parse_grant('{}/{}:{}'.format(org, team, permission))
+                for org, teams in sorted(mapping.items()) for team, permission in sorted(teams.items())]
+    except (IOError, OSError, ValueError, AttributeError) as e:
+        raise argparse.ArgumentTypeError('Invalid grants file {!r}: {}'.format(path, e))
+
+
 def get_args():
     p = MyParser()
     p.add_argument('--version', '-v', action='version',
                    help='Prints the program version and exits',
                    version='%(prog)s ' + __version__)
 
-    p.add_argument('--organization', '-o', dest='organization', action='store', default=None, required=True,
-                   help='GitHub organization whose repositories we will alter')
-    p.add_argument('--team', '-t', dest='team', action='store', default=None, required=True,
+    p.add_argument('--organization', '-o', dest='organization', action='store', default=None,
+                   help='GitHub organization whose repositories we will alter ([HOST:]ORG for other GitHub hosts)')
+    p.add_argument('--team', '-t', dest='team', action='store', default=None,
                    help='GitHub team slug (scoped to the given organization) for which to provide permissions')
     p.add_argument('--permission', '-p', dest='permission', action='store', default='write', choices=['read', 'write', 'admin'],
                    help='GitHub repository permissions to grant the given team')
+    p.add_argument('--grant', '-g', dest='grants', action='append', type=parse_grant, default=[], metavar='[HOST:]ORG/TEAM[:PERMISSION]',
+                   help='Grant a team (scoped to its organization) permissions to all of that organization\'s repositories '
+                        '(allows multiple invocations of --grant, permission defaults to write)')
+    p.add_argument('--grants-file', dest='grants_file', action='store', type=load_grants, default=[], metavar='FILE',
+                   help='JSON file mapping organization => team slug => permission, each granted as with --grant')
+    p.add_argument('--jobs', '-j', type=int, default=4,
+                   help='Permission changes to make at the same time, across all teams (default: 4)')
+    p.add_argument('--dry-run', dest='dry_run', action='store_true', default=False,
+                   help='Show which permissions would change (as DIFF: lines) without changing them')
 
     p.add_argument('--github-user', dest='gh_user', action='store', default=os.getenv('GITHUB_USER'))
-    p.add_argument('--github-token', dest='gh_token', action='store', default=os.getenv('GITHUB_TOKEN'))
+    p.add_argument('--github-token', dest='gh_token', action='append', default=[],
+                   help='API token, given more than once to rotate between a pool of them, as HOST=TOKEN for other '
+                        'GitHub hosts (defaults to GITHUB_TOKENS or GITHUB_TOKEN, and GITHUB_TOKEN_<HOST> for other hosts)')
 
-    return p.parse_args()
+    add_filter_args(p)
+    add_shard_args(p)
+    add_journal_args(p)
+    add_offline_args(p)
+    add_transport_args(p)
+    add_format_args(p)
 
+    opts = p.parse_args()
+    check_filter_args(p, opts)
+    if opts.offline and not opts.dry_run:
+        p.error('--offline needs --dry-run, a snapshot can\'t be changed')
+    if bool(opts.organization) != bool(opts.team):
+        p.error('--organization and --team must be given together')
+    opts.grants = ([Grant(opts.organization, opts.team, opts.permission)] if opts.organization else []) + \
+        opts.grants + opts.grants_file
+    if not opts.grants:
+        p.error('one of the arguments --organization/--team, --grant or --grants-file is required')
+    return opts
+
+
+def org_teams(client, org_name):
+    """
+    All of the organization's teams, by lowercase slug
+    """
+    return dict((team_info['slug'].lower(), team_info)
+                for team_info in client.paginate('/orgs/{org}/teams'.format(org=org_name)))
+
+
+def team_from_name(client, org_name, team, teams=None):
+    """
+    param:: teams: The organization's teams, as from `org_teams()`, if already fetched
+    """
+    if teams is None:
+        teams = org_teams(client, org_name)
+    if team.lower() in teams:
+        return teams[team.lower()]
+
+    raise LookupError('Team name {team} not found for organization {org}'.format(team=repr(team), org=repr(org_name)))
 
-def team_from_name(client, org_name, team):
-    resp = client.get('/orgs/{org}/teams'.format(org=org_name))
-    resp.raise_for_status()
-    out = resp.json()
-    for team_info in out:
-        if team_info['slug'].lower() != team.lower():
-            continue
-        return team_info
 
-    raise 'Team name {team} not found for organization {org}'.format(team=repr(team), org=repr(org_name))
+def grant(client, team, repo, perm, label, journal=None):
+    """
+    Gives the team the permission to one repository, returning whether it worked
+    """
+    resp = client.put(
+        '/teams/{team_id}/repos/{repo}'.format(repo=repo.full_name, team_id=team['id']),
+        json={
+            'permission': perm,
+        },
+        scopes=GRANT_SCOPES,
+    )
+    if resp.status_code >= 400:
+        emit('error', 'ERROR: {repo}{label} => {status} {reason}'.format(repo=qualified_name(repo), label=label, status=resp.status_code,
+                                                                         reason=resp.reason), error=True,
+             repository=qualified_name(repo), team=team['slug'], status=resp.status_code, message=resp.reason)
+        return False
+
+    # NOTE: Normally a status of 201 would indicate it was written to the server, but our GHE instance is buggy that way.
+    emit('repo', 'REPO: {repo}{label}'.format(repo=qualified_name(repo), label=label), repository=qualified_name(repo),
+         team=team['slug'], permission=perm)
+    if journal is not None:
+        journal.record('permit', '{team_id}:{repo}'.format(team_id=team['id'], repo=qualified_name(repo)), perm)
+    return True
+
+
+def preview(client, team, repo, perm, label):
+    """
+    Says whether granting the permission would change anything, returning whether it could tell
+    """
+    resp = client.get('/teams/{team_id}/repos/{repo}'.format(repo=repo.full_name, team_id=team['id']),
+                      headers={'Accept': 'application/vnd.github.v3.repository+json'})
+    if resp.status_code not in (200, 404):
+        emit('error', 'ERROR: {repo}{label} => {status} {reason}'.format(repo=qualified_name(repo), label=label, status=resp.status_code,
+                                                                         reason=resp.reason), error=True,
+             repository=qualified_name(repo), team=team['slug'], status=resp.status_code, message=resp.reason)
+        return False
+
+    current = permission_name(resp.json().get('permissions')) if resp.status_code == 200 else None
+    if current == perm:
+        emit('skip', 'SKIP: {repo}{label} (already {perm})'.format(repo=qualified_name(repo), label=label, perm=perm),
+             repository=qualified_name(repo), team=team['slug'], permission=perm, reason='unchanged')
+    else:
+        emit('diff', 'DIFF: {repo}{label} ({current} -> {perm})'.format(repo=qualified_name(repo), label=label,
+                                                                         current=current or 'none', perm=perm),
+             repository=qualified_name(repo), team=team['slug'], current=current, permission=perm)
+    return True
+
+
+def list_organization(clients, org_spec, org_grants, opts, fields):
+    """
+    The teams granted something in the organization, and its repositories
+
+    Returns (targets, repositories), targets being (team, API permission, label) for each grant
+    """
+    client, org_name = clients.resolve(org_spec)
+    # Each organization's teams and repositories are only listed once, however many teams are granted
+    teams = org_teams(client, org_name)
+    targets = []
+    for g in org_grants:
+        team = team_from_name(client, org_name, g.team, teams=teams)
+        emit('team', 'TEAM: @{org}/{team} ({_id})'.format(org=org_spec, team=g.team, _id=team['id']),
+             organization=org_spec, team=g.team, id=team['id'], permission=PERMISSIONS[g.permission])
+        # Only say who was granted what when there is more than one to tell apart
+        label = ' => @{org}/{team} ({permission})'.format(org=org_spec, team=g.team, permission=g.permission) \
+            if len(opts.grants) > 1 else ''
+        targets.append((team, PERMISSIONS[g.permission], label))
+
+    org = GithubOrganization(client, org_name)
+    if opts.where is not None:
+        return targets, list(opts.where.repositories(org, fields=fields))
+    return targets, list(org.iter_repositories(fields=fields))
 
 
 def main():
     opts = get_args()
-    client = create_client(username=opts.gh_user, token=opts.gh_token)
-    client.headers.update({'Accept': 'application/vnd.github.swamp-thing-preview+json'})
+    configure_output(opts)
+    clients = clients_from(opts)
 
-    perm = {
-        'read': 'pull',
-        'write': 'push',
-        'admin': 'admin',
-    }[opts.permission]
+    grants_by_org = collections.OrderedDict()
+    for g in opts.grants:
+        grants_by_org.setdefault(g.organization, []).append(g)
+    for org_spec in grants_by_org:
+        clients.resolve(org_spec)[0].headers.update({'Accept': 'application/vnd.github.swamp-thing-preview+json'})
 
-    org_name = opts.organization
-    assert org_name, 'Must provide a valid organization name in slug format'
-    team = team_from_name(client, org_name, opts.team)
-    assert team, 'Must provide a valid team name for the given organization'
-    print('TEAM: @{org}/{team} ({_id})'.format(org=org_name, team=opts.team, _id=team['id']))
+    fields = listing_fields(opts, LISTING_FIELDS)
+    shard = shard_from(opts)
+    # A dry run only reads the journal (when resuming), so don't start a new one over it
+    journal = open_journal(opts) if opts.resume or not opts.dry_run else None
+    # One pool of workers for every grant, so a team with few repositories doesn't leave it idle
+    workers = ThreadPoolExecutor(max_workers=max(1, opts.jobs))
+    pending = []
+    total_repositories = 0
+    selected_repositories = 0
 
-    org = GithubOrganization(client, org_name)
-    for repo in org.repositories:
-        resp = client.put(
-            '/teams/{team_id}/repos/{repo}'.format(repo=repo.full_name, team_id=team['id']),
-            json={
-                'permission': perm,
-            },
-        )
-        resp.raise_for_status()
-
-        # NOTE: Normally a status of 201 would indicate it was written to the server, but our GHE instance is buggy that way.
-        print('REPO: {repo}'.format(repo=repo.full_name))
+    # Every organization is listed at the same time, whichever host it's on
+    with ThreadPoolExecutor(max_workers=len(grants_by_org)) as listers:
+        listings = [(org_spec, listers.submit(list_organization, clients, org_spec, org_grants, opts, fields))
+                    for org_spec, org_grants in grants_by_org.items()]
+
+    failed = set([])
+    listed = []
+    for org_spec, listing in listings:
+        try:
+            targets, repositories = listing.result()
+        except Exception as e:
+            # The other organizations' grants still go ahead
+            emit('error', 'ERROR: {org} => {e}'.format(org=org_spec, e=e), error=True, organization=org_spec, message=str(e))
+            failed.add(org_spec)
+            continue
+        total_repositories += len(repositories)
+        listed.append((org_spec, targets, repositories))
+    if shard is not None:
+        # Shards are balanced over every organization's repositories together, not one at a time
+        shard.select([repo for _, _, repositories in listed for repo in repositories])
+
+    for org_spec, targets, repositories in listed:
+        client = clients.resolve(org_spec)[0]
+        if shard is not None:
+            repositories = [repo for repo in repositories if shard.contains(repo)]
+        selected_repositories += len(repositories)
+
+        for repo in repositories:
+            for team, perm, label in targets:
+                key = '{team_id}:{repo}'.format(team_id=team['id'], repo=qualified_name(repo))
+                if opts.resume and journal.done('permit', key, perm):
+                    emit('skip', 'SKIP: {repo}{label}'.format(repo=qualified_name(repo), label=label),
+                         repository=qualified_name(repo), team=team['slug'], permission=perm, reason='resumed')
+                    continue
+                if opts.dry_run:
+                    pending.append((repo, workers.submit(preview, client, team, repo, perm, label)))
+                else:
+                    pending.append((repo, workers.submit(grant, client, team, repo, perm, label, journal=journal)))
+
+    for repo, future in pending:
+        try:
+            if future.result():
+                continue
+        except Exception as e:
+            emit('error', 'ERROR: {repo} => {e}'.format(repo=qualified_name(repo), e=e), error=True,
+                 repository=qualified_name(repo), message=str(e))
+        failed.add(qualified_name(repo))
+    workers.shutdown()
+
+    if journal is not None:
+        journal.close()
+
+    print_stats(clients)
+    if shard is not None:
+        print_shard(shard, selected_repositories, total_repositories, len(failed))
+    sys.exit(1 if failed else 0)
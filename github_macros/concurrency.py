@@ -0,0 +1,153 @@
+"""
+Finding out how much concurrency the other end can take, rather than guessing a worker count.
+github.com happily serves far more parallel calls than a small GitHub Enterprise appliance,
+which answers too many with 502s and secondary rate limits.
+
+`AdaptiveLimit` caps how many calls are in flight at once, AIMD-style (as TCP does):
+
+  * starts at the most allowed, the concurrency there would be without it (or, given a lower
+    starting point, doubles every round trip of healthy calls until the first sign of trouble)
+  * halves on an overloaded call: one the other end pushed back on, with a 5xx or a rate limit
+    or abuse response (multiplicative decrease); calls that were already in flight when it halved
+    don't halve it again
+  * after that, grows back by one per round trip of healthy calls (additive increase)
+  * holds steady while calls take much longer than usual, as that's the first sign of a backlog
+    building up on the other end
+
+Worker pools keep their size (which becomes the most that can ever run at once); those beyond
+the current limit simply wait their turn. Until the other end pushes back, nothing waits.
+"""
+import contextlib
+import threading
+import time
+
+
+class Slot(object):
+    """
+    One call's turn; mark it overloaded when the other end pushed back
+    """
+
+    def __init__(self, epoch):
+        self.epoch = epoch
+        self.overloaded = False
+        self.started = time.time()
+
+
+class AdaptiveLimit(object):
+    """
+    param:: maximum: Most calls to ever have in flight (e.g., the worker pool or connection pool size)
+    param:: initial: Calls in flight to start with (default: the maximum)
+    param:: minimum: Fewest calls in flight it will back off to
+    param:: backoff: Fraction of the limit to keep on an overloaded call
+    param:: tolerance: How many times the usual latency a call can take before growth is held back
+    """
+
+    def __init__(self, maximum, initial=None, minimum=1, backoff=0.5, tolerance=2.0):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = float(min(self.maximum, max(self.minimum, initial or self.maximum)))
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.in_flight = 0
+        self.backoffs = 0
+        self.lowest = self.highest = self.limit
+        self.latency = None  # Moving average of healthy calls, in seconds
+        self._slow_start = True
+        self._epoch = 0  # Moves on with each decrease
+        self._cond = threading.Condition()
+
+    def __str__(self):
+        return '{limit} of {lowest}-{highest} (max {maximum}, {backoffs} backoffs)'.format(
+            limit=int(self.limit), lowest=int(self.lowest), highest=int(self.highest), maximum=self.maximum,
+            backoffs=self.backoffs)
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+            return Slot(self._epoch)
+
+    def release(self, slot, latency=None):
+        """
+        param:: latency: Seconds the call took, or None when it says nothing about the other end's
+                         health (e.g., git clones, which take as long as the repository is large)
+        """
+        with self._cond:
+            self.in_flight -= 1
+            if slot.overloaded:
+                if slot.epoch == self._epoch:
+                    self.limit = max(self.minimum, self.limit * self.backoff)
+                    self._epoch += 1
+                    self._slow_start = False
+                    self.backoffs += 1
+            elif self._healthy(latency):
+                # A round trip's worth of healthy calls adds the limit again in slow start, one otherwise
+                self.limit = min(self.maximum, self.limit + (1.0 if self._slow_start else 1.0 / self.limit))
+            else:
+                self._slow_start = False
+
+            self.lowest = min(self.lowest, self.limit)
+            self.highest = max(self.highest, self.limit)
+            self._cond.notify_all()
+
+    def _healthy(self, latency):
+        if latency is None:
+            return True
+        if self.latency is None:
+            self.latency = latency
+            return True
+        if latency > self.tolerance * self.latency:
+            return False
+        self.latency += 0.1 * (latency - self.latency)
+        return True
+
+    @contextlib.contextmanager
+    def slot(self, timed=True):
+        """
+        Waits for a turn, then holds it for the duration; an exception escaping the block doesn't
+        count as overloaded unless the slot was marked so
+
+        param:: timed: Whether the time taken tells anything about the other end's health
+        """
+        slot = self.acquire()
+        try:
+            yield slot
+        finally:
+            self.release(slot, (time.time() - slot.started) if timed else None)
+
+
+class SingleFlight(object):
+    """
+    Runs a call once for any number of callers asking for the same key at the same time
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        """
+        returns:: (result, whether it was shared from another caller's call)
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'done': threading.Event(), 'result': None, 'error': None}
+        if not leader:
+            call['done'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result'], True
+
+        try:
+            call['result'] = fn()
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['done'].set()
+        return call['result'], False
@@ -0,0 +1,149 @@
+"""
+Downloading release assets straight to disk, a chunk at a time, through the same authenticated
+session as the API calls (so private repositories work too).
+
+Each asset is written to "NAME.part" next to where it belongs, and only moved into place once
+its size (and digest, when GitHub knows it) checks out. Should a download break off, in this run
+or an earlier one, it picks up where it left off with a range request, rather than starting a
+multi-GB file over. Finished files get the asset's upload time, so a later run can tell they're
+unchanged without reading them again.
+"""
+import calendar
+import collections
+import contextlib
+import hashlib
+import os
+import time
+
+import requests
+
+CHUNK_SIZE = 1024 * 1024
+
+# What happened to an asset: "fetched", "resumed" (from `offset` bytes in) or "unchanged"
+Download = collections.namedtuple('Download', ('path', 'size', 'action', 'offset'))
+
+
+class DownloadError(Exception):
+    """
+    Raised when what was downloaded isn't the asset GitHub described
+    """
+
+
+def asset_path(directory, release, asset):
+    # Asset names are only unique within a release
+    return os.path.join(directory, release['tag_name'], os.path.basename(asset['name']))
+
+
+def uploaded_at(asset):
+    """
+    Epoch seconds the asset was last uploaded, if GitHub said
+    """
+    stamp = asset.get('updated_at') or asset.get('created_at')
+    if not stamp:
+        return None
+    return calendar.timegm(time.strptime(stamp, '%Y-%m-%dT%H:%M:%SZ'))
+
+
+def digest_of(asset):
+    """
+    A fresh hash object for the asset's digest (e.g., "sha256:..."), and the hex digest
+    expected of it, or (None, None) when GitHub didn't give one
+    """
+    algorithm, _, expected = (asset.get('digest') or '').partition(':')
+    if not expected or algorithm.lower() not in hashlib.algorithms_available:
+        return None, None
+    return hashlib.new(algorithm.lower()), expected.lower()
+
+
+def unchanged(path, asset):
+    if not os.path.isfile(path) or os.path.getsize(path) != asset['size']:
+        return False
+    stamp = uploaded_at(asset)
+    return stamp is None or int(os.path.getmtime(path)) == int(stamp)
+
+
+def _resume_offset(part, asset):
+    """
+    How much of an earlier attempt can be kept: none of it if the asset was uploaded again since
+    """
+    if not os.path.isfile(part):
+        return 0
+    stamp = uploaded_at(asset)
+    if stamp is not None and os.path.getmtime(part) < stamp:
+        return 0
+    offset = os.path.getsize(part)
+    return offset if offset <= asset['size'] else 0
+
+
+def _hash_file(hasher, path, chunk_size=CHUNK_SIZE):
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hasher.update(chunk)
+
+
+def fetch(client, asset, path, chunk_size=CHUNK_SIZE):
+    """
+    Downloads an asset to `path`, unless it's already there and unchanged
+
+    param:: client: The `GithubHttp` to download with
+    param:: asset: The asset, as listed by the API
+    param:: path: Where the asset goes, see `asset_path()`
+    param:: chunk_size: Bytes held in memory at a time
+    returns:: `Download`
+    """
+    if unchanged(path, asset):
+        return Download(path, asset['size'], 'unchanged', 0)
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory, exist_ok=True)
+
+    part = path + '.part'
+    size = asset['size']
+    hasher, expected = digest_of(asset)
+    offset = resumed = _resume_offset(part, asset)
+    if offset and hasher is not None:
+        _hash_file(hasher, part, chunk_size)
+
+    attempt = 0
+    while offset < size or not os.path.isfile(part):
+        # The API answers with a redirect to wherever the file is kept, and requests drops our
+        # credentials on the way there
+        headers = {'Accept': 'application/octet-stream', 'Accept-Encoding': 'identity'}
+        if offset:
+            headers['Range'] = 'bytes={}-'.format(offset)
+        try:
+            with contextlib.closing(client.get(asset['url'], headers=headers, stream=True)) as resp:
+                resp.raise_for_status()
+                if offset and resp.status_code != 206:
+                    # Ranges weren't honored, so this is the whole file again
+                    offset = resumed = 0
+                    hasher, expected = digest_of(asset)
+                with open(part, 'ab' if offset else 'wb') as out:
+                    for chunk in resp.iter_content(chunk_size):
+                        out.write(chunk)
+                        offset += len(chunk)
+                        if hasher is not None:
+                            hasher.update(chunk)
+            break
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                requests.exceptions.ChunkedEncodingError):
+            # Retried like any other call on the client, within the same budget for the whole run
+            if attempt >= client.max_retries or not client._take_retry():
+                client.count('failures')
+                raise
+            time.sleep(client._backoff_delay(attempt))
+            attempt += 1  # Keeping whatever made it to disk
+
+    if offset != size:
+        os.remove(part)
+        raise DownloadError('{name}: got {got} bytes, expected {size}'.format(name=asset['name'], got=offset, size=size))
+    if hasher is not None and hasher.hexdigest() != expected:
+        os.remove(part)
+        raise DownloadError('{name}: digest mismatch, expected {digest}'.format(name=asset['name'], digest=asset['digest']))
+
+    stamp = uploaded_at(asset)
+    if stamp is not None:
+        os.utime(part, (stamp, stamp))
+    os.replace(part, path)
+    return Download(path, size, 'resumed' if resumed else 'fetched', resumed)
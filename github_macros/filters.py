@@ -0,0 +1,350 @@
+"""
+A small expression language for choosing which repositories a command works on, e.g.::
+
+    not archived and not fork and pushed > 2026-01-01 and language in (Go, Python)
+
+Expressions are compiled once into a predicate over `GithubRepository` objects. Where part of an
+expression can be answered by the API itself (e.g., leaving out forks, or only recently pushed
+repositories), `Filter.repositories()` asks the API for less rather than fetching everything and
+throwing most of it away.
+
+Grammar::
+
+    expr       := and_expr ('or' and_expr)*
+    and_expr   := not_expr ('and' not_expr)*
+    not_expr   := 'not' not_expr | '(' expr ')' | comparison
+    comparison := FIELD
+                | FIELD ('=' | '==' | '!=' | '>' | '>=' | '<' | '<=' | '~') VALUE
+                | FIELD ['not'] 'in' '(' VALUE (',' VALUE)* ')'
+
+A bare FIELD is true when the field is set (e.g., `archived`). `~` matches shell-style globs
+(e.g., `name ~ "terraform-*"`). Text is compared case-insensitively, and dates may be written as
+`2026-01-01` or any ISO 8601 timestamp.
+"""
+import argparse
+import datetime
+import fnmatch
+import operator
+import re
+
+import dateutil.parser
+import dateutil.tz
+
+from github_macros.models.github import BaseGithubSerializer, GithubOrganization, GithubRepository
+
+# Friendlier names for fields of `GithubRepository`
+ALIASES = {
+    'pushed': 'pushed_at',
+    'created': 'created_at',
+    'updated': 'updated_at',
+    'repo': 'full_name',
+    'repository': 'full_name',
+}
+
+# What can be filtered on: the data GitHub sends for a repository, rather than whatever else the
+# model has (methods, or properties such as `branches` that would call the API for each repository)
+FIELDS = frozenset(GithubRepository.ALLOWED_MAPS + ['name', 'owner', 'created_at', 'updated_at', 'pushed_at'])
+
+KEYWORDS = ('and', 'or', 'not', 'in', 'true', 'false', 'null')
+
+COMPARISONS = {
+    '=': operator.eq,
+    '==': operator.eq,
+    '!=': operator.ne,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+}
+
+TOKEN = re.compile(r'''\s*(?:
+    (?P<string>"[^"]*"|'[^']*')
+  | (?P<symbol>==|!=|>=|<=|=|>|<|~|\(|\)|,)
+  | (?P<word>[^\s()=!<>~,'"]+)
+)''', re.VERBOSE)
+
+DATE_LIKE = re.compile(r'^\d{4}-\d{2}-\d{2}')
+
+
+class FilterError(ValueError):
+    pass
+
+
+def tokenize(text):
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        match = TOKEN.match(text, pos)
+        if not match or match.end() == pos:
+            raise FilterError('Unexpected {!r} at position {}'.format(text[pos:pos + 10], pos))
+        pos = match.end()
+        if match.group('string') is not None:
+            tokens.append(('string', match.group('string')[1:-1]))
+        elif match.group('symbol') is not None:
+            tokens.append(('symbol', match.group('symbol')))
+        elif match.group('word').lower() in KEYWORDS:
+            tokens.append(('keyword', match.group('word').lower()))
+        else:
+            tokens.append(('word', match.group('word')))
+    return tokens
+
+
+def literal(kind, text):
+    """
+    The python value of a literal in an expression
+    """
+    if kind == 'keyword':
+        return {'true': True, 'false': False, 'null': None}[text]
+    if kind == 'string':
+        return text
+    for cast in (int, float):
+        try:
+            return cast(text)
+        except ValueError:
+            pass
+    return text
+
+
+def as_datetime(value):
+    stamp = dateutil.parser.parse(value)
+    if stamp.tzinfo is None:
+        stamp = stamp.replace(tzinfo=dateutil.tz.tzutc())
+    return stamp
+
+
+def coerce(field_value, value):
+    """
+    Makes a literal comparable with the value of the field it is compared to
+    """
+    if isinstance(field_value, BaseGithubSerializer):
+        field_value = field_value.name
+    if isinstance(field_value, datetime.datetime) and isinstance(value, str):
+        if field_value.tzinfo is None:
+            field_value = field_value.replace(tzinfo=dateutil.tz.tzutc())
+        return field_value, as_datetime(value)
+    if isinstance(field_value, str) and value is not None:
+        return field_value.lower(), str(value).lower()
+    return field_value, value
+
+
+class Filter(object):
+    """
+    A compiled `--where` expression; call it with a repository to see if it matches
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self._tokens = tokenize(text)
+        self._pos = 0
+        # Top-level `and` terms, as (field, op, value), for pushing parts of the filter down to the API
+        self._conjuncts = []
+        # Every repository field the expression looks at
+        self.fields = set([])
+
+        if not self._tokens:
+            raise FilterError('Empty filter expression')
+        self._predicate = self._expr(top=True)
+        if self._pos < len(self._tokens):
+            raise FilterError('Unexpected {!r} after a complete expression'.format(self._tokens[self._pos][1]))
+
+    @classmethod
+    def compile(cls, text):
+        """
+        For use as an argparse `type=`
+        """
+        try:
+            return cls(text)
+        except FilterError as e:
+            raise argparse.ArgumentTypeError('Invalid filter {!r}: {}'.format(text, e))
+
+    def __call__(self, repo):
+        return bool(self._predicate(repo))
+
+    def __str__(self):
+        return self.text
+
+    # ======
+    # Parser
+    # ======
+
+    def _peek(self):
+        return self._tokens[self._pos] if self._pos < len(self._tokens) else (None, None)
+
+    def _next(self):
+        token = self._peek()
+        if token[0] is None:
+            raise FilterError('Unexpected end of expression')
+        self._pos += 1
+        return token
+
+    def _expect(self, kind, text):
+        token = self._next()
+        if token != (kind, text):
+            raise FilterError('Expected {!r} but found {!r}'.format(text, token[1]))
+
+    def _expr(self, top=False):
+        terms = [self._and(top=top)]
+        while self._peek() == ('keyword', 'or'):
+            self._next()
+            terms.append(self._and())
+        if len(terms) > 1:
+            # Nothing at the top level can be pushed down if any of it is optional
+            if top:
+                self._conjuncts = []
+            return lambda repo: any(term(repo) for term in terms)
+        return terms[0]
+
+    def _and(self, top=False):
+        terms = [self._not(top=top)]
+        while self._peek() == ('keyword', 'and'):
+            self._next()
+            terms.append(self._not(top=top))
+        if len(terms) > 1:
+            return lambda repo: all(term(repo) for term in terms)
+        return terms[0]
+
+    def _not(self, top=False):
+        if self._peek() == ('keyword', 'not'):
+            self._next()
+            start = len(self._conjuncts)
+            term = self._not(top=top)
+            if top and len(self._conjuncts) == start + 1 and self._conjuncts[-1][1] == 'truthy':
+                field, _, _ = self._conjuncts.pop()
+                self._conjuncts.append((field, 'falsy', None))
+            else:
+                del self._conjuncts[start:]
+            return lambda repo: not term(repo)
+        if self._peek() == ('symbol', '('):
+            self._next()
+            term = self._expr()
+            self._expect('symbol', ')')
+            return term
+        return self._comparison(top=top)
+
+    def _field(self):
+        kind, name = self._next()
+        if kind != 'word':
+            raise FilterError('Expected a field name but found {!r}'.format(name))
+        field = ALIASES.get(name.lower(), name.lower())
+        if field not in FIELDS:
+            raise FilterError('Unknown repository field {!r}'.format(name))
+        self.fields.add(field)
+        return field
+
+    def _value(self):
+        kind, text = self._next()
+        if kind not in ('word', 'string', 'keyword') or (kind == 'keyword' and text not in ('true', 'false', 'null')):
+            raise FilterError('Expected a value but found {!r}'.format(text))
+        return literal(kind, text)
+
+    def _values(self):
+        self._expect('symbol', '(')
+        values = [self._value()]
+        while self._peek() == ('symbol', ','):
+            self._next()
+            values.append(self._value())
+        self._expect('symbol', ')')
+        return values
+
+    def _comparison(self, top=False):
+        field = self._field()
+        kind, op = self._peek()
+
+        if (kind, op) == ('keyword', 'not') and self._tokens[self._pos + 1:self._pos + 2] == [('keyword', 'in')]:
+            self._pos += 2
+            values = self._values()
+            return lambda repo: not self._contains(getattr(repo, field, None), values)
+
+        if (kind, op) == ('keyword', 'in'):
+            self._next()
+            values = self._values()
+            return lambda repo: self._contains(getattr(repo, field, None), values)
+
+        if kind == 'symbol' and (op in COMPARISONS or op == '~'):
+            self._next()
+            value = self._value()
+            if top:
+                self._conjuncts.append((field, op, value))
+            if op == '~':
+                return lambda repo: self._glob(getattr(repo, field, None), value)
+            return lambda repo: self._compare(COMPARISONS[op], getattr(repo, field, None), value)
+
+        if top:
+            self._conjuncts.append((field, 'truthy', None))
+        return lambda repo: bool(getattr(repo, field, None))
+
+    @staticmethod
+    def _compare(op, field_value, value):
+        field_value, value = coerce(field_value, value)
+        if op not in (operator.eq, operator.ne) and (field_value is None or value is None):
+            return False
+        try:
+            return op(field_value, value)
+        except TypeError:
+            return False
+
+    @staticmethod
+    def _contains(field_value, values):
+        if isinstance(field_value, (list, tuple, set)):
+            # e.g., topics: any of them will do
+            return any(Filter._contains(item, values) for item in field_value)
+        return any(Filter._compare(operator.eq, field_value, value) for value in values)
+
+    @staticmethod
+    def _glob(field_value, pattern):
+        field_value, pattern = coerce(field_value, pattern)
+        return field_value is not None and fnmatch.fnmatchcase(str(field_value), str(pattern))
+
+    # ========
+    # Pushdown
+    # ========
+
+    def api_params(self, owner):
+        """
+        Query parameters for listing the owner's repositories that leave out (some of) what the
+        filter would throw away anyway. What comes back is still checked against the filter.
+        """
+        params = {}
+        conjuncts = dict((field, (op, value)) for field, op, value in self._conjuncts)
+
+        if isinstance(owner, GithubOrganization):
+            # `type` only takes one value, so go with the first one that applies
+            if conjuncts.get('fork') == ('falsy', None):
+                params['type'] = 'sources'
+            elif conjuncts.get('fork') == ('truthy', None):
+                params['type'] = 'forks'
+            elif conjuncts.get('private') == ('truthy', None):
+                params['type'] = 'private'
+            elif conjuncts.get('private') == ('falsy', None):
+                params['type'] = 'public'
+
+        if self.pushed_after is not None:
+            params.update({'sort': 'pushed', 'direction': 'desc'})
+
+        return params
+
+    @property
+    def pushed_after(self):
+        """
+        The earliest push time the filter accepts, if it insists on one
+        """
+        bounds = [as_datetime(value) for field, op, value in self._conjuncts
+                  if field == 'pushed_at' and op in ('>', '>=') and isinstance(value, str) and DATE_LIKE.match(value)]
+        return max(bounds) if bounds else None
+
+    def repositories(self, owner, fields=None):
+        """
+        Yields the owner's repositories that match, fetching as few as the API allows
+
+        param:: fields: As for `iter_repositories()`, to which the fields the filter needs are added
+        """
+        cutoff = self.pushed_after
+        if fields is not None:
+            fields = set(fields) | self.fields
+        for repo in owner.iter_repositories(params=self.api_params(owner), fields=fields):
+            if cutoff is not None and repo.pushed_at is not None and repo.pushed_at < cutoff:
+                # Listed most recently pushed first, so everything after this is older still
+                return
+            if self(repo):
+                yield repo
@@ -0,0 +1,298 @@
+"""
+Serving the mirror to git clients over smart HTTP, as a read-through cache of GitHub: CI
+runners clone and fetch from here (e.g., `git clone http://mirror:8080/acme/widget`) rather
+than each going to GitHub for the same objects.
+
+Repositories are found under the base directory laid out the way `gh-refresh` mirrors them
+(`OWNER/NAME`, or `HOST/OWNER/NAME` for other GitHub hosts), matching names without regard to
+case and with or without ".git". Before answering, a repository is brought up to date when:
+
+  * it isn't in the mirror yet (a miss)
+  * a client lists its refs and it was last fetched more than `max_age` seconds ago
+  * a client asks for objects it doesn't have (e.g., checking out a commit pushed a moment ago)
+
+Any number of clients missing the same repository at once wait on a single update. The rest is
+left to `git http-backend`. Only fetching is served: pushes are turned away.
+
+Mirrored repositories are ordinary clones, where fetching only moves `refs/remotes/origin/*`.
+What clients see is origin's branches and tags as of the last update, which are copied under a
+git namespace (see gitnamespaces(7)) of the repository for `git http-backend` to serve.
+"""
+import collections
+import gzip
+import os
+import re
+import shutil
+import socketserver
+import subprocess
+import tempfile
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import sh
+from sh.contrib import git
+
+from github_macros.concurrency import SingleFlight
+from github_macros.hosts import default_host, qualify
+from github_macros.submodules import mirror_path
+
+# e.g., "/acme/widget.git/info/refs" or "/ghe.example.com/platform/api/git-upload-pack", with
+# only the characters GitHub allows in host, owner and repository names
+GIT_PATH = re.compile(r'^/(?:(?P<host>[A-Za-z0-9-]+(?:\.[A-Za-z0-9-]+)+)/)?(?P<owner>[A-Za-z0-9_-]+)/'
+                      r'(?P<name>[A-Za-z0-9._-]+?)(?:\.git)?/(?P<rest>info/refs|git-upload-pack|git-receive-pack)$')
+UPLOAD_PACK = 'git-upload-pack'
+# Where origin's refs are copied to for serving, as refs/namespaces/<NAMESPACE>/refs/...
+NAMESPACE = 'mirror'
+
+
+def read_wants(body):
+    """
+    The object IDs an upload-pack request (protocol v0, v1 or v2) asks for, from its pkt-lines
+    """
+    wants = []
+    pos = 0
+    while pos + 4 <= len(body):
+        try:
+            length = int(body[pos:pos + 4], 16)
+        except ValueError:
+            break
+        if length < 4:  # flush, delimiter or response-end packet
+            pos += 4
+            continue
+        line = body[pos + 4:pos + length]
+        pos += length
+        if line.startswith(b'want '):
+            wants.append(line.split()[1].decode('ascii'))
+    return wants
+
+
+def missing(path, wants):
+    """
+    Which of the objects a client wants the repository at `path` doesn't have
+    """
+    if not wants:
+        return []
+    out = str(git('-C', path, 'cat-file', '--batch-check', _in='\n'.join(wants) + '\n'))
+    return [line.split()[0] for line in out.splitlines() if line.endswith(' missing')]
+
+
+def publish(path):
+    """
+    Copies origin's branches (as of the last fetch) and the tags of the repository at `path` to
+    where they're served from, with HEAD pointing at origin's default branch
+    """
+    prefix = 'refs/namespaces/{}/'.format(NAMESPACE)
+    git('-C', path, 'fetch', '--quiet', '--prune', '--no-write-fetch-head', '--no-auto-gc', '.',
+        '+refs/remotes/origin/*:{}refs/heads/*'.format(prefix), '^refs/remotes/origin/HEAD',
+        '+refs/tags/*:{}refs/tags/*'.format(prefix))
+    try:
+        head = str(git('-C', path, 'symbolic-ref', '--short', 'refs/remotes/origin/HEAD')).strip()
+    except sh.ErrorReturnCode:
+        return  # An empty repository has no branches to point at
+    git('-C', path, 'symbolic-ref', prefix + 'HEAD', '{}refs/heads/{}'.format(prefix, head[len('origin/'):]))
+
+
+def published(path):
+    """
+    Whether the repository at `path` has refs to serve (see `publish()`)
+    """
+    return os.path.exists(os.path.join(path, '.git', 'refs', 'namespaces', NAMESPACE))
+
+
+def fetched_at(path):
+    """
+    When the repository at `path` was last fetched into (0 if it never was, only cloned)
+    """
+    try:
+        return os.path.getmtime(os.path.join(path, '.git', 'FETCH_HEAD'))
+    except OSError:
+        return 0
+
+
+class GitHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.serve_git()
+
+    def do_POST(self):
+        self.serve_git()
+
+    def serve_git(self):
+        url = urlparse(self.path)
+        match = GIT_PATH.match(url.path)
+        if not match:
+            return self.reply(404, 'Not a repository')
+        rest = match.group('rest')
+        service = parse_qs(url.query).get('service', [None])[0] if rest == 'info/refs' else rest
+        if 'receive-pack' in (service or '') or 'receive-pack' in rest:
+            return self.reply(403, 'This is a read-only mirror, push to GitHub instead')
+        if service != UPLOAD_PACK or self.command != ('GET' if rest == 'info/refs' else 'POST'):
+            return self.reply(403, 'Only fetching over git\'s smart HTTP protocol is served')
+
+        body = self.read_body() if self.command == 'POST' else b''
+        host = (match.group('host') or default_host()).lower()
+        full_name = '{}/{}'.format(match.group('owner'), match.group('name'))
+        if match.group('name') in ('.', '..'):
+            return self.reply(404, 'Not a repository')
+        try:
+            path = self.server.checkout(host, full_name, wants=read_wants(body), advertising=rest == 'info/refs')
+        except Exception as e:
+            return self.reply(502, 'Unable to update {}: {}'.format(full_name, e))
+        if path is None:
+            return self.reply(404, 'Repository not found')
+        self.run_backend(path, rest, url.query, body)
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip() or b'0', 16)
+                if not size:
+                    while self.rfile.readline().strip():
+                        pass  # Trailers
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            body = b''.join(chunks)
+        else:
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        # git compresses large requests; http-backend is given them as they were meant to be read
+        if self.headers.get('Content-Encoding', '').lower() in ('gzip', 'x-gzip'):
+            body = gzip.decompress(body)
+        return body
+
+    def run_backend(self, path, rest, query, body):
+        env = dict(os.environ, GIT_PROJECT_ROOT=os.path.abspath(path), GIT_HTTP_EXPORT_ALL='1',
+                   PATH_INFO='/.git/' + rest, QUERY_STRING=query, REQUEST_METHOD=self.command,
+                   CONTENT_TYPE=self.headers.get('Content-Type', ''), CONTENT_LENGTH=str(len(body)),
+                   REMOTE_ADDR=self.client_address[0] if self.client_address else '',
+                   HTTP_GIT_PROTOCOL=self.headers.get('Git-Protocol', ''), GIT_NAMESPACE=NAMESPACE)
+        with tempfile.TemporaryFile() as request:
+            request.write(body)
+            request.seek(0)
+            backend = subprocess.Popen(['git', 'http-backend'], stdin=request, stdout=subprocess.PIPE,
+                                       stderr=subprocess.DEVNULL, env=env)
+        try:
+            status, headers = 200, []
+            for line in iter(backend.stdout.readline, b''):
+                line = line.decode('latin-1').rstrip('\r\n')
+                if not line:
+                    break
+                name, _, value = line.partition(':')
+                if name.lower() == 'status':
+                    status = int(value.split()[0])
+                else:
+                    headers.append((name, value.strip()))
+
+            # The length of what upload-pack sends isn't known up front, so the connection ends it
+            self.close_connection = True
+            self.send_response(status)
+            for name, value in headers:
+                self.send_header(name, value)
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            shutil.copyfileobj(backend.stdout, self.wfile)
+        finally:
+            backend.stdout.close()
+            backend.wait()
+
+    def reply(self, status, message):
+        body = message.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Quiet by default; updates are reported by whoever does them
+        pass
+
+
+class GitServer(socketserver.ThreadingMixIn, HTTPServer):
+    """
+    param:: address: (host, port) to listen on; port 0 picks a free one
+    param:: base: Directory the mirror is in
+    param:: refresh: Called with (host, "owner/name") to clone or update a repository, returning
+                     the directory it's in, or None when it isn't one being mirrored
+    param:: max_age: Seconds since a repository was last fetched before listing its refs
+                     updates it first (0 to always update)
+    param:: owners: Lowercased organizations and users (as [HOST:]NAME) whose repositories are
+                    served, whether or not they're already in the mirror (None for any)
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, base, refresh, max_age=60, owners=None):
+        HTTPServer.__init__(self, address, GitHandler)
+        self.base = os.path.realpath(base)
+        self.refresh = refresh
+        self.max_age = max_age
+        self.owners = owners
+        self.flights = SingleFlight()
+        self.stats = collections.Counter()
+        self._published = {}  # (host, lowercased name): as of when its refs were last published
+        self._lock = threading.Lock()
+
+    def checkout(self, host, full_name, wants=(), advertising=False):
+        """
+        Brings a repository up to date if it needs to be before it's served
+
+        param:: wants: Objects the client asked for
+        param:: advertising: Whether the client is listing refs (which are then to be no older than `max_age`)
+        returns:: The directory it's in, or None if it isn't mirrored
+        """
+        key = (host, full_name.lower())
+        with self._lock:
+            self.stats['requests'] += 1
+        if self.owners is not None and qualify(host, full_name.split('/')[0]).lower() not in self.owners:
+            return None
+        path = self.locate(host, full_name)
+        if path is None or self.stale(key, path, wants, advertising):
+            path, shared = self.flights.do(key, lambda: self._update(key, host, full_name))
+            if path is not None and not self.inside(path):
+                return None
+            if shared:
+                with self._lock:
+                    self.stats['coalesced'] += 1
+        elif not published(path) or fetched_at(path) > self._published.get(key, 0):
+            # Updated from GitHub (by a sweep or webhook) since it was last published
+            self.flights.do(key, lambda: self._publish(key, path))
+        return path
+
+    def locate(self, host, full_name):
+        """
+        Where the repository is in the mirror, if it is (and is inside it, following symlinks)
+        """
+        path = mirror_path(self.base, 'https://{}/{}'.format(host, full_name))
+        return path if path is not None and self.inside(path) else None
+
+    def inside(self, path):
+        return os.path.realpath(path).startswith(self.base + os.sep)
+
+    def stale(self, key, path, wants, advertising):
+        if wants:
+            try:
+                return bool(missing(path, wants))
+            except sh.ErrorReturnCode:
+                return True
+        if advertising:
+            last = max(self._published.get(key, 0), fetched_at(path))
+            return time.time() - last >= self.max_age
+        return False
+
+    def _update(self, key, host, full_name):
+        path = self.refresh(host, full_name)
+        if path is not None:
+            self._publish(key, path)
+            with self._lock:
+                self.stats['updates'] += 1
+        return path
+
+    def _publish(self, key, path):
+        started = time.time()
+        publish(path)
+        with self._lock:
+            self._published[key] = started
@@ -0,0 +1,104 @@
+"""
+Working with several GitHub hosts (github.com and any number of GitHub Enterprise instances) in
+one run. Organizations, users and repositories on any host but the default one (GITHUB_DOMAIN,
+or github.com) are named "HOST:NAME", e.g. "ghe.example.com:platform" or
+"ghe.example.com:platform/api".
+
+Every host gets its own client, and with it its own connection pool, credentials, rate limit
+and concurrency limit, so a slow Enterprise appliance can't hold up github.com (or the other
+way around).
+"""
+import os
+import re
+import threading
+
+
+def default_host():
+    domain = os.getenv('GITHUB_DOMAIN', 'github.com').lower()
+    return 'github.com' if domain == 'api.github.com' else domain
+
+
+def split_host(spec):
+    """
+    Splits "HOST:NAME" into (host, name), with the default host for a plain "NAME"
+    """
+    host, _, name = spec.rpartition(':')
+    return (host.lower() or default_host()), name
+
+
+def qualify(host, name):
+    """
+    The inverse of `split_host()`, leaving names on the default host as they are
+    """
+    if not host or host.lower() == default_host():
+        return name
+    return '{}:{}'.format(host.lower(), name)
+
+
+def host_of(model):
+    """
+    The host a model (repository, organization, ...) was read from
+    """
+    return getattr(model.http, 'domain', None) or default_host()
+
+
+def qualified_name(repo):
+    return qualify(host_of(repo), repo.full_name)
+
+
+def env_suffix(host):
+    """
+    What environment variables holding a host's settings end with, e.g. "GHE_EXAMPLE_COM"
+    """
+    return re.sub('[^A-Z0-9]', '_', host.upper())
+
+
+def split_tokens(tokens):
+    """
+    Sorts tokens given as "HOST=TOKEN" (or "HOST=USERNAME:TOKEN") by host, with the rest going
+    to the default host
+    """
+    by_host = {}
+    for spec in tokens or []:
+        host, sep, token = spec.partition('=')
+        if not sep:
+            host, token = default_host(), spec
+        by_host.setdefault(host.lower(), []).append(token)
+    return by_host
+
+
+class HostClients(object):
+    """
+    One client per host, each only created once something on that host is asked for
+
+    param:: factory: Called with a host name, returns its `GithubHttp`
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def get(self, host=None):
+        host = (host or default_host()).lower()
+        with self._lock:
+            if host not in self._clients:
+                self._clients[host] = self._factory(host)
+            return self._clients[host]
+
+    def resolve(self, spec):
+        """
+        The client for the host a "HOST:NAME" spec names, and the name on that host
+        """
+        host, name = split_host(spec)
+        return self.get(host), name
+
+    def __contains__(self, host):
+        return host.lower() in self._clients
+
+    def __len__(self):
+        return len(self._clients)
+
+    def items(self):
+        with self._lock:
+            return sorted(self._clients.items())
@@ -1,7 +1,184 @@
 from __future__ import print_function
+import collections
 import os
+import random
+import threading
+import time
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from github_macros import cassette
+from github_macros.concurrency import AdaptiveLimit
+from github_macros.proxy import UnixSocketAdapter
+
+
+class DeadlineExceeded(requests.exceptions.Timeout):
+    """
+    Raised when the overall per-run deadline given to `GithubHttp` has elapsed
+    """
+
+
+class GraphQLError(Exception):
+    """
+    Raised when a GraphQL query comes back with errors instead of (all of) its data
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        super(GraphQLError, self).__init__('; '.join(e.get('message', repr(e)) for e in errors))
+
+
+# Retrying these cannot cause a change to be applied twice
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+RETRY_STATUSES = (429, 502, 503, 504)
+# OAuth scopes that come with another, e.g. a token with "repo" can do what "public_repo" allows
+IMPLIED_SCOPES = {
+    'repo': ('repo:status', 'repo_deployment', 'public_repo', 'repo:invite', 'security_events'),
+    'admin:org': ('write:org', 'read:org'),
+    'write:org': ('read:org',),
+}
+
+
+def retry_after(resp):
+    """
+    Seconds the server asked us to wait before trying again, if it said so
+    """
+    if 'Retry-After' in resp.headers:
+        try:
+            return float(resp.headers['Retry-After'])
+        except ValueError:
+            return None
+    if resp.headers.get('X-RateLimit-Remaining') == '0' and 'X-RateLimit-Reset' in resp.headers:
+        return max(0.0, float(resp.headers['X-RateLimit-Reset']) - time.time())
+    return None
+
+
+def is_transient(resp):
+    """
+    Whether the response is a failure worth trying again (server hiccup or rate limiting)
+    """
+    if resp.status_code in RETRY_STATUSES:
+        return True
+    if resp.status_code == 403:
+        # Abuse detection (a.k.a. secondary rate limits) and exhausted primary rate limits
+        # both come back as 403, unlike a real lack of permissions
+        if 'Retry-After' in resp.headers or resp.headers.get('X-RateLimit-Remaining') == '0':
+            return True
+        body = resp.text.lower()
+        return 'abuse' in body or 'secondary rate limit' in body
+    return False
+
+
+class TokenAuth(requests.auth.AuthBase):
+    """
+    Bearer-style auth, as used by GitHub App installation tokens
+    """
+
+    def __init__(self, token):
+        self.token = token
+
+    def __call__(self, request):
+        request.headers['Authorization'] = 'token {}'.format(self.token)
+        return request
+
+
+class Credential(object):
+    """
+    A single API token, along with what GitHub last told us about its rate limit
+    """
+
+    def __init__(self, username, token):
+        self.username = username
+        self.token = token
+        self.remaining = None  # Unknown until the first response comes back
+        self.reset = None  # Epoch seconds
+        self.scopes = None  # set([]), unless the token type doesn't report them (e.g., app installation tokens)
+
+    @classmethod
+    def parse(cls, spec, username=None):
+        """
+        param:: spec: Either "TOKEN" or "USERNAME:TOKEN" (use "x-access-token:TOKEN" for
+                      GitHub App installation tokens)
+        param:: username: Username to use when the spec does not include one
+        """
+        if ':' in spec:
+            username, spec = spec.split(':', 1)
+        return cls(username, spec)
+
+    @property
+    def auth(self):
+        if not self.username or self.username == 'x-access-token':
+            return TokenAuth(self.token)
+        return (self.username, self.token)
+
+    @property
+    def budget(self):
+        if self.remaining is None:
+            return float('inf')
+        # A spent token stays spent until GitHub says otherwise: going by our own clock, which
+        # may run ahead of GitHub's, it could look fresh again before its window rolls over
+        return self.remaining
+
+    def can(self, scopes):
+        """
+        Whether the token has the OAuth scopes, as far as we know (tokens that don't report
+        theirs, or haven't been used yet, are given the benefit of the doubt)
+        """
+        if not scopes or self.scopes is None:
+            return True
+        return set(scopes).issubset(self.scopes)
+
+    def update(self, resp):
+        if 'X-RateLimit-Remaining' in resp.headers:
+            self.remaining = int(resp.headers['X-RateLimit-Remaining'])
+        if 'X-RateLimit-Reset' in resp.headers:
+            self.reset = float(resp.headers['X-RateLimit-Reset'])
+        if 'X-OAuth-Scopes' in resp.headers:
+            scopes = set(s.strip() for s in resp.headers['X-OAuth-Scopes'].split(',') if s.strip())
+            for scope in list(scopes):
+                scopes.update(IMPLIED_SCOPES.get(scope, ()))
+            self.scopes = scopes
+
+
+class TokenPool(object):
+    """
+    Spreads requests over several credentials, always choosing the one with the most rate limit
+    budget left among those with the scopes the call needs, so total throughput grows with the
+    number of tokens
+    """
+
+    def __init__(self, credentials):
+        self.credentials = list(credentials)
+        self.dropped = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.credentials)
+
+    def pick(self, scopes=None):
+        with self._lock:
+            if not self.credentials:
+                return None
+            # If none of them can, let GitHub say so rather than failing here
+            candidates = [c for c in self.credentials if c.can(scopes)] or self.credentials
+            # With every token spent, the one that resets soonest is the one to try
+            return max(candidates, key=lambda c: (c.budget, -(c.reset or 0)))
+
+    def has_budget(self, scopes=None):
+        with self._lock:
+            return any(c.budget > 0 for c in self.credentials if c.can(scopes))
+
+    def drop(self, credential):
+        """
+        Removes a credential that GitHub has rejected. Returns whether it was still in the pool.
+        """
+        with self._lock:
+            if credential not in self.credentials:
+                return False
+            self.credentials.remove(credential)
+            self.dropped.append(credential)
+            return True
 
 
 class GithubHttp(requests.Session):
@@ -9,18 +186,229 @@ class GithubHttp(requests.Session):
     Wrapper for a requests session object with our project-specific settings
     """
 
-    def __init__(self, username, token, *args, **kwargs):
+    def __init__(self, username, token, pool_size=10, connect_timeout=10.0, read_timeout=60.0,
+                 deadline=None, compression=True, keep_alive=True, max_retries=5, retry_budget=100,
+                 backoff=1.0, max_backoff=60.0, adaptive=True, domain=None, record=None, replay=None,
+                 replay_latency=False, proxy_socket=None, *args, **kwargs):
+        """
+        param:: username: Default username for tokens that don't name their own
+        param:: token: A single token, or a list of them to rotate between (see `Credential.parse`)
+        param:: pool_size: Max number of pooled connections per host (match this to concurrency)
+        param:: connect_timeout: Seconds to wait for a TCP connection to be established
+        param:: read_timeout: Seconds to wait between bytes received from the server
+        param:: deadline: Seconds from now after which no new requests will be sent
+        param:: compression: Whether to ask for gzip/deflate compressed response bodies
+        param:: keep_alive: Whether to reuse connections between requests
+        param:: max_retries: Max times a single request is re-sent after a transient failure
+        param:: retry_budget: Max retries across all requests made with this session
+        param:: backoff: Base number of seconds for the exponential backoff between retries
+        param:: max_backoff: Longest we will ever wait before a retry, even if asked to wait longer
+        param:: adaptive: Whether to back off from `pool_size` calls at once when the server
+                          pushes back (5xx, rate limits), see `AdaptiveLimit`
+        param:: domain: The GitHub host to talk to (defaults to GITHUB_DOMAIN, or github.com)
+        param:: record: Cassette file to record every call to (see `github_macros.cassette`)
+        param:: replay: Cassette file to answer every call from, instead of the network
+        param:: replay_latency: Whether replayed calls take as long as they did when recorded
+        param:: proxy_socket: Send every call through the `gh-proxy` listening on this Unix socket
+                              (see `github_macros.proxy`)
+        """
         super(GithubHttp, self).__init__(*args, **kwargs)
 
-        if os.getenv('GITHUB_DOMAIN', 'github.com') in ('api.github.com', 'github.com'):
+        self.domain = (domain or os.getenv('GITHUB_DOMAIN', 'github.com')).lower()
+        if self.domain in ('api.github.com', 'github.com'):
+            self.domain = 'github.com'
             self.base_uri = 'https://api.github.com'
+            self.graphql_uri = 'https://api.github.com/graphql'
         else:
-            self.base_uri = 'https://{domain}/api/v3'.format(domain=os.getenv('GITHUB_DOMAIN'))
-        self.auth = (username, token)
+            self.base_uri = 'https://{domain}/api/v3'.format(domain=self.domain)
+            self.graphql_uri = 'https://{domain}/api/graphql'.format(domain=self.domain)
+        if isinstance(token, (list, tuple)):
+            self.tokens = TokenPool(Credential.parse(t, username) for t in token)
+        else:
+            self.tokens = TokenPool([Credential.parse(token, username) if token else Credential(username, token)])
         self.headers.update({'Accept': 'application/vnd.github.loki-preview+json',
                              'Content-Type': 'application/json',
                              'User-Agent': 'David Alexander: "Too lazy... Just script it..."'})
 
+        self.timeout = (connect_timeout, read_timeout)
+        self.deadline = (time.time() + deadline) if deadline else None
+
+        self.headers['Accept-Encoding'] = 'gzip, deflate' if compression else 'identity'
+        self.headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+
+        # The default adapter only keeps 10 connections around, which any concurrent worker
+        # pool larger than that would exhaust (and then discard connections, re-doing TLS)
+        if replay:
+            adapter = cassette.ReplayAdapter(cassette.shared(replay), latency=replay_latency)
+        elif record:
+            adapter = cassette.RecordingAdapter(cassette.shared(record, recording=True), pool_connections=pool_size,
+                                                pool_maxsize=pool_size)
+        elif proxy_socket:
+            adapter = UnixSocketAdapter(proxy_socket, pool_connections=pool_size, pool_maxsize=pool_size)
+        else:
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+        self.max_retries = max_retries
+        self.retry_budget = retry_budget
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.concurrency = AdaptiveLimit(pool_size) if adaptive else None
+        self.stats = collections.Counter()
+        self._stats_lock = threading.Lock()
+
+    def count(self, stat, amount=1):
+        with self._stats_lock:
+            self.stats[stat] += amount
+
+    def _take_retry(self):
+        with self._stats_lock:
+            if self.stats['retries'] >= self.retry_budget:
+                return False
+            self.stats['retries'] += 1
+            return True
+
+    def _backoff_delay(self, attempt, resp=None):
+        # "Full jitter" exponential backoff, so concurrent workers don't retry in lock-step
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * (2 ** attempt)))
+        asked = retry_after(resp) if resp is not None else None
+        if asked is not None:
+            delay = max(delay, asked)
+        return delay
+
+    def _take_switch(self, switches, tokens):
+        """
+        Whether a call may be sent again on another token, having already switched `switches`
+        times in a pool of `tokens`. Switching counts against the retry budget like any retry.
+        """
+        return switches < tokens and self._take_retry()
+
+    def request(self, method, url, retry=None, scopes=None, **kwargs):
+        """
+        param:: retry: Whether to retry on transient failures. Defaults to retrying idempotent
+                       methods only, so a POST is never sent twice unless asked for.
+        param:: scopes: OAuth scopes the call needs, so it goes to a token that has them
+        """
+        if retry is None:
+            retry = method.upper() in IDEMPOTENT_METHODS
+
+        attempt = 0
+        switches = 0
+        tokens = len(self.tokens)
+        while True:
+            self.count('requests')
+            try:
+                resp = self._request_once(method, url, scopes, **kwargs)
+            except DeadlineExceeded:
+                raise
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if not retry or attempt >= self.max_retries or not self._take_retry():
+                    self.count('failures')
+                    raise
+                time.sleep(self._backoff_delay(attempt))
+                attempt += 1
+                continue
+
+            if resp.status_code == 401 and resp.credential is not None and len(self.tokens) > 1:
+                # Revoked or expired, so stop using it; replaying the call on another token is safe
+                # because the server never acted on it
+                if self.tokens.drop(resp.credential):
+                    self.count('dropped_tokens')
+                if not self._take_switch(switches, tokens):
+                    self.count('failures')
+                    return resp
+                switches += 1
+                resp.close()
+                continue
+
+            if not retry or not is_transient(resp) or attempt >= self.max_retries:
+                return resp
+
+            if resp.headers.get('X-RateLimit-Remaining') == '0' and self.tokens.has_budget(scopes) and \
+                    self._take_switch(switches, tokens):
+                # This token is spent, but another one is not: no need to wait for the reset
+                switches += 1
+                resp.close()
+                continue
+
+            delay = self._backoff_delay(attempt, resp)
+            if delay > self.max_backoff or not self._take_retry():
+                # e.g., the rate limit resets in 40 minutes, so let the caller see the failure
+                self.count('failures')
+                return resp
+
+            resp.close()
+            time.sleep(delay)
+            attempt += 1
+
+    def _request_once(self, method, url, scopes=None, **kwargs):
+        credential = None
+        if kwargs.get('auth') is None and self.auth is None:
+            credential = self.tokens.pick(scopes)
+            if credential is not None:
+                kwargs['auth'] = credential.auth
+
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+
+        if self.deadline is not None:
+            remaining = self.deadline - time.time()
+            if remaining <= 0:
+                raise DeadlineExceeded('Run deadline exceeded before {method} {url}'.format(method=method, url=url))
+            # Never let a single slow request run past the overall deadline
+            connect, read = kwargs['timeout'] if isinstance(kwargs['timeout'], tuple) else (kwargs['timeout'],) * 2
+            kwargs['timeout'] = (min(connect or remaining, remaining), min(read or remaining, remaining))
+
+        if self.concurrency is None:
+            resp = super(GithubHttp, self).request(method, url, **kwargs)
+        else:
+            # Only the server pushing back (5xx, rate limits) backs off; a dropped connection or
+            # a timeout could as well be the network on our side
+            with self.concurrency.slot() as slot:
+                resp = super(GithubHttp, self).request(method, url, **kwargs)
+                slot.overloaded = resp.status_code >= 500 or is_transient(resp)
+        resp.credential = credential
+        if credential is not None:
+            credential.update(resp)
+        return resp
+
+    def paginate(self, url, params=None, **kwargs):
+        """
+        Yields each item of a listing endpoint, following `Link: <...>; rel="next"` headers
+        one page at a time, so callers can start on the first page while the rest load.
+
+        A 404 on the first page is treated as an empty listing.
+        """
+        params = dict(params or {})
+        params.setdefault('per_page', 100)
+        first = True
+
+        while url:
+            resp = self.get(url, params=params, **kwargs)
+            if first and resp.status_code == 404:
+                return
+            resp.raise_for_status()
+            for item in resp.json():
+                yield item
+
+            # The next link already carries our query string
+            url = resp.links.get('next', {}).get('url')
+            params = None
+            first = False
+
+    def graphql(self, query, variables=None):
+        """
+        Runs a GraphQL query, returning its `data`. Queries only read, so they are retried like
+        any other read even though they are sent as a POST.
+        """
+        resp = self.post(self.graphql_uri, json={'query': query, 'variables': variables or {}}, retry=True)
+        resp.raise_for_status()
+        out = resp.json()
+        if out.get('errors'):
+            raise GraphQLError(out['errors'])
+        return out['data']
+
     def prepare_request(self, request, **kwargs):
         if request.url.startswith('/'):
             # Insert our github.com api string as the base
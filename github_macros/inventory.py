@@ -0,0 +1,346 @@
+"""
+Offline snapshots of what the other commands read from the API: repositories, their branches'
+protection and which teams can get at them. `gh-inventory` takes a snapshot once; `gh-protect`
+and `gh-permit --dry-run` can then be pointed at it (`--offline SNAPSHOT`) and answer without a
+single network call.
+
+A snapshot is gzip-compressed JSON with one table per kind of record. Tables are stored by
+column (a list of values per field) rather than by row, which keeps field names from being
+repeated in every record and compresses far better. Rows of one table refer to rows of another
+by position, e.g., each branch names its repository by index into the repositories table.
+
+Reading a snapshot goes through `SnapshotAdapter`, which answers the same REST calls the models
+make, so the commands work the same against a snapshot as against GitHub.
+"""
+import collections
+import datetime
+import gzip
+import json
+import os
+import re
+
+from urllib.parse import parse_qs, unquote, urlparse
+
+import requests
+from requests.adapters import BaseAdapter
+
+from github_macros.http import GithubHttp
+from github_macros.models.github import GithubOrganization
+
+FORMAT = 'github-macros-inventory'
+VERSION = 1
+
+# REST fields kept for each repository; "owner" and "owner_type" make up the `owner` object
+REPOSITORY_COLUMNS = ('full_name', 'owner', 'owner_type', 'html_url', 'ssh_url', 'description', 'homepage',
+                      'language', 'default_branch', 'size', 'fork', 'private', 'archived', 'disabled',
+                      'visibility', 'topics', 'created_at', 'updated_at', 'pushed_at')
+# Where each REST field lives on `GithubRepository`, when it is named differently
+REPOSITORY_ATTRIBUTES = {'html_url': 'url', 'ssh_url': 'clone_url'}
+
+TABLES = {
+    # `teams` says whether the organization's teams were captured too
+    'owners': ('login', 'type', 'teams'),
+    'repositories': REPOSITORY_COLUMNS,
+    # `summary` is the `protection` object from the branch listing, `protection` is the full
+    # document from `.../protection` (None when the branch isn't protected)
+    'branches': ('repository', 'name', 'protected', 'summary', 'protection'),
+    'teams': ('organization', 'id', 'slug', 'name'),
+    'team_repositories': ('team', 'repository', 'permission'),
+}
+
+
+class SnapshotMiss(LookupError):
+    """
+    Raised when something is asked of a snapshot that wasn't captured in it
+    """
+
+
+class Table(object):
+    def __init__(self, columns, data=None):
+        self.columns = collections.OrderedDict((name, list((data or {}).get(name, []))) for name in columns)
+
+    def append(self, **row):
+        for name, values in self.columns.items():
+            values.append(row.get(name))
+        return len(self) - 1
+
+    def __len__(self):
+        return len(next(iter(self.columns.values())))
+
+    def __getitem__(self, index):
+        return dict((name, values[index]) for name, values in self.columns.items())
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+
+def _stamp(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+
+def permission_name(permissions):
+    """
+    The highest of a REST `permissions` object, e.g. {"admin": false, "push": true, ...} => "push"
+    """
+    for name in ('admin', 'push', 'pull'):
+        if (permissions or {}).get(name):
+            return name
+    return None
+
+
+class Snapshot(object):
+    """
+    param:: domain: The GitHub domain the snapshot was taken of
+    """
+
+    def __init__(self, domain=None, created_at=None, tables=None):
+        self.domain = domain
+        self.created_at = created_at or datetime.datetime.utcnow().replace(microsecond=0).isoformat() + 'Z'
+        self.tables = dict((name, Table(columns, (tables or {}).get(name))) for name, columns in TABLES.items())
+        self._index()
+
+    def _index(self):
+        self._owners = dict((row['login'].lower(), row['type']) for row in self.tables['owners'])
+        self._with_teams = set(row['login'].lower() for row in self.tables['owners'] if row['teams'])
+        self._repositories = dict((name.lower(), index) for index, name in
+                                  enumerate(self.tables['repositories'].columns['full_name']))
+        self._branches = collections.defaultdict(list)
+        for index, repository in enumerate(self.tables['branches'].columns['repository']):
+            self._branches[repository].append(index)
+        self._teams = collections.defaultdict(list)
+        for index, org in enumerate(self.tables['teams'].columns['organization']):
+            self._teams[org.lower()].append(index)
+        self._team_ids = dict((team_id, index) for index, team_id in enumerate(self.tables['teams'].columns['id']))
+        self._grants = {}
+        for row in self.tables['team_repositories']:
+            self._grants[(row['team'], row['repository'])] = row['permission']
+
+    # =========
+    # Recording
+    # =========
+
+    def add_owner(self, login, owner_type, teams=False):
+        """
+        param:: teams: Whether the (organization's) teams are recorded as well
+        """
+        self.tables['owners'].append(login=login, type=owner_type, teams=teams)
+        self._owners[login.lower()] = owner_type
+        if teams:
+            self._with_teams.add(login.lower())
+
+    def add_repository(self, repo):
+        """
+        param:: repo: A `GithubRepository`; returns its row, for referring to it from other tables
+        """
+        row = dict((column, _stamp(getattr(repo, REPOSITORY_ATTRIBUTES.get(column, column), None)))
+                   for column in REPOSITORY_COLUMNS)
+        row['owner'] = repo.owner.name if repo.owner is not None else repo.full_name.split('/')[0]
+        row['owner_type'] = 'Organization' if isinstance(repo.owner, GithubOrganization) else 'User'
+        row['topics'] = list(repo.topics or [])
+        index = self.tables['repositories'].append(**row)
+        self._repositories[repo.full_name.lower()] = index
+        return index
+
+    def add_branch(self, repository, item, protection=None):
+        """
+        param:: repository: Row of the branch's repository
+        param:: item: The branch, as listed by `/repos/{repo}/branches`
+        param:: protection: The branch's `/protection` document, if it has one
+        """
+        index = self.tables['branches'].append(repository=repository, name=item['name'], protected=bool(item.get('protected')),
+                                               summary=item.get('protection'), protection=protection)
+        self._branches[repository].append(index)
+
+    def add_team(self, org, item):
+        index = self.tables['teams'].append(organization=org, id=item['id'], slug=item['slug'], name=item.get('name'))
+        self._teams[org.lower()].append(index)
+        self._team_ids[item['id']] = index
+        return index
+
+    def add_team_repository(self, team, repository, permission):
+        self.tables['team_repositories'].append(team=team, repository=repository, permission=permission)
+        self._grants[(team, repository)] = permission
+
+    # ===============
+    # Saving, loading
+    # ===============
+
+    def save(self, path):
+        """
+        Written to a temporary file first, so an interrupted run never leaves a torn snapshot
+        """
+        out = {
+            'format': FORMAT,
+            'version': VERSION,
+            'domain': self.domain,
+            'created_at': self.created_at,
+            'tables': dict((name, table.columns) for name, table in self.tables.items()),
+        }
+        partial = path + '.part'
+        with gzip.open(partial, 'wt') as f:
+            json.dump(out, f, separators=(',', ':'))
+        os.replace(partial, path)
+
+    @classmethod
+    def load(cls, path):
+        with gzip.open(path, 'rt') as f:
+            obj = json.load(f)
+        if obj.get('format') != FORMAT or obj.get('version') != VERSION:
+            raise ValueError('{} is not a version {} inventory snapshot'.format(path, VERSION))
+        return cls(domain=obj.get('domain'), created_at=obj.get('created_at'), tables=obj['tables'])
+
+    # =============================
+    # Answering API calls offline
+    # =============================
+
+    def repository(self, full_name):
+        if full_name.lower() not in self._repositories:
+            raise SnapshotMiss('Repository {} is not in the snapshot'.format(full_name))
+        return self._repositories[full_name.lower()]
+
+    def repository_payload(self, index):
+        row = self.tables['repositories'][index]
+        row['name'] = row['full_name'].split('/')[-1]
+        row['owner'] = {'login': row['owner'], 'type': row.pop('owner_type')}
+        return row
+
+    def owner_repositories(self, login, owner_type, params=None):
+        """
+        As listed by `/orgs/{org}/repos` or `/users/{user}/repos`, honoring `type` and `sort`
+        """
+        if self._owners.get(login.lower()) != owner_type:
+            raise SnapshotMiss('{} {} is not in the snapshot'.format(owner_type, login))
+        params = params or {}
+        repos = [self.repository_payload(index) for index, owner in
+                 enumerate(self.tables['repositories'].columns['owner']) if owner.lower() == login.lower()]
+
+        repo_type = params.get('type')
+        if repo_type in ('sources', 'forks'):
+            repos = [repo for repo in repos if bool(repo['fork']) == (repo_type == 'forks')]
+        elif repo_type in ('private', 'public'):
+            repos = [repo for repo in repos if bool(repo['private']) == (repo_type == 'private')]
+
+        sort = params.get('sort', 'full_name')
+        key = sort + '_at' if sort in ('created', 'updated', 'pushed') else 'full_name'
+        descending = params.get('direction', 'asc' if key == 'full_name' else 'desc') == 'desc'
+        present = [repo for repo in repos if repo[key] is not None]
+        present.sort(key=lambda repo: repo[key].lower() if key == 'full_name' else repo[key], reverse=descending)
+        # Never pushed to goes last, as it does on GitHub
+        return present + [repo for repo in repos if repo[key] is None]
+
+    def branches(self, full_name):
+        return [self.tables['branches'][index] for index in self._branches.get(self.repository(full_name), [])]
+
+    def branch(self, full_name, name):
+        for branch in self.branches(full_name):
+            if branch['name'] == name:
+                return branch
+        raise SnapshotMiss('Branch {} of {} is not in the snapshot'.format(name, full_name))
+
+    def teams(self, org):
+        if org.lower() not in self._with_teams:
+            raise SnapshotMiss('Teams of organization {} are not in the snapshot'.format(org))
+        return [self.tables['teams'][index] for index in self._teams.get(org.lower(), [])]
+
+    def team(self, team_id):
+        if team_id not in self._team_ids:
+            raise SnapshotMiss('Team {} is not in the snapshot'.format(team_id))
+        return self._team_ids[team_id]
+
+    def team_permission(self, team_id, full_name):
+        return self._grants.get((self.team(team_id), self.repository(full_name)))
+
+
+def _branch_payload(branch):
+    return {'name': branch['name'], 'protected': branch['protected'],
+            'protection': branch['summary'] if branch['summary'] is not None else {'enabled': branch['protected']}}
+
+
+class SnapshotAdapter(BaseAdapter):
+    """
+    Serves GET calls to the REST API from a `Snapshot`, and refuses to send anything anywhere
+    """
+
+    ROUTES = [
+        (re.compile(r'^/orgs/(?P<login>[^/]+)/repos$'),
+         lambda s, m, params: s.owner_repositories(m['login'], 'Organization', params)),
+        (re.compile(r'^/users/(?P<login>[^/]+)/repos$'),
+         lambda s, m, params: s.owner_repositories(m['login'], 'User', params)),
+        (re.compile(r'^/repos/(?P<repo>[^/]+/[^/]+)$'),
+         lambda s, m, params: s.repository_payload(s.repository(m['repo']))),
+        (re.compile(r'^/repos/(?P<repo>[^/]+/[^/]+)/branches$'),
+         lambda s, m, params: [_branch_payload(b) for b in s.branches(m['repo'])]),
+        (re.compile(r'^/repos/(?P<repo>[^/]+/[^/]+)/branches/(?P<branch>.+)/protection$'),
+         lambda s, m, params: s.branch(m['repo'], m['branch'])['protection']),
+        (re.compile(r'^/repos/(?P<repo>[^/]+/[^/]+)/branches/(?P<branch>.+)$'),
+         lambda s, m, params: _branch_payload(s.branch(m['repo'], m['branch']))),
+        (re.compile(r'^/orgs/(?P<org>[^/]+)/teams$'),
+         lambda s, m, params: [{'id': t['id'], 'slug': t['slug'], 'name': t['name']} for t in s.teams(m['org'])]),
+        (re.compile(r'^/teams/(?P<team>\d+)/repos/(?P<repo>[^/]+/[^/]+)$'),
+         lambda s, m, params: SnapshotAdapter._team_repository(s, int(m['team']), m['repo'])),
+    ]
+
+    def __init__(self, snapshot, base_uri):
+        super(SnapshotAdapter, self).__init__()
+        self.snapshot = snapshot
+        self.base_uri = base_uri
+
+    @staticmethod
+    def _team_repository(snapshot, team_id, full_name):
+        permission = snapshot.team_permission(team_id, full_name)
+        if permission is None:
+            return None  # The team has no access to it
+        levels = ('pull', 'push', 'admin')
+        payload = snapshot.repository_payload(snapshot.repository(full_name))
+        payload['permissions'] = dict((level, levels.index(level) <= levels.index(permission)) for level in levels)
+        return payload
+
+    def send(self, request, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            raise SnapshotMiss('Snapshots are read-only, refusing to {} {}'.format(request.method, request.url))
+        url = urlparse(request.url)
+        path = unquote(url.path)
+        base = urlparse(self.base_uri).path
+        if path.startswith(base):
+            path = path[len(base):]
+        params = dict((key, values[-1]) for key, values in parse_qs(url.query).items())
+
+        for pattern, answer in self.ROUTES:
+            match = pattern.match(path)
+            if match:
+                return self._response(request, answer(self.snapshot, match.groupdict(), params))
+        raise SnapshotMiss('{} is not in the snapshot'.format(path))
+
+    @staticmethod
+    def _response(request, payload):
+        resp = requests.Response()
+        resp.request = request
+        resp.url = request.url
+        resp.encoding = 'utf-8'
+        resp.headers['Content-Type'] = 'application/json'
+        if payload is None:
+            resp.status_code, resp.reason = 404, 'Not Found'
+            payload = {'message': 'Not Found'}
+        else:
+            resp.status_code, resp.reason = 200, 'OK'
+        resp._content = json.dumps(payload).encode('utf-8')
+        return resp
+
+    def close(self):
+        pass
+
+
+def offline_client(path):
+    """
+    A `GithubHttp` reading everything from the snapshot at `path`, never from the network
+    """
+    snapshot = Snapshot.load(path)
+    client = GithubHttp(username=None, token=None, max_retries=0, adaptive=False, domain=snapshot.domain)
+    adapter = SnapshotAdapter(snapshot, client.base_uri)
+    client.mount('https://', adapter)
+    client.mount('http://', adapter)
+    client.snapshot = snapshot
+    return client
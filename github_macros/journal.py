@@ -0,0 +1,93 @@
+"""
+An append-only record of finished per-repository operations, so a long sweep that dies part
+way through can pick up where it left off instead of starting over.
+
+Each line is a JSON object: `{"op": ..., "key": ..., "fingerprint": ..., "at": ...}` plus any
+extra details the operation wants to keep. The fingerprint describes the inputs of the operation
+(e.g., when the repository was last pushed to), so an item is only skipped on resume if nothing
+it depends on has changed since.
+"""
+import json
+import os
+import threading
+import time
+
+
+class Journal(object):
+    """
+    param:: path: File to append to
+    param:: resume: Whether to honor what is already in the file (otherwise it is started afresh)
+    param:: sync_every: Records to buffer before forcing them to disk
+    param:: sync_interval: Seconds to buffer records before forcing them to disk
+
+    Writes are flushed and fsync'd in batches, so journaling costs one disk sync per batch rather
+    than one per operation. A crash loses at most the last batch, which is simply redone.
+    """
+
+    def __init__(self, path, resume=True, sync_every=100, sync_interval=1.0):
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self._finished = {}
+        self._lock = threading.Lock()
+        self._unsynced = 0
+        self._last_sync = time.time()
+
+        if resume and os.path.exists(path):
+            self._load()
+        self._file = open(path, 'a' if resume else 'w')
+        if resume and self._file.tell() > 0 and not self._ends_with_newline():
+            self._file.write('\n')  # Keep the next record off the line of a torn write
+
+    def _ends_with_newline(self):
+        with open(self.path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b'\n'
+
+    def _load(self):
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # A torn write from a crash, that item will just be redone
+                self._finished[(record['op'], record['key'])] = record
+
+    def get(self, op, key):
+        with self._lock:
+            return self._finished.get((op, key))
+
+    def done(self, op, key, fingerprint):
+        """
+        Whether the operation has already been finished with these same inputs
+        """
+        record = self.get(op, key)
+        return record is not None and record.get('fingerprint') == fingerprint
+
+    def record(self, op, key, fingerprint, **details):
+        record = dict(details, op=op, key=key, fingerprint=fingerprint, at=round(time.time(), 3))
+        with self._lock:
+            self._finished[(op, key)] = record
+            self._file.write(json.dumps(record, sort_keys=True) + '\n')
+            self._unsynced += 1
+            if self._unsynced >= self.sync_every or time.time() - self._last_sync >= self.sync_interval:
+                self._sync()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.time()
+
+    def close(self):
+        with self._lock:
+            if self._file.closed:
+                return
+            self._sync()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,219 @@
+"""
+Keeping mirrored repositories fast to fetch from, month after month. Every `git fetch` leaves
+another pack (and maybe loose objects) behind, and git gets slower the more of them it has to
+look through. After each update, a repository is checked against a few thresholds and, only if
+it needs it, tidied up incrementally, much like `git maintenance run --auto` would:
+
+  * loose-objects: packs up loose objects and drops those already in a pack
+  * incremental-repack: rolls the smaller packs into one through the multi-pack-index,
+    leaving the largest pack alone so the work stays proportional to what was fetched lately
+  * multi-pack-index: one index over all the packs, so lookups don't try each pack in turn
+  * commit-graph: speeds up walking history (`rev-parse`, merge bases, fetch negotiation)
+
+All of it runs at the lowest CPU priority, on its own small pool of workers, so it only uses
+what the clones and updates leave over.
+"""
+import collections
+import contextlib
+import glob
+import os
+import queue
+import threading
+
+from sh.contrib import git as git_cmd
+
+# As reported by `git count-objects -v`
+ObjectCounts = collections.namedtuple('ObjectCounts', ('loose', 'loose_kb', 'packs', 'garbage'))
+
+
+def lower_priority():
+    """
+    Run in each maintenance git process before it starts, so it yields to everything else
+    """
+    try:
+        os.nice(19)
+    except OSError:
+        pass
+
+
+def git(path, *args, **kwargs):
+    return git_cmd('-C', path, *args, _preexec_fn=lower_priority, **kwargs)
+
+
+def objects_dir(path):
+    git_dir = os.path.join(path, '.git')
+    return os.path.join(git_dir if os.path.isdir(git_dir) else path, 'objects')
+
+
+def count_objects(path):
+    counts = {}
+    for line in str(git(path, 'count-objects', '-v')).splitlines():
+        key, _, value = line.partition(':')
+        try:
+            counts[key.strip()] = int(value.strip())
+        except ValueError:
+            pass
+    return ObjectCounts(loose=counts.get('count', 0), loose_kb=counts.get('size', 0), packs=counts.get('packs', 0),
+                        garbage=counts.get('garbage', 0))
+
+
+def _mtime(*paths):
+    times = [os.path.getmtime(p) for p in paths if os.path.exists(p)]
+    return max(times) if times else None
+
+
+def plan(path, counts, max_packs=10, max_loose=100, max_loose_kb=50 * 1024):
+    """
+    The maintenance tasks the repository is due for, in the order to run them (none at all if it
+    is in good shape)
+    """
+    objects = objects_dir(path)
+    tasks = []
+    # A few large blobs are worth packing as much as many small objects
+    if counts.loose >= max_loose or (max_loose_kb and counts.loose_kb >= max_loose_kb):
+        tasks.append('loose-objects')
+    if counts.packs >= max_packs:
+        tasks.append('incremental-repack')
+
+    newest_pack = _mtime(*glob.glob(os.path.join(objects, 'pack', '*.pack')))
+    if newest_pack is None:
+        return tasks
+
+    midx = _mtime(os.path.join(objects, 'pack', 'multi-pack-index'))
+    if 'incremental-repack' not in tasks and counts.packs > 1 and (midx is None or midx < newest_pack):
+        tasks.append('multi-pack-index')
+
+    graph = _mtime(os.path.join(objects, 'info', 'commit-graph'),
+                   os.path.join(objects, 'info', 'commit-graphs', 'commit-graph-chain'))
+    if tasks or graph is None or graph < newest_pack:
+        tasks.append('commit-graph')
+    return tasks
+
+
+def repack_batch_size(path):
+    """
+    Just over the second largest pack, so the largest is left alone (as `git maintenance` does)
+    """
+    sizes = sorted(os.path.getsize(p) for p in glob.glob(os.path.join(objects_dir(path), 'pack', '*.pack')))
+    return sizes[-2] + 1 if len(sizes) > 1 else 0
+
+
+def loose_objects(path):
+    objects = objects_dir(path)
+    for fanout in sorted(os.listdir(objects)):
+        if len(fanout) != 2 or not os.path.isdir(os.path.join(objects, fanout)):
+            continue
+        for name in os.listdir(os.path.join(objects, fanout)):
+            if len(name) >= 38 and not name.startswith('tmp_'):
+                yield fanout + name
+
+
+def run(path, task):
+    if task == 'loose-objects':
+        # Every loose object, reachable or not, goes in one pack (as `git maintenance` does), after
+        # dropping those that are already in one
+        git(path, 'prune-packed', '--quiet')
+        ids = '\n'.join(loose_objects(path))
+        if ids:
+            pack = os.path.abspath(os.path.join(objects_dir(path), 'pack', 'loose'))  # Not relative to -C
+            git(path, 'pack-objects', '--quiet', pack, _in=ids + '\n')
+            git(path, 'prune-packed', '--quiet')
+    elif task == 'incremental-repack':
+        # The packs rolled together last time go first, and those rolled together now only on the
+        # next run (as `git maintenance` does): clones and fetches being served from the repository
+        # (see `github_macros.git_server`) may still be reading them
+        git(path, 'multi-pack-index', 'write')
+        git(path, 'multi-pack-index', 'expire')
+        git(path, 'multi-pack-index', 'repack', '--batch-size={}'.format(repack_batch_size(path)))
+    elif task == 'multi-pack-index':
+        git(path, 'multi-pack-index', 'write')
+    elif task == 'commit-graph':
+        git(path, 'commit-graph', 'write', '--reachable', '--split')
+        # Left as it was when there were no new commits, but it's as current as the packs now
+        chain = os.path.join(objects_dir(path), 'info', 'commit-graphs', 'commit-graph-chain')
+        if os.path.exists(chain):
+            os.utime(chain)
+    else:
+        raise ValueError('Unknown maintenance task {}'.format(task))
+
+
+class Maintenance(object):
+    """
+    A low-priority queue of repositories to check over after they've been updated
+
+    param:: jobs: Repositories to tidy up at the same time
+    param:: max_packs: Packs a repository may have before they're rolled together
+    param:: max_loose: Loose objects a repository may have before they're packed
+    param:: max_loose_kb: Size the loose objects may add up to before they're packed (0 for no limit)
+    param:: report: Called with (path, tasks, counts) for each repository that was tidied up
+    param:: on_error: Called with (path, exception) when maintenance fails
+    """
+
+    def __init__(self, jobs=1, max_packs=10, max_loose=100, max_loose_kb=50 * 1024, report=None, on_error=None):
+        self.max_packs = max_packs
+        self.max_loose = max_loose
+        self.max_loose_kb = max_loose_kb
+        self.report = report
+        self.on_error = on_error
+        self._queue = queue.Queue()
+        self._pending = set([])
+        self._busy = collections.defaultdict(threading.Lock)
+        self._lock = threading.Lock()
+        self._workers = []
+        for _ in range(max(1, jobs)):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._workers.append(thread)
+
+    @contextlib.contextmanager
+    def locked(self, path):
+        """
+        Keeps maintenance and updates of the same repository from running at the same time
+        """
+        with self._lock:
+            lock = self._busy[path]
+        with lock:
+            yield
+
+    def put(self, path):
+        with self._lock:
+            if path in self._pending:
+                return False
+            self._pending.add(path)
+        self._queue.put(path)
+        return True
+
+    def _work(self):
+        while True:
+            path = self._queue.get()
+            try:
+                if path is None:
+                    return
+                with self._lock:
+                    self._pending.discard(path)
+                with self.locked(path):
+                    counts = count_objects(path)
+                    tasks = plan(path, counts, max_packs=self.max_packs, max_loose=self.max_loose,
+                                 max_loose_kb=self.max_loose_kb)
+                    for task in tasks:
+                        run(path, task)
+                if tasks and self.report is not None:
+                    self.report(path, tasks, counts)
+            except Exception as e:
+                if self.on_error is not None:
+                    self.on_error(path, e)
+            finally:
+                self._queue.task_done()
+
+    def join(self):
+        self._queue.join()
+
+    def close(self):
+        """
+        Finishes what is queued, then stops the workers
+        """
+        for _ in self._workers:
+            self._queue.put(None)
+        for thread in self._workers:
+            thread.join()
@@ -3,12 +3,20 @@ A read-only set of models in the active record pattern, reading from GitHub's AP
 and transforming it into a pythonic set of objects.
 """
 
+import collections
+import datetime
+
 from github_macros.common import cached_property
 
 import dateutil.parser
+import dateutil.tz
 
 
 def parse_iso8601(stamp):
+    if stamp is None:  # e.g., `pushed_at` of a repository nobody has pushed to
+        return None
+    if isinstance(stamp, (int, float)):  # Webhook `push` payloads use epoch seconds
+        return datetime.datetime.fromtimestamp(stamp, tz=dateutil.tz.tzutc())
     return dateutil.parser.parse(stamp)
 
 
@@ -17,6 +25,142 @@ def debug(msg):
     pass
 
 
+# The result of polling an events feed:
+#   events: new events, newest first
+#   etag: send back next time, to get a cheap 304 when nothing happened
+#   poll_interval: seconds GitHub asks us to wait before polling again
+#   complete: False when the feed ran out before reaching the last event we saw (some were missed)
+EventPoll = collections.namedtuple('EventPoll', ['events', 'etag', 'poll_interval', 'complete'])
+
+
+def poll_events(http, url, etag=None, since=None):
+    """
+    param:: url: An events feed, e.g. `/orgs/{org}/events`
+    param:: etag: ETag from the previous poll
+    param:: since: ID of the newest event from the previous poll (None to just find the latest)
+    """
+    resp = http.get(url, params={'per_page': 100}, headers={'If-None-Match': etag} if etag else {})
+    poll_interval = int(resp.headers.get('X-Poll-Interval', 60))
+    if resp.status_code == 304:
+        return EventPoll([], etag, poll_interval, True)
+    if resp.status_code == 404:
+        return EventPoll([], None, poll_interval, True)
+    resp.raise_for_status()
+    new_etag = resp.headers.get('ETag')
+
+    events = []
+    while True:
+        for event in resp.json():
+            if since is not None and int(event['id']) <= since:
+                return EventPoll(events, new_etag, poll_interval, True)
+            events.append(event)
+        if since is None:
+            # Nothing to catch up on, we only wanted to know where the feed is now
+            return EventPoll(events, new_etag, poll_interval, True)
+
+        next_url = resp.links.get('next', {}).get('url')
+        if not next_url:
+            # GitHub only keeps the latest few hundred events, and we've gone past them
+            return EventPoll(events, new_etag, poll_interval, False)
+        resp = http.get(next_url)
+        resp.raise_for_status()
+
+
+# Repository fields that can be fetched through GraphQL, by their REST API name:
+#   REST name => (GraphQL selection, function pulling the REST value out of a GraphQL node)
+GRAPHQL_REPOSITORY_FIELDS = {
+    'name': ('name', lambda node: node['name']),
+    'full_name': ('nameWithOwner', lambda node: node['nameWithOwner']),
+    'owner': ('owner { login __typename }', lambda node: {'login': node['owner']['login'],
+                                                          'type': node['owner']['__typename']}),
+    'description': ('description', lambda node: node['description']),
+    'homepage': ('homepageUrl', lambda node: node['homepageUrl']),
+    'html_url': ('url', lambda node: node['url']),
+    'clone_url': ('url', lambda node: node['url'] + '.git'),
+    'ssh_url': ('sshUrl', lambda node: node['sshUrl']),
+    'language': ('primaryLanguage { name }', lambda node: (node['primaryLanguage'] or {}).get('name')),
+    'default_branch': ('defaultBranchRef { name }', lambda node: (node['defaultBranchRef'] or {}).get('name')),
+    'size': ('diskUsage', lambda node: node['diskUsage']),
+    'fork': ('isFork', lambda node: node['isFork']),
+    'archived': ('isArchived', lambda node: node['isArchived']),
+    'disabled': ('isDisabled', lambda node: node['isDisabled']),
+    'private': ('isPrivate', lambda node: node['isPrivate']),
+    'visibility': ('visibility', lambda node: (node['visibility'] or '').lower() or None),
+    'topics': ('repositoryTopics(first: 100) { nodes { topic { name } } }',
+               lambda node: [t['topic']['name'] for t in node['repositoryTopics']['nodes']]),
+    'stars': ('stargazerCount', lambda node: node['stargazerCount']),
+    'forks': ('forkCount', lambda node: node['forkCount']),
+    'created_at': ('createdAt', lambda node: node['createdAt']),
+    'updated_at': ('updatedAt', lambda node: node['updatedAt']),
+    'pushed_at': ('pushedAt', lambda node: node['pushedAt']),
+}
+
+GRAPHQL_REPOSITORIES_QUERY = """
+query($login: String!, $cursor: String) {
+  repositoryOwner(login: $login) {
+    repositories(first: 100, after: $cursor, ownerAffiliations: [OWNER]%(arguments)s) {
+      pageInfo { hasNextPage endCursor }
+      nodes { %(selections)s }
+    }
+  }
+}
+"""
+
+
+def graphql_listing_arguments(params):
+    """
+    The GraphQL equivalent of the REST listing parameters that `iter_repositories()` takes
+    """
+    params = params or {}
+    arguments = []
+    repo_type = params.get('type')
+    if repo_type in ('sources', 'forks'):
+        arguments.append('isFork: {}'.format('false' if repo_type == 'sources' else 'true'))
+    elif repo_type in ('private', 'public'):
+        arguments.append('privacy: {}'.format(repo_type.upper()))
+
+    order = {'pushed': 'PUSHED_AT', 'created': 'CREATED_AT', 'updated': 'UPDATED_AT', 'full_name': 'NAME'}
+    if params.get('sort') in order:
+        arguments.append('orderBy: {{field: {field}, direction: {direction}}}'.format(
+            field=order[params['sort']], direction=params.get('direction', 'asc').upper()))
+
+    return ''.join(', ' + argument for argument in arguments)
+
+
+def iter_graphql_repositories(http, login, fields, params=None):
+    """
+    Lists an organization's or user's repositories through GraphQL, asking for only the fields
+    given (by their REST API names), 100 at a time. Far less to download and parse than the
+    REST listing, which always sends every field.
+    """
+    unknown = set(fields) - set(GRAPHQL_REPOSITORY_FIELDS)
+    if unknown:
+        raise ValueError('Unable to list repository fields through GraphQL: {}'.format(', '.join(sorted(unknown))))
+
+    # The model can't do without these
+    fields = sorted(set(fields) | set(['name', 'full_name', 'owner']))
+    selections = []
+    for field in fields:
+        if GRAPHQL_REPOSITORY_FIELDS[field][0] not in selections:
+            selections.append(GRAPHQL_REPOSITORY_FIELDS[field][0])
+    query = GRAPHQL_REPOSITORIES_QUERY % {'arguments': graphql_listing_arguments(params),
+                                          'selections': ' '.join(selections)}
+
+    cursor = None
+    while True:
+        data = http.graphql(query, {'login': login, 'cursor': cursor})
+        if data.get('repositoryOwner') is None:
+            return  # Same as a 404 from the REST API
+        connection = data['repositoryOwner']['repositories']
+        for node in connection['nodes']:
+            payload = dict((field, GRAPHQL_REPOSITORY_FIELDS[field][1](node)) for field in fields)
+            yield GithubRepository.deserialize(http, payload)
+
+        if not connection['pageInfo']['hasNextPage']:
+            return
+        cursor = connection['pageInfo']['endCursor']
+
+
 class BaseGithubSerializer(object):
     ALLOWED_MAPS = []  # To be overridden in subclasses
 
@@ -145,13 +289,31 @@ class GithubOrganization(BaseGithubSerializer):
 
     @cached_property
     def repositories(self):
-        resp = self.http.get('/orgs/{org}/repos'.format(org=self.name), params={'per_page': 999})
-        if resp.status_code == 404:
-            return []
-        resp.raise_for_status()
-        out = resp.json()
+        return list(self.iter_repositories())
 
-        return [GithubRepository.deserialize(self.http, repo) for repo in out]
+    def iter_repositories(self, params=None, fields=None):
+        """
+        Lazily walks every page of the organization's repositories, yielding each as soon as
+        its page arrives (unlike `repositories`, nothing is cached)
+
+        param:: params: Extra query parameters for the listing (e.g., `type`, `sort`)
+        param:: fields: Only fetch these fields (by REST API name), through GraphQL. Everything
+                        else is left unset on the models.
+        """
+        if fields is not None:
+            for repo in iter_graphql_repositories(self.http, self.name, fields, params=params):
+                yield repo
+            return
+
+        for repo in self.http.paginate('/orgs/{org}/repos'.format(org=self.name), params=params):
+            yield GithubRepository.deserialize(self.http, repo)
+
+    def poll_events(self, etag=None, since=None):
+        """
+        Events (pushes, new branches, etc.) across the organization since the event ID given.
+        See `EventPoll` for what comes back.
+        """
+        return poll_events(self.http, '/orgs/{org}/events'.format(org=self.name), etag=etag, since=since)
 
     @cached_property
     def members(self):
@@ -206,13 +368,31 @@ class GithubUser(BaseGithubSerializer):
 
     @cached_property
     def repositories(self):
-        resp = self.http.get('/users/{u}/repos'.format(u=self.name), params={'per_page': 999})
-        if resp.status_code == 404:
-            return []
-        resp.raise_for_status()
-        out = resp.json()
+        return list(self.iter_repositories())
 
-        return [GithubRepository.deserialize(self.http, repo) for repo in out]
+    def iter_repositories(self, params=None, fields=None):
+        """
+        Lazily walks every page of the user's repositories, yielding each as soon as its page
+        arrives (unlike `repositories`, nothing is cached)
+
+        param:: params: Extra query parameters for the listing (e.g., `type`, `sort`)
+        param:: fields: Only fetch these fields (by REST API name), through GraphQL. Everything
+                        else is left unset on the models.
+        """
+        if fields is not None:
+            for repo in iter_graphql_repositories(self.http, self.name, fields, params=params):
+                yield repo
+            return
+
+        for repo in self.http.paginate('/users/{u}/repos'.format(u=self.name), params=params):
+            yield GithubRepository.deserialize(self.http, repo)
+
+    def poll_events(self, etag=None, since=None):
+        """
+        Events (pushes, new branches, etc.) performed by the user since the event ID given.
+        See `EventPoll` for what comes back.
+        """
+        return poll_events(self.http, '/users/{u}/events'.format(u=self.name), etag=etag, since=since)
 
     def __str__(self):
         return 'Github User ({u})'.format(u=str(self.name))
@@ -222,7 +402,8 @@ class GithubRepository(BaseGithubSerializer):
     # 1-to-1 mappings between JSON and object attributes:
     ALLOWED_MAPS = ['homepage', 'language', 'watchers', 'default_branch', 'full_name',
                     'fork', 'forks', 'stars', 'issues', 'open_issues', 'description',
-                    'permissions']
+                    'permissions', 'size', 'private', 'archived', 'disabled', 'visibility',
+                    'topics']
 
     http = None
     name = None
@@ -234,12 +415,17 @@ class GithubRepository(BaseGithubSerializer):
     language = None
     url = None
     private = False
+    archived = False
+    disabled = False
+    visibility = None  # 'public', 'private' or 'internal'
+    topics = ()
     fork = False
     stars = 0
     watchers = 0
     forks = 0
     issues = 0
     open_issues = 0
+    size = 0  # Kilobytes, as reported by GitHub
     clone_url = None
     created_at = None  # Datetime
     updated_at = None  # Datetime
@@ -297,19 +483,16 @@ class GithubRepository(BaseGithubSerializer):
         return 'Github Repository ({o})'.format(o=str(self.full_name))
 
     def __hash__(self):
-        return hash(self.full_name)
+        # The same name can be taken on different GitHub hosts
+        return hash((getattr(self.http, 'domain', None), self.full_name))
 
     @cached_property
     def branches(self):
         if not self.full_name:
             raise Exception('Requires that the `full_name` attribute be set')
-        resp = self.http.get('/repos/{r}/branches'.format(r=self.full_name), params={'per_page': 999})
-        if resp.status_code == 404:
-            return []
-        resp.raise_for_status()
-        out = resp.json()
 
-        return [GithubBranch.deserialize(client=self.http, repository=self, obj=branch) for branch in out]
+        return [GithubBranch.deserialize(client=self.http, repository=self, obj=branch)
+                for branch in self.http.paginate('/repos/{r}/branches'.format(r=self.full_name))]
 
     # ========
     # Metadata
@@ -354,7 +537,7 @@ class GithubBranch(BaseGithubSerializer):
     name = None
 
     repository = None
-    protection = None  # GithubBranchProtection
+    _protection_props = None
 
     def __init__(self, client, name, repository=None, repository_name=None, **kwargs):
         if repository:
@@ -380,12 +563,21 @@ class GithubBranch(BaseGithubSerializer):
 
     def _set_props(self, **kwargs):
         if 'protection' in kwargs:
-            self.protection = GithubBranchProtection(self.http, self, **kwargs['protection'])
-        elif not self.protection:
-            self.protection = GithubBranchProtection(self.http, self)
+            self._protection_props = kwargs['protection']
+            # clear cache to re-build from the new data
+            if 'protection' in self.__dict__:
+                del self.__dict__['protection']
 
         super(GithubBranch, self)._set_props(**kwargs)
 
+    @cached_property
+    def protection(self):
+        """
+        Built (and its extra details fetched) only when asked for, so listing the branches of a
+        repository doesn't cost an extra API call for every branch
+        """
+        return GithubBranchProtection(self.http, self, **(self._protection_props or {}))
+
     @classmethod
     def fetch(cls, client, name, repository=None, repository_name=None):
         if not repository:
@@ -426,6 +618,7 @@ class GithubBranchProtection(BaseGithubSerializer):
     push_restrictions = False
     push_users = None  # []
     push_teams = None  # []
+    document = None  # The `/protection` JSON as GitHub sent it, settings we don't model included
 
     def __init__(self, client, branch, **kwargs):
         self.http = client
@@ -581,7 +774,8 @@ class GithubBranchProtection(BaseGithubSerializer):
             return
         resp.raise_for_status()
         out = resp.json()
-        self._set_props(**out)
+        self.document = out
+        self._set_props(**dict(out))
 
     def __hash__(self):
         if not self.branch.repository.full_name:
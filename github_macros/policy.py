@@ -0,0 +1,161 @@
+"""
+Branch protection policies: which rules apply to which repositories and branches, so a single
+sweep can check different rules for different groups of repositories. A policy file is JSON::
+
+    {
+      "policies": [
+        {
+          "name": "services",
+          "repositories": ["acme/svc-*", "acme/api"],
+          "branches": ["master", "release/*"],
+          "code-review": true,
+          "enforce-for-admins": true,
+          "ci-check": ["ci/jenkins"]
+        },
+        {
+          "name": "everything else",
+          "branches": ["master"],
+          "restrict-push": true
+        }
+      ]
+    }
+
+Rules are named after the `gh-protect` flags they stand in for (`code-review: false` is the same
+as `--no-code-review`), and anything left out isn't checked. Repository and branch names are
+shell-style globs; a policy without `repositories` covers every repository.
+"""
+import argparse
+import fnmatch
+import json
+import re
+
+# Policy key => (option name used by the rule checkers, whether it holds a list, transform)
+RULES = {
+    'ci_check': ('contexts', True, None),
+    'code_review': ('require_code_review', False, None),
+    'auto_dismiss_review': ('auto_dismiss_review', False, None),
+    'restrict_dismiss_review': ('restrict_dismiss_review', False, None),
+    'dismiss_user': ('dismiss_review_users', True, None),
+    'dismiss_team': ('dismiss_review_teams', True, None),
+    'enforce_for_admins': ('except_admins', False, lambda enforce: not enforce),
+    'branch_up_to_date': ('branch_up_to_date', False, None),
+    'restrict_push': ('restrict_push', False, None),
+    'push_user': ('allowed_push_users', True, None),
+    'push_team': ('allowed_push_teams', True, None),
+}
+
+
+class PolicyError(ValueError):
+    pass
+
+
+def glob_matcher(patterns, ignore_case=True):
+    """
+    One compiled regex matching any of the globs
+
+    param:: ignore_case: False for what git (rather than GitHub) names, e.g. branches, where
+                         "Release" and "release" are different branches
+    """
+    flags = re.IGNORECASE if ignore_case else 0
+    return re.compile('|'.join('(?:{})'.format(fnmatch.translate(p)) for p in patterns), flags).match
+
+
+class Policy(object):
+    """
+    param:: name: Shown alongside each error, None for the rules given on the command line
+    param:: repositories: Globs of repository full names (e.g., "acme/*") the policy covers
+    param:: branches: Globs of the branch names the policy covers
+    param:: options: Namespace of the rules, as parsed from the `gh-protect` flags
+    """
+
+    def __init__(self, name, repositories, branches, options):
+        if not branches:
+            raise PolicyError('Policy {!r} does not name any branches'.format(name))
+        self.name = name
+        self.repositories = list(repositories or ['*'])
+        self.branches = list(branches)
+        self.options = options
+        self.options.policy = name  # So errors can say which policy they break
+        self._covers_repository = glob_matcher(self.repositories)
+        self._covers_branch = glob_matcher(self.branches, ignore_case=False)
+
+    @classmethod
+    def from_dict(cls, obj, index=0):
+        obj = dict((key.replace('-', '_'), value) for key, value in obj.items())
+        name = obj.pop('name', None) or 'policy #{}'.format(index + 1)
+        repositories = obj.pop('repositories', None)
+        branches = obj.pop('branches', None)
+
+        options = argparse.Namespace(**dict((dest, [] if is_list else None) for dest, is_list, _ in RULES.values()))
+        for key, value in obj.items():
+            if key not in RULES:
+                raise PolicyError('Policy {!r} has an unknown rule {!r}'.format(name, key))
+            dest, is_list, transform = RULES[key]
+            if is_list:
+                value = [value] if isinstance(value, str) else list(value)
+            elif not isinstance(value, bool):
+                raise PolicyError('Policy {!r} expects true or false for {!r}'.format(name, key))
+            setattr(options, dest, transform(value) if transform else value)
+
+        for label, globs in (('repositories', repositories), ('branches', branches)):
+            if isinstance(globs, str):
+                raise PolicyError('Policy {!r} expects a list of {}'.format(name, label))
+        return cls(name, repositories, branches, options)
+
+    def covers_repository(self, repo):
+        return bool(self._covers_repository(repo.full_name))
+
+    def covers_branch(self, branch_name):
+        return bool(self._covers_branch(branch_name))
+
+    def describe(self):
+        """
+        Everything that goes into a verdict, for telling whether an earlier one still stands
+        """
+        return {'name': self.name, 'repositories': self.repositories, 'branches': self.branches,
+                'rules': dict((dest, getattr(self.options, dest)) for dest, _, _ in RULES.values())}
+
+
+class PolicySet(object):
+    """
+    Every policy checked in a run, so each repository and branch is fetched once no matter how
+    many of them apply to it
+    """
+
+    def __init__(self, policies):
+        self.policies = list(policies)
+        names = [policy.name for policy in self.policies]
+        if len(set(names)) != len(names):
+            raise PolicyError('Policy names must be unique')
+
+    @classmethod
+    def load(cls, path):
+        """
+        For use as an argparse `type=`
+        """
+        try:
+            with open(path) as f:
+                obj = json.load(f)
+            if isinstance(obj, dict):
+                obj = obj.get('policies')
+            if not isinstance(obj, list) or not obj:
+                raise PolicyError('Expected a list of policies')
+            return cls(Policy.from_dict(policy, index) for index, policy in enumerate(obj))
+        except (IOError, OSError, ValueError, AttributeError) as e:
+            raise argparse.ArgumentTypeError('Invalid policy file {!r}: {}'.format(path, e))
+
+    def __iter__(self):
+        return iter(self.policies)
+
+    def __len__(self):
+        return len(self.policies)
+
+    def for_repository(self, repo):
+        """
+        Policies covering the repository; when there are none, it needn't be looked at any further
+        """
+        return [policy for policy in self.policies if policy.covers_repository(repo)]
+
+    @staticmethod
+    def for_branch(policies, branch_name):
+        return [policy for policy in policies if policy.covers_branch(branch_name)]
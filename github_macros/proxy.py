@@ -0,0 +1,343 @@
+"""
+A local daemon (`gh-proxy`) for every `gh-*` process on a machine to send its API calls through,
+over a Unix socket, rather than each keeping its own connections, cache and idea of how much
+rate limit is left. Between them, the processes then share:
+
+  * connections: one pool per GitHub host, kept open across processes
+  * a response cache: a repeated read is revalidated with its ETag, and a 304 (which GitHub
+    doesn't count against the rate limit) is answered from the cache; with `max_age`, recent
+    enough responses aren't revalidated at all
+  * one rate limit budget per token: once GitHub says a token is spent, calls on it are held
+    back here (served stale from the cache where possible) until it resets, rather than each
+    process finding out for itself
+  * identical reads in flight: only the first goes to GitHub, the rest wait for its answer
+
+Clients only talk plain HTTP over the socket, naming the full URL they want (as they would to
+any forward proxy), with their own credentials. `GithubHttp` does so through
+`UnixSocketAdapter` when given a `proxy_socket` (GITHUB_PROXY_SOCKET).
+"""
+import collections
+import hashlib
+import os
+import socket
+import socketserver
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool
+
+from github_macros.concurrency import SingleFlight
+
+# Only mean something between a client and whoever it's directly talking to
+HOP_HEADERS = ('connection', 'keep-alive', 'proxy-authorization', 'proxy-connection', 'te', 'trailer',
+               'transfer-encoding', 'upgrade', 'host', 'content-length', 'accept-encoding')
+# Not to be passed back, as bodies are sent on decoded (and the daemon sends its own Date and Server)
+DROP_HEADERS = HOP_HEADERS + ('content-encoding', 'set-cookie', 'date', 'server')
+# Headers that make a read conditional or partial, which leaves it to the client
+CONDITIONAL_HEADERS = ('if-none-match', 'if-modified-since', 'range')
+RATE_LIMIT_HEADERS = ('X-RateLimit-Limit', 'X-RateLimit-Remaining', 'X-RateLimit-Reset', 'X-RateLimit-Used')
+
+CHUNK_SIZE = 64 * 1024
+
+
+class Reply(object):
+    """
+    A whole response, as sent (or to be sent again) to clients
+    """
+
+    def __init__(self, status, reason, headers, body, etag=None):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+        self.etag = etag
+        self.stored_at = time.time()
+
+    @property
+    def size(self):
+        return len(self.body)
+
+
+class Cache(object):
+    """
+    Least recently used responses, up to `max_bytes` of bodies
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._replies = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            reply = self._replies.get(key)
+            if reply is not None:
+                self._replies.move_to_end(key)
+            return reply
+
+    def put(self, key, reply):
+        if reply.size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._replies.pop(key, None)
+            if previous is not None:
+                self.size -= previous.size
+            self._replies[key] = reply
+            self.size += reply.size
+            while self.size > self.max_bytes:
+                _, evicted = self._replies.popitem(last=False)
+                self.size -= evicted.size
+
+    def __len__(self):
+        return len(self._replies)
+
+
+class Budget(object):
+    """
+    What GitHub last said about each token's rate limit, as seen by every process
+    """
+
+    def __init__(self):
+        self._limits = {}
+        self._lock = threading.Lock()
+
+    def update(self, credential, headers):
+        if 'X-RateLimit-Remaining' not in headers:
+            return
+        with self._lock:
+            self._limits[credential] = dict((name, headers[name]) for name in RATE_LIMIT_HEADERS if name in headers)
+
+    def headers(self, credential):
+        with self._lock:
+            return dict(self._limits.get(credential, {}))
+
+    def spent(self, credential):
+        """
+        Seconds until the token's rate limit resets, when it's used up, otherwise None
+        """
+        limits = self.headers(credential)
+        if limits.get('X-RateLimit-Remaining') != '0' or 'X-RateLimit-Reset' not in limits:
+            return None
+        wait = float(limits['X-RateLimit-Reset']) - time.time()
+        return wait if wait > 0 else None
+
+
+def credential_of(headers):
+    """
+    Stands in for the caller's token, without keeping the token itself around
+    """
+    return hashlib.sha256((headers.get('Authorization') or '').encode('utf-8')).hexdigest()
+
+
+class ProxyHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        try:
+            self.forward()
+        except requests.exceptions.RequestException as e:
+            # Passed on as a failure the client knows to retry
+            self.send_reply(Reply(502, 'Bad Gateway', {'Content-Type': 'text/plain'}, str(e).encode('utf-8')))
+
+    do_HEAD = do_POST = do_PUT = do_PATCH = do_DELETE = do_OPTIONS = do_GET
+
+    def forward(self):
+        proxy = self.server
+        url = urlparse(self.path)
+        if url.scheme not in ('https', 'http') or not url.netloc:
+            return self.send_reply(Reply(400, 'Bad Request', {'Content-Type': 'text/plain'},
+                                         b'Expected a full URL, as to a forward proxy'))
+
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else None
+        headers = dict((k, v) for k, v in self.headers.items() if k.lower() not in HOP_HEADERS)
+        credential = credential_of(self.headers)
+        proxy.count('requests')
+
+        conditional = any(name in (k.lower() for k in headers) for name in CONDITIONAL_HEADERS)
+        if self.command != 'GET' or body or conditional or 'octet-stream' in headers.get('Accept', ''):
+            # Changes, downloads and the client's own conditional reads go straight through
+            return self.relay(proxy.send(self.command, self.path, headers, body, credential, stream=True))
+
+        key = '{credential} {accept} {url}'.format(credential=credential, accept=headers.get('Accept'), url=self.path)
+        reply = proxy.cache.get(key)
+        if reply is not None and time.time() - reply.stored_at < proxy.max_age:
+            proxy.count('cached')
+            return self.send_reply(reply, proxy.budget.headers(credential))
+
+        wait = proxy.budget.spent(credential)
+        if wait is not None:
+            proxy.count('held')
+            if reply is not None:
+                return self.send_reply(reply, proxy.budget.headers(credential))
+            return self.send_reply(Reply(403, 'Forbidden', {'Content-Type': 'application/json', 'Retry-After': str(int(wait) + 1)},
+                                         b'{"message": "API rate limit exceeded (held back by gh-proxy)"}'),
+                                   proxy.budget.headers(credential))
+
+        def revalidate():
+            sent = dict(headers)
+            if reply is not None:
+                sent['If-None-Match'] = reply.etag
+            resp = proxy.send('GET', self.path, sent, None, credential)
+            if resp.status_code == 304 and reply is not None:
+                proxy.count('revalidated')
+                reply.stored_at = time.time()
+                return reply
+            fresh = Reply(resp.status_code, resp.reason, filtered(resp.headers), resp.content, resp.headers.get('ETag'))
+            if fresh.status == 200 and fresh.etag:
+                proxy.cache.put(key, fresh)
+            return fresh
+
+        answer, shared = proxy.flights.do(key, revalidate)
+        if shared:
+            proxy.count('coalesced')
+        self.send_reply(answer, proxy.budget.headers(credential))
+
+    def send_reply(self, reply, overrides=None):
+        self.send_response(reply.status, reply.reason)
+        headers = dict(reply.headers)
+        headers.update(overrides or {})
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(reply.size))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(reply.body)
+
+    def relay(self, resp):
+        """
+        Passes a response on as it arrives, however big, ending it by closing the connection
+        """
+        with resp:
+            self.send_response(resp.status_code, resp.reason)
+            for name, value in filtered(resp.headers).items():
+                self.send_header(name, value)
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.close_connection = True
+            if self.command != 'HEAD':
+                for chunk in resp.iter_content(CHUNK_SIZE):
+                    self.wfile.write(chunk)
+
+    def log_message(self, format, *args):
+        # Quiet by default; the stats say what went on
+        pass
+
+
+def filtered(headers):
+    return dict((k, v) for k, v in headers.items() if k.lower() not in DROP_HEADERS)
+
+
+class ProxyServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    param:: path: Unix socket to listen on (only the current user can connect)
+    param:: pool_size: Connections kept open to each GitHub host
+    param:: timeout: (connect, read) seconds for calls to GitHub
+    param:: max_age: Seconds a cached response is used without asking GitHub whether it changed
+    param:: cache_bytes: How much of the responses to keep in memory
+    """
+    daemon_threads = True
+
+    def __init__(self, path, pool_size=20, timeout=(10.0, 60.0), max_age=0, cache_bytes=256 * 1024 * 1024):
+        if os.path.exists(path):
+            _remove_stale_socket(path)
+        socketserver.UnixStreamServer.__init__(self, path, ProxyHandler)
+        os.chmod(path, 0o600)
+        self.path = path
+        self.timeout = timeout
+        self.max_age = max_age
+        self.cache = Cache(cache_bytes)
+        self.budget = Budget()
+        self.flights = SingleFlight()
+        self.stats = collections.Counter()
+        self._stats_lock = threading.Lock()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def count(self, stat, amount=1):
+        with self._stats_lock:
+            self.stats[stat] += amount
+
+    def send(self, method, url, headers, body, credential, stream=False):
+        self.count('upstream')
+        resp = self.session.request(method, url, headers=headers, data=body, stream=stream, allow_redirects=False,
+                                    timeout=self.timeout)
+        self.budget.update(credential, resp.headers)
+        return resp
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        self.session.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _remove_stale_socket(path):
+    """
+    Clears a socket left behind by a daemon that's gone, refusing to take over a running one
+    """
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        os.remove(path)
+        return
+    finally:
+        probe.close()
+    raise OSError('Another gh-proxy is already listening on {}'.format(path))
+
+
+# =============================
+# The client side
+# =============================
+
+class UnixSocketConnection(HTTPConnection):
+    def __init__(self, *args, **kwargs):
+        self.socket_path = kwargs.pop('socket_path')
+        super(UnixSocketConnection, self).__init__(*args, **kwargs)
+
+    def _new_conn(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if isinstance(self.timeout, (int, float)):
+            sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        return sock
+
+
+class UnixSocketConnectionPool(HTTPConnectionPool):
+    ConnectionCls = UnixSocketConnection
+
+
+class UnixSocketAdapter(HTTPAdapter):
+    """
+    Sends every request to the `gh-proxy` listening on `path`, whatever host it's for
+    """
+
+    def __init__(self, path, pool_connections=10, pool_maxsize=10, **kwargs):
+        super(UnixSocketAdapter, self).__init__(pool_connections=pool_connections, pool_maxsize=pool_maxsize, **kwargs)
+        self.path = path
+        self.pool = UnixSocketConnectionPool('localhost', maxsize=pool_maxsize, socket_path=path)
+
+    def get_connection(self, url, proxies=None):
+        return self.pool
+
+    def get_connection_with_tls_context(self, request, verify, proxies=None, cert=None):
+        return self.pool
+
+    def request_url(self, request, proxies):
+        # The daemon needs to know where the request is headed
+        return request.url
+
+    def close(self):
+        super(UnixSocketAdapter, self).close()
+        self.pool.close()
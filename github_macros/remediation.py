@@ -0,0 +1,231 @@
+"""
+Working out the fewest API writes that bring a branch's protection in line with the rules it
+is checked against, so a compliant branch costs nothing and a non-compliant one only has the
+settings that are off touched.
+
+GitHub lets most settings be changed on their own (e.g., `POST .../protection/enforce_admins`),
+but some can only be turned on by replacing the whole protection with
+`PUT .../protection`. That is only done when needed, and the replacement is the protection as
+GitHub last sent it (required approvals, code owner reviews, linear history, force pushes, and
+so on) with only the settings that drifted changed.
+"""
+import collections
+
+Change = collections.namedtuple('Change', ('method', 'path', 'body', 'summary'))
+
+# Rule options that are either on, off or (when None) left as they are
+SWITCHES = ('restrict_push', 'require_code_review', 'auto_dismiss_review', 'branch_up_to_date', 'except_admins')
+# Protection settings read as {"enabled": ...} but written as a plain true or false
+FLAGS = ('required_linear_history', 'allow_force_pushes', 'allow_deletions', 'block_creations',
+         'required_conversation_resolution', 'lock_branch', 'allow_fork_syncing')
+# Pull request review settings written as they're read
+REVIEW_SETTINGS = ('dismiss_stale_reviews', 'require_code_owner_reviews', 'required_approving_review_count',
+                   'require_last_push_approval')
+# OAuth scopes that changing branch protection needs
+SCOPES = ('repo',)
+
+
+def desired_settings(policies):
+    """
+    Combines the rules of every policy covering a branch
+
+    Returns (settings, conflicts): the rule options to enforce, and the names of any that the
+    policies disagree on (which are left alone)
+    """
+    settings = {'contexts': [], 'allowed_push_users': [], 'allowed_push_teams': []}
+    conflicts = set([])
+    for policy in policies:
+        for option in SWITCHES:
+            value = getattr(policy.options, option)
+            if value is None:
+                continue
+            if settings.get(option, value) != value:
+                conflicts.add(option)
+            settings[option] = value
+        for option in ('contexts', 'allowed_push_users', 'allowed_push_teams'):
+            settings[option] += [item for item in getattr(policy.options, option) if item not in settings[option]]
+
+    for option in conflicts:
+        del settings[option]
+    return settings, sorted(conflicts)
+
+
+def _on_off(value):
+    return 'on' if value else 'off'
+
+
+def plan(protection, settings):
+    """
+    The calls to make, in order, for the branch's protection to follow the rules
+
+    param:: protection: The branch's current `GithubBranchProtection`
+    param:: settings: Rule options to enforce, as from `desired_settings()`
+    """
+    current = {
+        'status': bool(protection.required_status_checks),
+        'strict': bool(protection.up_to_date),
+        'contexts': list(protection.contexts or []),
+        'reviews': bool(protection.required_code_review),
+        'dismiss_stale': bool(protection.dismiss_stale_reviews),
+        'enforce_admins': not protection.except_admins,
+        'restrict': bool(protection.push_restrictions),
+    }
+    target = dict(current)
+
+    if settings.get('branch_up_to_date') is not None:
+        target['strict'] = settings['branch_up_to_date']
+        target['status'] = target['status'] or target['strict']
+    missing = [check for check in settings.get('contexts', []) if check not in current['contexts']]
+    if missing:
+        target['contexts'] = current['contexts'] + missing
+        target['status'] = True
+    if settings.get('require_code_review') is not None:
+        target['reviews'] = settings['require_code_review']
+    if target['reviews'] and settings.get('auto_dismiss_review') is not None:
+        target['dismiss_stale'] = settings['auto_dismiss_review']
+    if settings.get('except_admins') is not None:
+        target['enforce_admins'] = not settings['except_admins']
+    if settings.get('restrict_push') is not None:
+        target['restrict'] = settings['restrict_push']
+
+    if target == current:
+        return []
+
+    diff = dict((name, _describe(name, current[name], target[name])) for name in target
+                if target[name] != current[name])
+    base = '/repos/{r}/branches/{b}/protection'.format(r=protection.branch.repository.full_name,
+                                                       b=protection.branch.name)
+
+    def change(method, path, body, *names):
+        return Change(method, path, body, ', '.join(diff[name] for name in sorted(names) if name in diff))
+
+    turned_on = [name for name in ('status', 'reviews', 'restrict') if target[name] and not current[name]]
+    if not protection.enabled or turned_on:
+        # Only a full replacement can switch these on
+        return [change('PUT', base, _full_protection(protection, target, settings), *target)]
+
+    changes = []
+    if target['status'] and (target['strict'], target['contexts']) != (current['strict'], current['contexts']):
+        status = (_writable(protection.document)['required_status_checks'] or {}).get('checks')
+        changes.append(change('PATCH', base + '/required_status_checks', _status_checks(status, target),
+                              'strict', 'contexts'))
+    if current['reviews'] and not target['reviews']:
+        changes.append(change('DELETE', base + '/required_pull_request_reviews', None, 'reviews'))
+    elif target['reviews'] and target['dismiss_stale'] != current['dismiss_stale']:
+        changes.append(change('PATCH', base + '/required_pull_request_reviews',
+                              {'dismiss_stale_reviews': target['dismiss_stale']}, 'dismiss_stale'))
+    if target['enforce_admins'] != current['enforce_admins']:
+        changes.append(change('POST' if target['enforce_admins'] else 'DELETE', base + '/enforce_admins', None,
+                              'enforce_admins'))
+    if current['restrict'] and not target['restrict']:
+        changes.append(change('DELETE', base + '/restrictions', None, 'restrict'))
+    return changes
+
+
+def _describe(name, before, after):
+    if name == 'contexts':
+        return 'contexts +{}'.format(','.join(check for check in after if check not in before))
+    return '{}: {} -> {}'.format(name, _on_off(before), _on_off(after))
+
+
+def _names(items, key):
+    return [item[key] if isinstance(item, dict) else item for item in items or []]
+
+
+def _actors(section):
+    actors = {'users': _names(section.get('users'), 'login'), 'teams': _names(section.get('teams'), 'slug')}
+    if 'apps' in section:
+        actors['apps'] = _names(section['apps'], 'slug')
+    return actors
+
+
+def _writable(document):
+    """
+    The body for `PUT .../protection` that leaves the protection as it is, from the protection
+    as GitHub sends it (None for an unprotected branch)
+    """
+    document = document or {}
+    body = {
+        'required_status_checks': None,
+        'enforce_admins': bool((document.get('enforce_admins') or {}).get('enabled')),
+        'required_pull_request_reviews': None,
+        'restrictions': None,
+    }
+    status = document.get('required_status_checks')
+    if status:
+        body['required_status_checks'] = {'strict': bool(status.get('strict'))}
+        if status.get('checks'):
+            # Unlike contexts, checks keep the app each one has to come from
+            body['required_status_checks']['checks'] = [dict((key, check[key]) for key in ('context', 'app_id') if key in check)
+                                                        for check in status['checks']]
+        else:
+            body['required_status_checks']['contexts'] = list(status.get('contexts') or [])
+    reviews = document.get('required_pull_request_reviews')
+    if reviews:
+        body['required_pull_request_reviews'] = dict((key, reviews[key]) for key in REVIEW_SETTINGS if key in reviews)
+        for section in ('dismissal_restrictions', 'bypass_pull_request_allowances'):
+            if reviews.get(section):
+                body['required_pull_request_reviews'][section] = _actors(reviews[section])
+    if document.get('restrictions'):
+        body['restrictions'] = _actors(document['restrictions'])
+    for flag in FLAGS:
+        if flag in document:
+            body[flag] = bool((document[flag] or {}).get('enabled'))
+    return body
+
+
+def _status_checks(checks, target):
+    """
+    The required status checks to write, as `checks` when the branch has them (so each keeps
+    the app it has to come from) or else as `contexts`
+    """
+    if checks is None:
+        return {'strict': target['strict'], 'contexts': target['contexts']}
+    known = [check['context'] for check in checks]
+    return {'strict': target['strict'],
+            'checks': checks + [{'context': context} for context in target['contexts'] if context not in known]}
+
+
+def _full_protection(protection, target, settings):
+    body = _writable(protection.document)
+    body['enforce_admins'] = target['enforce_admins']
+
+    if target['status']:
+        body['required_status_checks'] = _status_checks((body['required_status_checks'] or {}).get('checks'), target)
+    else:
+        body['required_status_checks'] = None
+
+    reviews = body['required_pull_request_reviews'] or {}
+    if target['reviews']:
+        reviews['dismiss_stale_reviews'] = target['dismiss_stale']
+        if 'dismissal_restrictions' not in reviews and (protection.dismissal_users or protection.dismissal_teams):
+            reviews['dismissal_restrictions'] = {
+                'users': _names(protection.dismissal_users, 'login'),
+                'teams': _names(protection.dismissal_teams, 'slug'),
+            }
+    body['required_pull_request_reviews'] = reviews if target['reviews'] else None
+
+    restrictions = body['restrictions']
+    if target['restrict']:
+        if restrictions is None:
+            restrictions = {'users': [], 'teams': []}
+            if protection.push_restrictions:
+                restrictions = {'users': _names(protection.push_users, 'login'), 'teams': _names(protection.push_teams, 'slug')}
+        restrictions['users'] += [u for u in settings.get('allowed_push_users', []) if u not in restrictions['users']]
+        restrictions['teams'] += [t for t in settings.get('allowed_push_teams', []) if t not in restrictions['teams']]
+    body['restrictions'] = restrictions if target['restrict'] else None
+    return body
+
+
+def apply(http, changes):
+    """
+    Makes the calls in order, stopping at the first that fails
+
+    Returns the failed `(change, response)`, or None when all went through
+    """
+    for change in changes:
+        # Each call sets the end state rather than adding to it, so a retry can't overdo it
+        resp = http.request(change.method, change.path, json=change.body, retry=True, scopes=SCOPES)
+        if resp.status_code >= 400:
+            return change, resp
+    return None
@@ -0,0 +1,69 @@
+"""
+Everything a command has to say about its run, either as the usual lines of text or, with
+`--format ndjson`, as one JSON object per line for other tools to consume while the run is still
+going. Each record is written (and flushed) as soon as it's ready, and always whole, however many
+workers are reporting at once.
+
+Every record has a `type` (e.g., "repo", "error", "stats"), the rest of its fields depending on
+the type. In ndjson mode, all records go to stdout, errors included.
+"""
+from __future__ import print_function
+import collections
+import json
+import sys
+import threading
+
+FORMATS = ('text', 'ndjson')
+
+
+class Reporter(object):
+    """
+    param:: fmt: One of `FORMATS`
+    param:: stdout: Stream for records (defaults to `sys.stdout` at the time of writing)
+    param:: stderr: Stream for errors in text mode (defaults to `sys.stderr` at the time of writing)
+    """
+
+    def __init__(self, fmt='text', stdout=None, stderr=None):
+        self.format = fmt
+        self.stdout = stdout
+        self.stderr = stderr
+        self._lock = threading.Lock()
+
+    def emit(self, record_type, text=None, error=False, **fields):
+        """
+        param:: record_type: What the record is about, its `type` in ndjson
+        param:: text: What to print in text mode, if anything
+        param:: error: Whether the text goes to stderr
+        """
+        if self.format == 'ndjson':
+            record = collections.OrderedDict([('type', record_type)])
+            record.update(sorted((key, value) for key, value in fields.items() if value is not None))
+            line = json.dumps(record, default=str)
+            stream = self.stdout or sys.stdout
+        elif text is not None:
+            line = text
+            stream = (self.stderr or sys.stderr) if error else (self.stdout or sys.stdout)
+        else:
+            return
+
+        with self._lock:
+            print(line, file=stream)
+            stream.flush()
+
+
+# The one every command reports through, set up from its arguments with `configure()`
+reporter = Reporter()
+
+
+def add_format_args(p):
+    p.add_argument('--format', dest='format', action='store', default='text', choices=FORMATS,
+                   help='Print lines of text (text, the default), or a JSON object per line as each result comes in (ndjson)')
+
+
+def configure(opts):
+    reporter.format = opts.format
+    return reporter
+
+
+def emit(record_type, text=None, error=False, **fields):
+    reporter.emit(record_type, text, error=error, **fields)
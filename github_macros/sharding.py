@@ -0,0 +1,91 @@
+"""
+Splitting repository work across several machines without overlap: each of N shards takes a
+stable slice of the repositories, decided only by their names (and, optionally, sizes), so every
+node arrives at the same assignment without talking to the others.
+"""
+import argparse
+import hashlib
+import threading
+
+from github_macros.hosts import qualified_name
+
+
+def shard_hash(name, count):
+    """
+    0-based shard for a repository, stable across runs, machines and Python versions
+
+    param:: name: The repository's name qualified by its host (see `qualified_name()`), as the
+                  same OWNER/NAME on github.com and a GitHub Enterprise host are different repositories
+    """
+    digest = hashlib.sha1(name.lower().encode('utf-8')).hexdigest()
+    return int(digest, 16) % count
+
+
+class Shard(object):
+    """
+    param:: index: Which shard this is, 1 through `count`
+    param:: count: How many shards the work is split into
+    param:: balance: 'hash' to assign repositories by name alone, or 'size' to balance the total
+                     size of each shard (needs the whole listing up front, see `select()`)
+    """
+
+    def __init__(self, index, count, balance='hash'):
+        if count < 1 or not 1 <= index <= count:
+            raise ValueError('Shard must be between 1/{n} and {n}/{n}'.format(n=max(count, 1)))
+        self.index = index
+        self.count = count
+        self.balance = balance
+        self._assigned = {}  # Lowercased [HOST:]OWNER/NAME => 0-based shard, for size-balanced listings seen so far
+        self._lock = threading.Lock()
+
+    @classmethod
+    def parse(cls, spec, balance='hash'):
+        """
+        param:: spec: "i/N", e.g. "2/5" for the second of five shards
+        """
+        try:
+            index, count = [int(part) for part in spec.split('/')]
+            return cls(index, count, balance=balance)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError('Invalid shard {spec}: expected i/N ({e})'.format(spec=repr(spec), e=e))
+
+    def __str__(self):
+        return '{}/{}'.format(self.index, self.count)
+
+    def contains(self, repo):
+        key = qualified_name(repo).lower()
+        with self._lock:
+            if key in self._assigned:
+                return self._assigned[key] == self.index - 1
+        return shard_hash(key, self.count) == self.index - 1
+
+    def select(self, repos):
+        """
+        The repositories of a complete listing which belong to this shard. When balancing by size,
+        that's every repository being worked on (of every organization and user) at once, as each
+        call balances what it's given from scratch.
+        """
+        repos = list(repos)
+        if self.balance != 'size':
+            return [repo for repo in repos if self.contains(repo)]
+
+        # Largest first, each onto whichever shard has the least so far. Ties are broken by
+        # name and shard number, so every node computes the same assignment.
+        loads = [0] * self.count
+        assignment = {}
+        for repo in sorted(repos, key=lambda r: (-(r.size or 0), qualified_name(r).lower())):
+            target = min(range(self.count), key=lambda i: (loads[i], i))
+            loads[target] += repo.size or 0
+            assignment[qualified_name(repo).lower()] = target
+
+        with self._lock:
+            self._assigned.update(assignment)
+        return [repo for repo in repos if assignment[qualified_name(repo).lower()] == self.index - 1]
+
+
+def report(shard, selected, total, errors):
+    """
+    A one-line summary per shard; concatenating these from every node accounts for the whole run
+    """
+    return 'SHARD: {shard} handled {selected} of {total} repositories, {errors} with errors\n'.format(
+        shard=shard, selected=selected, total=total, errors=errors)
@@ -0,0 +1,156 @@
+"""
+Checking out the submodules of mirrored repositories, all the way down, without fetching from
+GitHub what the mirror already has.
+
+Each submodule whose URL points at a repository that is itself mirrored (on any host, see
+`github_macros.hosts`) is cloned with the mirror as a reference: objects the mirror holds are
+copied from it locally, and only the rest comes over the network. The clone is dissociated from
+the mirror afterwards, so it keeps working whatever happens to the mirror later on.
+
+Submodules of one repository are updated several at a time, each going on to its own submodules
+once it's checked out.
+"""
+import collections
+import os
+import posixpath
+import re
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import sh
+from sh.contrib import git
+
+from github_macros.hosts import default_host
+
+# e.g., "git@github.com:acme/widget.git"
+SCP_LIKE = re.compile(r'^(?:[^@/]+@)?(?P<host>[^:/]+):(?P<path>[^/].*)$')
+
+Submodule = collections.namedtuple('Submodule', ('name', 'path', 'url'))
+
+
+def split_url(url):
+    """
+    The (host, "owner/name") a clone URL points at, or None if it isn't a repository on a host
+    """
+    parsed = urlparse(url)
+    if parsed.scheme and parsed.hostname:
+        host, path = parsed.hostname, parsed.path
+    else:
+        match = SCP_LIKE.match(url)
+        if not match:
+            return None
+        host, path = match.group('host'), match.group('path')
+    path = path.strip('/')
+    if path.endswith('.git'):
+        path = path[:-len('.git')]
+    if path.count('/') != 1:
+        return None
+    return host.lower(), path
+
+
+def resolve_url(url, parent_url):
+    """
+    Submodule URLs starting with "./" or "../" are relative to the URL of the repository they're in
+    """
+    if not url.startswith(('./', '../')) or not parent_url:
+        return url
+    parsed = urlparse(parent_url)
+    if parsed.scheme and parsed.netloc:
+        path = posixpath.normpath(posixpath.join(parsed.path.rstrip('/'), url))
+        return parsed._replace(path=path).geturl()
+    match = SCP_LIKE.match(parent_url)
+    if not match:
+        return posixpath.normpath(posixpath.join(parent_url, url))
+    path = posixpath.normpath(posixpath.join(match.group('path').rstrip('/'), url))
+    return '{prefix}:{path}'.format(prefix=parent_url[:match.start('path') - 1], path=path)
+
+
+def mirror_path(base, url):
+    """
+    Where the repository a URL points at is mirrored under `base`, if it is. Names are matched
+    without regard to case, as GitHub does.
+    """
+    parts = split_url(url)
+    if parts is None:
+        return None
+    host, full_name = parts
+    if any(part in ('', '.', '..') for part in [host] + full_name.split('/')):
+        return None
+    path = base if host == default_host() else _find(base, host)
+    for name in full_name.split('/'):
+        path = _find(path, name) if path else None
+    if path and os.path.isdir(os.path.join(path, '.git')):
+        return path
+    return None
+
+
+def _find(directory, name):
+    candidate = os.path.join(directory, name)
+    if os.path.isdir(candidate):
+        return candidate
+    try:
+        matches = [entry for entry in os.listdir(directory) if entry.lower() == name.lower()]
+    except OSError:
+        return None
+    return os.path.join(directory, matches[0]) if matches else None
+
+
+def submodules(path):
+    """
+    The submodules `.gitmodules` lists in a checkout
+    """
+    if not os.path.isfile(os.path.join(path, '.gitmodules')):
+        return []
+    try:
+        out = str(git('-C', path, 'config', '-f', '.gitmodules', '--get-regexp', r'^submodule\..*\.(path|url)$'))
+    except sh.ErrorReturnCode_1:
+        return []
+    found = collections.OrderedDict()
+    for line in out.splitlines():
+        key, _, value = line.partition(' ')
+        name, _, field = key[len('submodule.'):].rpartition('.')
+        found.setdefault(name, {})[field] = value.strip()
+    return [Submodule(name, fields['path'], fields.get('url')) for name, fields in found.items() if 'path' in fields]
+
+
+def origin_url(path):
+    try:
+        return str(git('-C', path, 'config', '--get', 'remote.origin.url')).strip()
+    except sh.ErrorReturnCode:
+        return None
+
+
+def update(path, base, jobs=4, timeout=None):
+    """
+    Checks out every submodule of the repository at `path`, recursively
+
+    param:: base: Directory the mirror is in, for finding mirrored submodules
+    param:: jobs: Submodules of a repository to update at the same time
+    param:: timeout: Seconds after which a fetch or clone is given up on
+    returns:: (submodules checked out, how many of those came from the mirror)
+    """
+    found = submodules(path)
+    if not found:
+        return 0, 0
+    network = {'_timeout': timeout} if timeout else {}
+    base = os.path.abspath(base)
+    parent_url = origin_url(path)
+
+    # These write to the repository's own config, so they can't run side by side
+    git('-C', path, 'submodule', 'sync', '--quiet')
+    git('-C', path, 'submodule', 'init', '--quiet')
+
+    def update_one(submodule):
+        url = resolve_url(submodule.url or '', parent_url)
+        reference = mirror_path(base, url)
+        if reference is not None and os.path.abspath(reference) == os.path.abspath(path):
+            reference = None  # A repository that's its own submodule has nothing to lend
+        options = ['--reference', reference, '--dissociate'] if reference else []
+        git('-C', path, 'submodule', 'update', '--quiet', *(options + ['--', submodule.path]), **network)
+        nested, nested_mirrored = update(os.path.join(path, submodule.path), base, jobs, timeout)
+        return 1 + nested, (1 if reference else 0) + nested_mirrored
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as workers:
+        results = list(workers.map(update_one, found))
+    return sum(r[0] for r in results), sum(r[1] for r in results)
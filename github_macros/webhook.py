@@ -0,0 +1,82 @@
+"""
+A small HTTP endpoint for receiving GitHub webhook deliveries, checking that each one was
+signed with our shared secret before handing it off.
+"""
+from __future__ import print_function
+import hashlib
+import hmac
+import json
+import socketserver
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+def sign(secret, body, algorithm='sha256'):
+    """
+    The value GitHub would send in `X-Hub-Signature-256` (or `X-Hub-Signature` for sha1)
+    """
+    digest = hmac.new(secret.encode('utf-8'), body, getattr(hashlib, algorithm)).hexdigest()
+    return '{algo}={digest}'.format(algo=algorithm, digest=digest)
+
+
+def verify_signature(secret, body, headers):
+    """
+    Checks the delivery's HMAC signature, preferring sha256 over the legacy sha1 header
+    """
+    if 'X-Hub-Signature-256' in headers:
+        expected, given = sign(secret, body, 'sha256'), headers['X-Hub-Signature-256']
+    elif 'X-Hub-Signature' in headers:
+        expected, given = sign(secret, body, 'sha1'), headers['X-Hub-Signature']
+    else:
+        return False
+
+    return hmac.compare_digest(expected.encode('utf-8'), given.encode('utf-8'))
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+
+        if self.server.secret and not verify_signature(self.server.secret, body, self.headers):
+            return self.reply(401, 'Bad signature')
+
+        try:
+            payload = json.loads(body.decode('utf-8') or '{}')
+        except ValueError:
+            return self.reply(400, 'Expected a JSON payload')
+
+        event = self.headers.get('X-GitHub-Event', '')
+        if event == 'ping':
+            return self.reply(200, 'pong')
+
+        accepted = self.server.on_event(event, payload)
+        self.reply(202 if accepted else 200, 'queued' if accepted else 'ignored')
+
+    def reply(self, status, message):
+        body = message.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Quiet by default; callers report what they do with each event
+        pass
+
+
+class WebhookServer(socketserver.ThreadingMixIn, HTTPServer):
+    """
+    param:: address: (host, port) to listen on; port 0 picks a free one
+    param:: on_event: Called with (event_name, payload) for each verified delivery, returning
+                      whether it resulted in any work
+    param:: secret: Shared secret configured on the GitHub webhook (None skips verification)
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, on_event, secret=None):
+        HTTPServer.__init__(self, address, WebhookHandler)
+        self.on_event = on_event
+        self.secret = secret
@@ -0,0 +1,43 @@
+import pytest
+
+from github_macros.cli._base import MyParser, add_filter_args, add_transport_args, check_filter_args, create_client, \
+    transport_options
+
+
+def parse(*args):
+    p = MyParser()
+    add_transport_args(p)
+    return p.parse_args(list(args))
+
+
+def test_transport_flags_and_environment_reach_the_client(monkeypatch):
+    monkeypatch.setenv('GITHUB_READ_TIMEOUT', '90')
+    monkeypatch.setenv('GITHUB_KEEP_ALIVE', 'off')
+
+    opts = parse('--pool-size', '24', '--no-compression', '--max-retries', '2')
+    client = create_client('someone', 'sometoken', **transport_options(opts))
+
+    assert client.get_adapter('https://api.github.com').poolmanager.connection_pool_kw['maxsize'] == 24
+    assert client.timeout == (10.0, 90.0)
+    assert client.headers['Accept-Encoding'] == 'identity'
+    assert client.headers['Connection'] == 'close'
+    assert client.max_retries == 2
+
+
+def check_filter(*args):
+    p = MyParser()
+    add_filter_args(p)
+    opts = p.parse_args(list(args))
+    check_filter_args(p, opts)
+    return opts
+
+
+def test_graphql_filters_on_fields_it_cant_list_are_turned_away_up_front(capsys):
+    for where in ('open_issues > 3', 'watchers > 10 and not fork', 'permissions'):
+        with pytest.raises(SystemExit) as exit:
+            check_filter('--graphql', '--where', where)
+        assert exit.value.code == 2
+    assert 'open_issues' in capsys.readouterr().err
+
+    assert check_filter('--graphql', '--where', 'not fork and size > 100 and topics in (go)').graphql
+    assert check_filter('--where', 'open_issues > 3').where is not None  # Listed through REST
@@ -19,3 +19,8 @@ def test_gh_protect():
 def test_gh_releases():
     sh.gh_releases('--version')
     sh.gh_releases('--help')
+
+
+def test_gh_inventory():
+    sh.gh_inventory('--version')
+    sh.gh_inventory('--help')
@@ -0,0 +1,319 @@
+import argparse
+import json
+import threading
+
+import pytest
+import requests
+
+from github_macros.cli import refresh
+from github_macros.cli.refresh import CloneScheduler, clone_worker, list_repositories, start_thread, watch, watch_cursors
+from github_macros.models.github import GithubOrganization, GithubRepository
+from github_macros.sharding import Shard
+
+from test.test_http import client_with
+
+
+def repo(name, size=10):
+    return GithubRepository.deserialize(None, {
+        'name': name.split('/')[1], 'full_name': name, 'owner': {'login': name.split('/')[0], 'type': 'Organization'},
+        'ssh_url': 'git@github.com:{}.git'.format(name), 'pushed_at': '2026-03-01T00:00:00Z', 'size': size,
+    })
+
+
+class Owner(object):
+    """
+    Lists `names` a page at a time, breaking off with `error` (if any) after them
+    """
+
+    def __init__(self, name, names, error=None):
+        self.name = name
+        self.http = None
+        self.names = names
+        self.error = error
+
+    def iter_repositories(self, fields=None):
+        for name in self.names:
+            yield repo(name)
+        if self.error is not None:
+            raise self.error
+
+
+def options(**kwargs):
+    defaults = dict(resume=False, dry_run=False, clobber=False, git_timeout=0, submodules=False, submodule_jobs=4)
+    defaults.update(kwargs)
+    return argparse.Namespace(**defaults)
+
+
+class Cloned(list):
+    """
+    Stands in for git: records each repository cloned, failing for those in `broken`
+    """
+
+    def __init__(self):
+        super(Cloned, self).__init__()
+        self.broken = set([])
+        self._lock = threading.Lock()
+
+    def __call__(self, repo, **kwargs):
+        if repo.full_name in self.broken:
+            raise RuntimeError('fatal: the remote end hung up unexpectedly')
+        with self._lock:
+            self.append(repo.full_name)
+
+
+@pytest.fixture
+def cloned(tmpdir, monkeypatch):
+    monkeypatch.chdir(str(tmpdir))
+    clone = Cloned()
+    monkeypatch.setattr(refresh, 'clone', clone)
+    return clone
+
+
+def run(owners, work, failures, jobs=2):
+    """
+    Lists every owner while `jobs` workers clone, the way `main()` does, until all of it is done
+    """
+    managed = set([])
+    producers = [start_thread(list_repositories, owner, '  ORG', work, managed, failures) for owner in owners]
+    workers = [start_thread(clone_worker, work, options(), failures) for _ in range(jobs)]
+    for thread in producers:
+        thread.join()
+    work.join()
+    work.close(len(workers))
+    for thread in workers:
+        thread.join(5)
+        assert not thread.is_alive()
+    return managed
+
+
+def test_repositories_are_cloned_as_they_are_listed(cloned):
+    failures = []
+    managed = run([Owner('acme', ['acme/widget', 'acme/gadget']), Owner('labs', ['labs/lab'])], CloneScheduler(), failures)
+
+    assert sorted(cloned) == ['acme/gadget', 'acme/widget', 'labs/lab']
+    assert sorted(managed) == ['acme/gadget', 'acme/widget', 'labs/lab']
+    assert failures == []
+
+
+def test_a_listing_that_breaks_off_keeps_what_it_had_listed(cloned):
+    failures = []
+    broken = Owner('acme', ['acme/widget'], error=requests.HTTPError('502 Server Error: Bad Gateway'))
+    run([broken, Owner('labs', ['labs/lab'])], CloneScheduler(), failures)
+
+    assert sorted(cloned) == ['acme/widget', 'labs/lab']
+    assert failures == ['acme']
+
+
+def test_a_failing_clone_is_reported_and_the_rest_carry_on(cloned):
+    cloned.broken.add('acme/gadget')
+    failures = []
+    run([Owner('acme', ['acme/widget', 'acme/gadget', 'acme/sprocket'])], CloneScheduler(), failures, jobs=1)
+
+    assert sorted(cloned) == ['acme/sprocket', 'acme/widget']
+    assert failures == ['acme/gadget']
+
+
+def test_closing_lets_workers_finish_what_was_queued_first(cloned):
+    work = CloneScheduler()
+    for name in ('acme/widget', 'acme/gadget'):
+        work.put(repo(name))
+    work.close(2)
+
+    workers = [start_thread(clone_worker, work, options(), []) for _ in range(2)]
+    for thread in workers:
+        thread.join(5)
+        assert not thread.is_alive()
+    assert sorted(cloned) == ['acme/gadget', 'acme/widget']
+
+
+def test_closing_with_nothing_queued_stops_idle_workers(cloned):
+    work = CloneScheduler()
+    workers = [start_thread(clone_worker, work, options(), []) for _ in range(3)]
+    work.close(len(workers))
+
+    for thread in workers:
+        thread.join(5)
+        assert not thread.is_alive()
+    assert cloned == []
+
+
+def drain(work):
+    names = []
+    work.close(1)
+    while True:
+        repo = work.get()
+        if repo is refresh._DONE:
+            return names
+        names.append(repo.full_name)
+
+
+def test_work_is_handed_out_largest_first():
+    work = CloneScheduler(strategy='size')
+    for name, size in (('acme/small', 10), ('acme/huge', 9000), ('acme/medium', 500), ('acme/unsized', None)):
+        work.put(repo(name, size))
+
+    assert drain(work) == ['acme/huge', 'acme/medium', 'acme/small', 'acme/unsized']
+
+
+def test_work_is_handed_out_longest_previous_run_first_then_unseen_by_size():
+    work = CloneScheduler(strategy='history', history={'acme/quick': 1.5, 'acme/slow': 120.0})
+    for name, size in (('acme/quick', 9000), ('acme/new', 10), ('acme/slow', 10), ('acme/newer', 500)):
+        work.put(repo(name, size))
+
+    assert drain(work) == ['acme/newer', 'acme/new', 'acme/slow', 'acme/quick']
+
+
+def test_work_is_handed_out_as_listed_and_only_once_while_waiting():
+    work = CloneScheduler(strategy='api')
+    assert work.put(repo('acme/small', 10))
+    assert work.put(repo('acme/huge', 9000))
+    assert not work.put(repo('acme/small', 10))
+
+    assert drain(work) == ['acme/small', 'acme/huge']
+    # Once it's been handed out, another change needs another pass
+    assert work.put(repo('acme/small', 10))
+
+
+def test_byte_budget_holds_back_clones_past_the_limit():
+    budget = refresh.ByteBudget(100)
+    budget.acquire(60)
+    budget.acquire(40)
+    assert budget.in_flight == 100
+
+    started = threading.Event()
+
+    def clone():
+        budget.acquire(30)
+        started.set()
+    start_thread(clone)
+    assert not started.wait(0.2)
+
+    budget.release(60)
+    assert started.wait(5)
+    assert budget.in_flight == 70
+
+
+def test_byte_budget_lets_a_repository_larger_than_the_limit_run_alone():
+    budget = refresh.ByteBudget(100)
+    budget.acquire(500)
+    assert budget.in_flight == 500
+    budget.release(500)
+
+    unlimited = refresh.ByteBudget(0)
+    unlimited.acquire(500)
+    unlimited.acquire(500)
+    assert unlimited.in_flight == 0
+
+
+def test_a_failed_clone_gives_back_its_share_of_the_budget(cloned):
+    work = CloneScheduler(max_inflight_kb=100)
+    with pytest.raises(RuntimeError):
+        with work.running(repo('acme/widget', 80)):
+            assert work.budget.in_flight == 80
+            raise RuntimeError('fatal: early EOF')
+    assert work.budget.in_flight == 0
+    assert 'acme/widget' not in work.history
+
+    with work.running(repo('acme/gadget', 90)):
+        assert work.budget.in_flight == 90
+    assert work.budget.in_flight == 0
+    assert 'acme/gadget' in work.history
+
+
+def test_updates_dont_count_against_the_budget(cloned, tmpdir):
+    tmpdir.mkdir('acme').mkdir('widget')
+    work = CloneScheduler(max_inflight_kb=100)
+    with work.running(repo('acme/widget', 5000)):
+        assert work.budget.in_flight == 0
+
+
+def event(n, kind, name):
+    return {'id': str(n), 'type': kind, 'repo': {'name': name}}
+
+
+def payload(name):
+    return json.dumps({'name': name.split('/')[1], 'full_name': name, 'size': 10,
+                       'owner': {'login': name.split('/')[0], 'type': 'Organization'},
+                       'ssh_url': 'git@github.com:{}.git'.format(name), 'pushed_at': '2026-03-01T00:00:00Z'})
+
+
+class Stop(Exception):
+    pass
+
+
+def watch_once(monkeypatch, responses, cursor):
+    """
+    Runs a single round of polling, returning what was queued, the cursor and how long it would wait
+    """
+    client, adapter = client_with(responses)
+    owners = [('  ORG', GithubOrganization(client, 'acme'))]
+    cursors = {'acme': cursor}
+    waits = []
+
+    def sleep(seconds):
+        waits.append(seconds)
+        raise Stop()
+    monkeypatch.setattr(refresh.time, 'sleep', sleep)
+
+    work = CloneScheduler(strategy='api')
+    with pytest.raises(Stop):
+        watch(owners, cursors, work, [], 60)
+    return drain(work), cursors['acme'], waits[0], adapter
+
+
+def test_watching_starts_from_where_each_feed_is():
+    client, adapter = client_with([(200, {'ETag': 'W/"one"'}, json.dumps([event(12, 'PushEvent', 'acme/widget')])),
+                                   (200, {}, '[]')])
+    owners = [('  ORG', GithubOrganization(client, 'acme')), ('  ORG', GithubOrganization(client, 'quiet'))]
+
+    assert watch_cursors(owners) == {'acme': {'etag': 'W/"one"', 'since': 12}, 'quiet': {'etag': None, 'since': 0}}
+
+
+def test_watching_updates_only_what_was_pushed_to(monkeypatch):
+    feed = [event(16, 'PushEvent', 'acme/widget'), event(15, 'WatchEvent', 'acme/starred'),
+            event(14, 'PushEvent', 'someone/fork'), event(13, 'CreateEvent', 'acme/gadget'),
+            event(12, 'PushEvent', 'acme/widget'), event(11, 'PushEvent', 'acme/old')]
+    queued, cursor, wait, adapter = watch_once(monkeypatch, [
+        (200, {'ETag': 'W/"two"', 'X-Poll-Interval': '90'}, json.dumps(feed)),
+        (200, {}, payload('acme/widget')),
+        (200, {}, payload('acme/gadget')),
+    ], {'etag': 'W/"one"', 'since': 11})
+
+    assert queued == ['acme/widget', 'acme/gadget']
+    assert cursor == {'etag': 'W/"two"', 'since': 16}
+    assert wait == 90  # GitHub asked for longer than we would have waited
+    assert adapter.sent[0].headers['If-None-Match'] == 'W/"one"'
+
+
+def test_watching_an_unchanged_feed_does_nothing(monkeypatch):
+    queued, cursor, wait, adapter = watch_once(monkeypatch, [(304, {'X-Poll-Interval': '30'}, '')],
+                                               {'etag': 'W/"one"', 'since': 11})
+
+    assert queued == []
+    assert cursor == {'etag': 'W/"one"', 'since': 11}
+    assert wait == 60
+    assert len(adapter.sent) == 1
+
+
+def test_watching_falls_back_to_a_sweep_when_events_were_missed(monkeypatch):
+    queued, cursor, wait, adapter = watch_once(monkeypatch, [
+        (200, {'ETag': 'W/"two"'}, json.dumps([event(400, 'PushEvent', 'acme/widget')])),
+        (200, {}, '[{}, {}]'.format(payload('acme/widget'), payload('acme/gadget'))),
+    ], {'etag': 'W/"one"', 'since': 11})
+
+    assert queued == ['acme/widget', 'acme/gadget']
+    assert cursor == {'etag': 'W/"two"', 'since': 400}
+    assert adapter.sent[1].url.startswith('https://api.github.com/orgs/acme/repos')
+
+
+def test_size_balanced_shards_wait_for_every_owner_to_be_listed():
+    work = CloneScheduler(strategy='api', shard=Shard(2, 2, balance='size'))
+    held = []
+    for owner in (Owner('acme', ['acme/widget']), Owner('labs', ['labs/lab'])):
+        list_repositories(owner, '  ORG', work, set([]), [], held=held)
+    assert [r.full_name for r in held] == ['acme/widget', 'labs/lab']
+
+    # As main() does once every producer is done: each owner's only repository can't both go to shard 1
+    work.shard.select(held)
+    assert [r.full_name for r in held if work.put(r)] == ['labs/lab']
+    assert drain(work) == ['labs/lab']
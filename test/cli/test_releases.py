@@ -0,0 +1,129 @@
+import io
+import json
+import sys
+
+import requests
+from requests.adapters import BaseAdapter
+
+from github_macros.cli import releases
+from github_macros.http import GithubHttp
+from github_macros import reporting
+
+API = 'https://api.github.com'
+
+
+def release(repo, tag):
+    return {'tag_name': tag, 'draft': False, 'prerelease': False,
+            'assets_url': '{}/repos/{}/releases/{}/assets'.format(API, repo, tag)}
+
+
+def asset(repo, tag, name):
+    return {'name': name, 'size': len(name), 'updated_at': '2026-01-02T03:04:05Z',
+            'url': '{}/repos/{}/releases/assets/{}/{}'.format(API, repo, tag, name),
+            'browser_download_url': 'https://github.com/{}/releases/download/{}/{}'.format(repo, tag, name)}
+
+
+class ReleaseServer(BaseAdapter):
+    """
+    Serves the releases, assets and asset downloads of `repos` by URL, whatever order they're asked for in
+    """
+
+    def __init__(self, repos):
+        super(ReleaseServer, self).__init__()
+        self.routes = {}
+        for repo, tags in repos.items():
+            found = []
+            for tag, names in tags:
+                assets = [asset(repo, tag, name) for name in names]
+                found.append(release(repo, tag))
+                self.routes['/repos/{}/releases/{}/assets'.format(repo, tag)] = json.dumps(assets).encode('utf-8')
+                for item in assets:
+                    self.routes[item['url'][len(API):]] = item['name'].encode('utf-8')
+            self.routes['/repos/{}/releases'.format(repo)] = json.dumps(found).encode('utf-8')
+
+    def send(self, request, **kwargs):
+        path = request.path_url.split('?')[0]
+        resp = requests.Response()
+        resp.status_code = 200 if path in self.routes else 404
+        resp.raw = io.BytesIO(self.routes.get(path, b'{"message": "Not Found"}'))
+        resp.request = request
+        resp.url = request.url
+        return resp
+
+    def close(self):
+        pass
+
+
+REPOS = {
+    'acme/widget': [('v1.0.0', ['widget.tar.gz']), ('v1.1.0', ['widget.tar.gz', 'widget.zip'])],
+    'acme/gadget': [('v2.0.0', ['gadget.tar.gz']), ('v2.1.0-rc1', ['gadget.tar.gz'])],
+}
+
+
+def run(monkeypatch, capsys, *args, **kwargs):
+    client = GithubHttp('someone', 'sometoken', backoff=0)
+    client.mount('https://', ReleaseServer(REPOS))
+    monkeypatch.setattr(releases, 'create_client', lambda *a, **kw: client)
+    monkeypatch.setattr(sys, 'argv', ['gh-releases', '--format', 'ndjson'] + list(args))
+    monkeypatch.setattr(sys, 'stdin', io.StringIO(kwargs.get('stdin', '')))
+    # main() sets the format of the shared reporter, which is put back as it was afterwards
+    monkeypatch.setattr(reporting.reporter, 'format', reporting.reporter.format)
+    code = 0
+    try:
+        releases.main()
+    except SystemExit as e:
+        code = e.code
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    return code, records
+
+
+def test_several_repositories_are_looked_up_in_one_run(monkeypatch, capsys):
+    code, records = run(monkeypatch, capsys, 'acme/widget', 'acme/gadget')
+
+    assert code == 0
+    assert sorted((r['repository'], r['tag'], r['name']) for r in records if r['type'] == 'asset') == [
+        ('acme/gadget', 'v2.0.0', 'gadget.tar.gz'),
+        ('acme/widget', 'v1.0.0', 'widget.tar.gz'),
+        ('acme/widget', 'v1.1.0', 'widget.tar.gz'),
+        ('acme/widget', 'v1.1.0', 'widget.zip'),
+    ]
+
+
+def test_a_missing_repository_among_several_is_reported_and_the_rest_carry_on(monkeypatch, capsys):
+    code, records = run(monkeypatch, capsys, '--latest', '--asset', '*.tar.gz', 'acme/widget', 'acme/missing',
+                        'acme/gadget')
+
+    assert code == 1
+    assert [r['repository'] for r in records if r['type'] == 'error'] == ['acme/missing']
+    assert sorted((r['repository'], r['tag'], r['name']) for r in records if r['type'] == 'asset') == [
+        ('acme/gadget', 'v2.0.0', 'gadget.tar.gz'),
+        ('acme/widget', 'v1.1.0', 'widget.tar.gz'),
+    ]
+
+
+def test_repositories_are_read_from_stdin_and_a_file_once_each(monkeypatch, capsys, tmpdir):
+    names = tmpdir.join('repos.txt')
+    names.write('# Those we ship\nacme/gadget\n\nacme/widget  # again\n')
+
+    code, records = run(monkeypatch, capsys, '--latest', '-', '--repos-file', str(names), stdin='acme/widget\n')
+
+    assert code == 0
+    assert sorted((r['repository'], r['name']) for r in records if r['type'] == 'asset') == [
+        ('acme/gadget', 'gadget.tar.gz'), ('acme/widget', 'widget.tar.gz'), ('acme/widget', 'widget.zip')]
+
+
+def test_several_repositories_download_to_a_directory_each(monkeypatch, capsys, tmpdir):
+    code, records = run(monkeypatch, capsys, '--latest', '--download', str(tmpdir), 'acme/widget', 'acme/gadget')
+
+    assert code == 0
+    assert tmpdir.join('acme', 'widget', 'v1.1.0', 'widget.zip').read() == 'widget.zip'
+    assert tmpdir.join('acme', 'gadget', 'v2.0.0', 'gadget.tar.gz').read() == 'gadget.tar.gz'
+    assert len([r for r in records if r['type'] == 'download']) == 3
+
+
+def test_a_single_repository_downloads_as_before(monkeypatch, capsys, tmpdir):
+    code, records = run(monkeypatch, capsys, '--latest', '--download', str(tmpdir), 'acme/gadget')
+
+    assert code == 0
+    assert tmpdir.join('v2.0.0', 'gadget.tar.gz').read() == 'gadget.tar.gz'
+
@@ -0,0 +1,114 @@
+import argparse
+import json
+import sys
+
+import pytest
+import requests
+
+from github_macros.cli import repo_permissions
+from github_macros.cli.repo_permissions import Grant, load_grants, parse_grant
+from github_macros.inventory import Snapshot
+from github_macros.models.github import GithubRepository
+from github_macros import reporting
+
+
+def test_grants_name_an_organization_team_and_permission():
+    assert parse_grant('acme/devs') == Grant('acme', 'devs', 'write')
+    assert parse_grant('ghe.example.com:platform/ops:admin') == Grant('ghe.example.com:platform', 'ops', 'admin')
+    for spec in ('acme', 'acme/', '/devs', 'ghe.example.com:/devs', 'acme/devs:owner'):
+        with pytest.raises(argparse.ArgumentTypeError):
+            parse_grant(spec)
+
+
+def test_grants_file_maps_organizations_to_teams(tmpdir):
+    path = tmpdir.join('grants.json')
+    path.write(json.dumps({'acme-labs': {'devs': 'read'}, 'acme': {'ops': 'admin', 'devs': 'write'}}))
+
+    assert load_grants(str(path)) == [Grant('acme', 'devs', 'write'), Grant('acme', 'ops', 'admin'),
+                                      Grant('acme-labs', 'devs', 'read')]
+    path.write(json.dumps({'acme': {'devs': 'owner'}}))
+    with pytest.raises(argparse.ArgumentTypeError):
+        load_grants(str(path))
+    with pytest.raises(argparse.ArgumentTypeError):
+        load_grants(str(tmpdir.join('missing.json')))
+
+
+def repo(name):
+    return GithubRepository.deserialize(None, {
+        'name': name.split('/')[1], 'full_name': name, 'owner': {'login': name.split('/')[0], 'type': 'Organization'},
+        'ssh_url': 'git@github.com:{}.git'.format(name), 'pushed_at': '2026-03-01T00:00:00Z', 'size': 10,
+    })
+
+
+@pytest.fixture
+def snapshot(tmpdir):
+    snapshot = Snapshot()
+    for org in ('acme', 'broken', 'labs'):
+        snapshot.add_owner(org, 'Organization', teams=True)
+    widget = snapshot.add_repository(repo('acme/widget'))
+    snapshot.add_repository(repo('acme/gadget'))
+    snapshot.add_repository(repo('labs/lab'))
+    devs = snapshot.add_team('acme', {'id': 7, 'slug': 'devs', 'name': 'Devs'})
+    snapshot.add_team('acme', {'id': 8, 'slug': 'ops', 'name': 'Ops'})
+    snapshot.add_team('labs', {'id': 9, 'slug': 'devs', 'name': 'Devs'})
+    snapshot.add_team_repository(devs, widget, 'push')
+
+    path = str(tmpdir.join('inventory.json.gz'))
+    snapshot.save(path)
+    return path
+
+
+def run(monkeypatch, capsys, *args):
+    monkeypatch.setattr(sys, 'argv', ['gh-permit', '--dry-run', '--format', 'ndjson'] + list(args))
+    # main() sets the format of the shared reporter, which is put back as it was afterwards
+    monkeypatch.setattr(reporting.reporter, 'format', reporting.reporter.format)
+    with pytest.raises(SystemExit) as exit:
+        repo_permissions.main()
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    return exit.value.code, records
+
+
+def test_every_team_granted_is_checked_against_every_repository(snapshot, monkeypatch, capsys):
+    code, records = run(monkeypatch, capsys, '--offline', snapshot, '--grant', 'acme/devs', '--grant', 'acme/ops:admin',
+                        '--grant', 'labs/devs:read')
+
+    assert code == 0
+    checked = sorted((r['repository'], r['team'], r['type']) for r in records if r['type'] in ('diff', 'skip'))
+    assert checked == [
+        ('acme/gadget', 'devs', 'diff'),
+        ('acme/gadget', 'ops', 'diff'),
+        ('acme/widget', 'devs', 'skip'),
+        ('acme/widget', 'ops', 'diff'),
+        ('labs/lab', 'devs', 'diff'),
+    ]
+
+
+def test_a_failing_organization_leaves_the_others_to_carry_on(snapshot, monkeypatch, capsys):
+    org_teams = repo_permissions.org_teams
+
+    def broken(client, org_name):
+        if org_name == 'broken':
+            raise requests.HTTPError('502 Server Error: Bad Gateway')
+        return org_teams(client, org_name)
+    monkeypatch.setattr(repo_permissions, 'org_teams', broken)
+
+    code, records = run(monkeypatch, capsys, '--offline', snapshot, '--grant', 'broken/devs', '--grant', 'acme/nobody',
+                        '--grant', 'labs/devs')
+
+    assert code == 1
+    assert sorted(r['organization'] for r in records if r['type'] == 'error') == ['acme', 'broken']
+    assert [r['repository'] for r in records if r['type'] == 'diff'] == ['labs/lab']
+    assert records[-1]['type'] == 'stats'
+
+
+def test_shards_are_balanced_over_every_organization_together(snapshot, monkeypatch, capsys):
+    checked = []
+    for index in (1, 2, 3):
+        code, records = run(monkeypatch, capsys, '--offline', snapshot, '--grant', 'acme/ops', '--grant', 'labs/devs',
+                            '--shard', '{}/3'.format(index), '--shard-balance', 'size')
+        assert code == 0
+        checked.append(sorted(r['repository'] for r in records if r['type'] == 'diff'))
+
+    # One each, rather than every organization's largest repository on the first shard
+    assert sorted(len(repos) for repos in checked) == [1, 1, 1]
+    assert sorted(sum(checked, [])) == ['acme/gadget', 'acme/widget', 'labs/lab']
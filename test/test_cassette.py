@@ -0,0 +1,74 @@
+import json
+import threading
+import time
+
+import pytest
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from github_macros import cassette
+from github_macros.cassette import CassetteMiss
+from github_macros.http import GithubHttp
+
+
+class CountingHandler(BaseHTTPRequestHandler):
+    calls = 0
+
+    def do_GET(self):
+        CountingHandler.calls += 1
+        time.sleep(0.05)
+        body = json.dumps({'path': self.path, 'call': CountingHandler.calls}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('X-RateLimit-Remaining', str(5000 - CountingHandler.calls))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = HTTPServer(('127.0.0.1', 0), CountingHandler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield 'http://127.0.0.1:{}'.format(httpd.server_port)
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_replay_answers_what_was_recorded(server, tmpdir):
+    path = str(tmpdir.join('run.cassette.gz'))
+    recorder = GithubHttp('someone', 'sometoken', record=path)
+    recorded = [recorder.get(server + url).json() for url in ('/orgs/acme', '/orgs/acme', '/orgs/acme/repos')]
+    cassette.shared(path, recording=True).close()
+    calls = CountingHandler.calls
+
+    player = GithubHttp(None, None, replay=path)
+    replayed = [player.get(server + url).json() for url in ('/orgs/acme', '/orgs/acme', '/orgs/acme/repos')]
+
+    assert replayed == recorded
+    assert CountingHandler.calls == calls  # Nothing reached the server
+    assert player.get(server + '/orgs/acme').json() == recorded[1]  # The last one over again
+    assert player.get(server + '/orgs/acme/repos').headers['X-RateLimit-Remaining'] == str(5000 - recorded[2]['call'])
+    with pytest.raises(CassetteMiss):
+        player.get(server + '/orgs/other')
+
+
+def test_replay_can_take_as_long_as_the_recording(server, tmpdir):
+    path = str(tmpdir.join('slow.cassette.gz'))
+    GithubHttp('someone', 'sometoken', record=path).get(server + '/slow')
+    cassette.shared(path, recording=True).close()
+
+    fast = GithubHttp(None, None, replay=path)
+    started = time.time()
+    fast.get(server + '/slow')
+    assert time.time() - started < 0.05
+
+    slow = GithubHttp(None, None, replay=path, replay_latency=True)
+    started = time.time()
+    slow.get(server + '/slow')
+    assert time.time() - started >= 0.05
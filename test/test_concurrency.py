@@ -0,0 +1,82 @@
+import threading
+
+from github_macros.concurrency import AdaptiveLimit
+
+
+def finish(limit, overloaded=False, latency=0.1):
+    slot = limit.acquire()
+    slot.overloaded = overloaded
+    limit.release(slot, latency)
+
+
+def test_limit_grows_quickly_then_steadily_after_backing_off():
+    limit = AdaptiveLimit(32, initial=2)
+    for _ in range(6):
+        finish(limit)
+    assert int(limit.limit) == 8  # Slow start: every healthy call adds one
+
+    finish(limit, overloaded=True)
+    assert int(limit.limit) == 4
+    assert limit.backoffs == 1
+
+    for _ in range(4):
+        finish(limit)
+    assert int(limit.limit) == 4  # Now about one more per round trip
+    for _ in range(5):
+        finish(limit)
+    assert int(limit.limit) == 5
+
+
+def test_limit_starts_at_the_maximum():
+    limit = AdaptiveLimit(10)
+    slots = [limit.acquire() for _ in range(10)]
+    assert limit.in_flight == 10
+    for slot in slots:
+        limit.release(slot)
+    assert limit.limit == 10
+
+
+def test_calls_already_in_flight_only_back_off_once():
+    limit = AdaptiveLimit(16, initial=8)
+    slots = [limit.acquire() for _ in range(8)]
+    for slot in slots:
+        slot.overloaded = True
+        limit.release(slot)
+
+    assert int(limit.limit) == 4
+    assert limit.backoffs == 1
+
+
+def test_limit_stays_within_bounds():
+    limit = AdaptiveLimit(4, initial=2, minimum=2)
+    for _ in range(10):
+        finish(limit)
+    assert limit.limit == 4
+    for _ in range(5):
+        finish(limit, overloaded=True)
+    assert limit.limit == 2
+
+
+def test_slow_calls_hold_the_limit():
+    limit = AdaptiveLimit(16, initial=4)
+    finish(limit, latency=0.1)
+    before = limit.limit
+    finish(limit, latency=1.0)
+    assert limit.limit == before
+
+
+def test_callers_beyond_the_limit_wait_their_turn():
+    limit = AdaptiveLimit(8, initial=1)
+    first = limit.acquire()
+    got_in = threading.Event()
+
+    def second():
+        limit.release(limit.acquire(), None)
+        got_in.set()
+
+    thread = threading.Thread(target=second)
+    thread.start()
+    assert not got_in.wait(0.1)
+    limit.release(first, None)
+    assert got_in.wait(1)
+    thread.join()
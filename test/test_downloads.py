@@ -0,0 +1,135 @@
+import hashlib
+import io
+import os
+
+import pytest
+import requests
+from requests.adapters import BaseAdapter
+
+from github_macros.downloads import DownloadError, asset_path, fetch
+from github_macros.http import GithubHttp
+
+DATA = os.urandom(100000)
+URL = 'https://api.github.com/repos/acme/widget/releases/assets/1'
+
+
+class BreakingStream(io.BytesIO):
+    """
+    A response body that drops the connection after `limit` bytes
+    """
+
+    def __init__(self, body, limit=None):
+        super(BreakingStream, self).__init__(body)
+        self.limit = limit
+
+    def read(self, size=-1):
+        if self.limit is not None and self.tell() >= self.limit:
+            raise requests.exceptions.ConnectionError('connection reset by peer')
+        if self.limit is not None:
+            size = min(size, self.limit - self.tell())
+        return super(BreakingStream, self).read(size)
+
+
+class AssetServer(BaseAdapter):
+    """
+    Serves DATA, honoring ranges, breaking off the first response after `break_after` bytes
+    """
+
+    def __init__(self, break_after=None, ranges=True):
+        super(AssetServer, self).__init__()
+        self.break_after = break_after
+        self.ranges = ranges
+        self.sent = []
+
+    def send(self, request, **kwargs):
+        self.sent.append(request)
+        start = 0
+        if self.ranges and 'Range' in request.headers:
+            start = int(request.headers['Range'].split('=')[1].rstrip('-'))
+        resp = requests.Response()
+        resp.status_code = 206 if start else 200
+        resp.raw = BreakingStream(DATA[start:], self.break_after)
+        resp.request = request
+        resp.url = request.url
+        self.break_after = None
+        return resp
+
+    def close(self):
+        pass
+
+
+def asset(**kwargs):
+    fields = {'name': 'widget.tar.gz', 'url': URL, 'size': len(DATA), 'updated_at': '2026-01-02T03:04:05Z',
+              'digest': 'sha256:' + hashlib.sha256(DATA).hexdigest()}
+    fields.update(kwargs)
+    return fields
+
+
+def client_with(server, **kwargs):
+    client = GithubHttp('someone', 'sometoken', backoff=0, **kwargs)
+    client.mount('https://', server)
+    return client
+
+
+def test_download_resumes_where_the_connection_dropped(tmpdir):
+    server = AssetServer(break_after=30000)
+    path = asset_path(str(tmpdir), {'tag_name': 'v1.0.0'}, asset())
+
+    client = client_with(server)
+    result = fetch(client, asset(), path, chunk_size=4096)
+
+    assert result.action == 'fetched'
+    assert client.stats['retries'] == 1
+    assert open(path, 'rb').read() == DATA
+    assert [r.headers.get('Range') for r in server.sent] == [None, 'bytes=30000-']
+    assert server.sent[0].headers['Accept'] == 'application/octet-stream'
+    assert not os.path.exists(path + '.part')
+
+
+def test_unchanged_files_are_skipped_and_partial_ones_resumed(tmpdir):
+    path = str(tmpdir.join('widget.tar.gz'))
+    fetch(client_with(AssetServer()), asset(), path)
+
+    server = AssetServer()
+    assert fetch(client_with(server), asset(), path).action == 'unchanged'
+    assert server.sent == []
+
+    os.remove(path)
+    with open(path + '.part', 'wb') as f:
+        f.write(DATA[:60000])
+    result = fetch(client_with(server), asset(), path)
+    assert (result.action, result.offset) == ('resumed', 60000)
+    assert server.sent[0].headers['Range'] == 'bytes=60000-'
+    assert open(path, 'rb').read() == DATA
+
+
+def test_servers_ignoring_ranges_start_over(tmpdir):
+    path = str(tmpdir.join('widget.tar.gz'))
+    with open(path + '.part', 'wb') as f:
+        f.write(b'stale')
+
+    result = fetch(client_with(AssetServer(ranges=False)), asset(), path)
+
+    assert result.action == 'fetched'
+    assert open(path, 'rb').read() == DATA
+
+
+def test_corrupt_download_is_thrown_away(tmpdir):
+    path = str(tmpdir.join('widget.tar.gz'))
+
+    with pytest.raises(DownloadError):
+        fetch(client_with(AssetServer()), asset(digest='sha256:' + '0' * 64), path)
+
+    assert not os.path.exists(path)
+    assert not os.path.exists(path + '.part')
+
+
+def test_broken_downloads_are_retried_within_the_retry_budget(tmpdir):
+    server = AssetServer(break_after=30000)
+    client = client_with(server, retry_budget=0)
+
+    with pytest.raises(requests.exceptions.ConnectionError):
+        fetch(client, asset(), str(tmpdir.join('widget.tar.gz')))
+    assert len(server.sent) == 1
+    assert client.stats['failures'] == 1
+    assert os.path.getsize(str(tmpdir.join('widget.tar.gz.part'))) == 30000
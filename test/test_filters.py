@@ -0,0 +1,51 @@
+import pytest
+
+from github_macros.filters import Filter, FilterError
+from github_macros.models.github import GithubOrganization, GithubRepository, GithubUser
+
+
+def repo(name, **kwargs):
+    kwargs.setdefault('owner', {'login': 'acme', 'type': 'Organization'})
+    return GithubRepository(None, 'acme/' + name, **kwargs)
+
+
+WIDGET = repo('widget', language='Go', pushed_at='2026-03-01T10:00:00Z', archived=False, fork=False, size=300)
+OLD = repo('old-thing', language='Python', pushed_at='2019-06-01T10:00:00Z', archived=True, fork=False)
+FORK = repo('forked', language='Ruby', pushed_at='2026-02-01T10:00:00Z', fork=True, topics=['mirror', 'vendor'])
+
+
+def matching(expr):
+    where = Filter(expr)
+    return [r.name for r in (WIDGET, OLD, FORK) if where(r)]
+
+
+def test_boolean_logic_and_comparisons():
+    assert matching('not archived and not fork') == ['widget']
+    assert matching('pushed > 2026-01-01') == ['widget', 'forked']
+    assert matching('language in (go, Python)') == ['widget', 'old-thing']
+    assert matching('language not in (Go)') == ['old-thing', 'forked']
+    assert matching('archived or (fork and topics in (vendor))') == ['old-thing', 'forked']
+    assert matching('name ~ "*thing" or size >= 300') == ['widget', 'old-thing']
+    assert matching('owner = ACME and not (language = ruby)') == ['widget', 'old-thing']
+
+
+def test_invalid_expressions_are_rejected_up_front():
+    for expr in ('', 'not', 'colour = red', 'language in Go', 'archived and', 'size > 1 size',
+                 'mro', '__class__', 'fetch', 'refresh', 'http', 'branches'):
+        with pytest.raises(FilterError):
+            Filter(expr)
+
+
+def test_every_field_github_sends_can_be_filtered_on():
+    assert Filter('permissions and open_issues > 3').fields == set(['permissions', 'open_issues'])
+
+
+def test_pushdown_only_for_required_terms():
+    org = GithubOrganization(None, 'acme')
+    user = GithubUser(None, 'someone')
+
+    assert Filter('not fork and pushed >= 2026-01-01').api_params(org) == {'type': 'sources', 'sort': 'pushed', 'direction': 'desc'}
+    assert Filter('private and language = go').api_params(org) == {'type': 'private'}
+    assert Filter('not fork').api_params(user) == {}
+    assert Filter('not fork or pushed > 2026-01-01').api_params(org) == {}
+    assert Filter('not (fork and private)').api_params(org) == {}
@@ -0,0 +1,162 @@
+import http.client
+import os
+import threading
+
+import pytest
+
+from github_macros.git_server import GitServer, read_wants
+
+from sh.contrib import git
+
+COMMIT = ('-c', 'user.name=t', '-c', 'user.email=t@example.com', 'commit', '-q', '--allow-empty')
+
+
+class Upstream(object):
+    """
+    Stands in for GitHub and the rest of gh-refresh: clones or fetches into the mirror, counting how often
+    """
+
+    def __init__(self, tmpdir):
+        self.remote = str(tmpdir.join('remote', 'acme', 'widget'))
+        self.base = str(tmpdir.join('mirror'))
+        self.updates = []
+        self.gate = threading.Event()
+        self.gate.set()
+        git('init', '-q', self.remote)
+        self.commit('first')
+
+    def commit(self, message):
+        git('-C', self.remote, *(COMMIT + ('-m', message)))
+        return str(git('-C', self.remote, 'rev-parse', 'HEAD')).strip()
+
+    def refresh(self, host, full_name):
+        if full_name.lower() != 'acme/widget':
+            return None
+        self.gate.wait()
+        self.updates.append(full_name)
+        path = os.path.join(self.base, 'Acme', 'widget')
+        if os.path.exists(path):
+            git('-C', path, 'fetch', '-q', 'origin')
+        else:
+            git('clone', '-q', self.remote, path)
+        return path
+
+
+@pytest.fixture
+def upstream(tmpdir):
+    return Upstream(tmpdir)
+
+
+@pytest.fixture
+def server(upstream):
+    httpd = GitServer(('127.0.0.1', 0), upstream.base, upstream.refresh, max_age=3600, owners=set(['acme']))
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    httpd.url = 'http://127.0.0.1:{}'.format(httpd.server_port)
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def log(path):
+    return str(git('-C', path, 'log', '--format=%s', 'origin/HEAD')).split()
+
+
+def test_wants_are_read_from_either_protocol():
+    v0 = b'0032want ' + b'a' * 40 + b'\n' + b'0032want ' + b'b' * 40 + b'\n00000009done\n'
+    v2 = b'0012command=fetch\n0001000ethin-pack\n0032want ' + b'c' * 40 + b'\n0000'
+    assert read_wants(v0) == ['a' * 40, 'b' * 40]
+    assert read_wants(v2) == ['c' * 40]
+
+
+def test_a_miss_is_cloned_then_served_from_the_mirror(upstream, server, tmpdir):
+    git('clone', '-q', server.url + '/acme/Widget.git', str(tmpdir.join('one')))
+    git('clone', '-q', server.url + '/acme/widget', str(tmpdir.join('two')))
+
+    assert log(str(tmpdir.join('one'))) == log(str(tmpdir.join('two'))) == ['first']
+    assert upstream.updates == ['acme/Widget']
+    with pytest.raises(Exception):
+        git('clone', '-q', server.url + '/acme/gadget', str(tmpdir.join('three')))
+
+
+def test_a_commit_the_mirror_lacks_is_fetched_for(upstream, server, tmpdir):
+    checkout = str(tmpdir.join('checkout'))
+    git('clone', '-q', server.url + '/acme/widget', checkout)
+    sha = upstream.commit('second')
+
+    git('-C', checkout, 'fetch', '-q', 'origin', sha)
+
+    assert str(git('-C', checkout, 'log', '-1', '--format=%s', sha)).strip() == 'second'
+    assert len(upstream.updates) == 2
+
+
+def test_stale_refs_are_updated_before_listing(upstream, server, tmpdir):
+    checkout = str(tmpdir.join('checkout'))
+    git('clone', '-q', server.url + '/acme/widget', checkout)
+    upstream.commit('second')
+    server.max_age = 0
+
+    git('-C', checkout, 'fetch', '-q', 'origin')
+
+    assert log(checkout) == ['second', 'first']
+
+
+def test_concurrent_misses_update_once(upstream, server, tmpdir):
+    upstream.gate.clear()
+    clones = [threading.Thread(target=git, args=('clone', '-q', server.url + '/acme/widget', str(tmpdir.join(str(n)))))
+              for n in range(4)]
+    for thread in clones:
+        thread.start()
+    while server.stats['requests'] < 4:
+        threading.Event().wait(0.05)
+    threading.Event().wait(0.2)  # Past counting, into waiting on the update
+    upstream.gate.set()
+    for thread in clones:
+        thread.join()
+
+    assert upstream.updates == ['acme/widget']
+    assert server.stats['coalesced'] == 3
+    assert all(log(str(tmpdir.join(str(n)))) == ['first'] for n in range(4))
+
+
+def test_pushes_are_turned_away(upstream, server, tmpdir):
+    checkout = str(tmpdir.join('checkout'))
+    git('clone', '-q', server.url + '/acme/widget', checkout)
+    git('-C', checkout, *(COMMIT + ('-m', 'local')))
+
+    with pytest.raises(Exception):
+        git('-C', checkout, 'push', '-q', 'origin', 'HEAD')
+
+
+def fetched(path):
+    # Fresh enough not to be updated before it's served
+    open(os.path.join(path, '.git', 'FETCH_HEAD'), 'w').close()
+    return path
+
+
+def get(server, path):
+    connection = http.client.HTTPConnection('127.0.0.1', server.server_port)
+    connection.request('GET', path)
+    return connection.getresponse().status
+
+
+def test_nothing_outside_the_mirror_is_served(upstream, server, tmpdir):
+    secret = str(tmpdir.join('secret'))
+    git('clone', '-q', upstream.remote, secret)
+    fetched(secret)
+    os.makedirs(os.path.join(upstream.base, 'acme'))
+    os.symlink(secret, os.path.join(upstream.base, 'acme', 'linked'))
+
+    for path in ('/../secret', '/acme/..', '/acme/../../secret', '/acme/linked'):
+        assert get(server, path + '/info/refs?service=git-upload-pack') == 404
+    assert not os.path.exists(os.path.join(secret, '.git', 'refs', 'namespaces'))
+    assert upstream.updates == []
+
+
+def test_only_mirrored_owners_are_served(upstream, server, tmpdir):
+    git('clone', '-q', upstream.remote, os.path.join(upstream.base, 'other', 'widget'))
+    fetched(os.path.join(upstream.base, 'other', 'widget'))
+
+    assert get(server, '/other/widget/info/refs?service=git-upload-pack') == 404
+    assert get(server, '/acme/widget/info/refs?service=git-upload-pack') == 200
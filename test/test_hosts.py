@@ -0,0 +1,30 @@
+from github_macros.hosts import HostClients, qualify, split_host, split_tokens
+
+
+def test_names_are_on_the_default_host_unless_qualified(monkeypatch):
+    monkeypatch.delenv('GITHUB_DOMAIN', raising=False)
+    assert split_host('acme') == ('github.com', 'acme')
+    assert split_host('GHE.example.com:platform/api') == ('ghe.example.com', 'platform/api')
+    assert qualify('github.com', 'acme/widget') == 'acme/widget'
+    assert qualify('ghe.example.com', 'platform/api') == 'ghe.example.com:platform/api'
+
+    monkeypatch.setenv('GITHUB_DOMAIN', 'ghe.example.com')
+    assert split_host('platform') == ('ghe.example.com', 'platform')
+    assert qualify('github.com', 'acme/widget') == 'github.com:acme/widget'
+
+
+def test_tokens_go_to_the_host_they_name(monkeypatch):
+    monkeypatch.delenv('GITHUB_DOMAIN', raising=False)
+    assert split_tokens(['abc', 'someone:def', 'ghe.example.com=x-access-token:ghi']) == {
+        'github.com': ['abc', 'someone:def'],
+        'ghe.example.com': ['x-access-token:ghi'],
+    }
+
+
+def test_each_host_gets_one_client():
+    created = []
+    clients = HostClients(lambda host: created.append(host) or object())
+    assert clients.resolve('ghe.example.com:acme')[0] is clients.get('ghe.example.com')
+    assert 'ghe.example.com' in clients
+    assert 'github.com' not in clients
+    assert created == ['ghe.example.com']
@@ -0,0 +1,261 @@
+import time
+
+import pytest
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+
+from github_macros.http import GithubHttp
+from github_macros.proxy import UnixSocketAdapter
+
+
+class FakeAdapter(BaseAdapter):
+    """
+    Serves canned (status, headers, body) responses in order, recording each request sent
+    """
+
+    def __init__(self, responses):
+        super(FakeAdapter, self).__init__()
+        self.responses = list(responses)
+        self.sent = []
+        self.options = []
+
+    def send(self, request, **kwargs):
+        self.sent.append(request)
+        self.options.append(kwargs)
+        status, headers, body = self.responses.pop(0)
+        if isinstance(status, Exception):
+            raise status
+        resp = requests.Response()
+        resp.status_code = status
+        resp.headers.update(headers)
+        resp._content = body.encode('utf-8')
+        resp.request = request
+        resp.url = request.url
+        return resp
+
+    def close(self):
+        pass
+
+
+def client_with(responses, **kwargs):
+    kwargs.setdefault('backoff', 0)
+    kwargs.setdefault('token', 'sometoken')
+    client = GithubHttp('someone', **kwargs)
+    adapter = FakeAdapter(responses)
+    client.mount('https://', adapter)
+    return client, adapter
+
+
+def test_get_retries_transient_failures():
+    client, adapter = client_with([
+        (502, {}, 'bad gateway'),
+        (requests.exceptions.ConnectionError('reset by peer'), None, None),
+        (200, {}, '{}'),
+    ])
+
+    resp = client.get('/orgs/example')
+
+    assert resp.status_code == 200
+    assert len(adapter.sent) == 3
+    assert client.stats['retries'] == 2
+
+
+def test_abuse_limit_is_retried_but_permission_denied_is_not():
+    client, adapter = client_with([
+        (403, {'Retry-After': '0'}, '{"message": "You have triggered an abuse detection mechanism."}'),
+        (403, {}, '{"message": "Must have admin rights to Repository."}'),
+    ])
+
+    resp = client.get('/repos/example/thing/branches/master/protection')
+
+    assert resp.status_code == 403
+    assert len(adapter.sent) == 2
+
+
+def test_post_is_not_retried_by_default():
+    client, adapter = client_with([
+        (502, {}, 'bad gateway'),
+    ])
+
+    resp = client.post('/graphql', json={})
+
+    assert resp.status_code == 502
+    assert len(adapter.sent) == 1
+
+
+def test_retry_budget_is_shared_across_requests():
+    client, adapter = client_with([
+        (503, {}, ''),
+        (200, {}, '{}'),
+        (503, {}, ''),
+    ], retry_budget=1)
+
+    assert client.get('/one').status_code == 200
+    assert client.get('/two').status_code == 503
+    assert client.stats['retries'] == 1
+    assert client.stats['failures'] == 1
+
+
+def test_token_pool_prefers_the_token_with_most_budget_left():
+    client, adapter = client_with([
+        (200, {'X-RateLimit-Remaining': '10'}, '{}'),
+        (200, {'X-RateLimit-Remaining': '4000'}, '{}'),
+        (200, {}, '{}'),
+    ], token=['someone:first', 'someone:second'])
+
+    client.get('/one')
+    client.get('/two')
+    client.get('/three')
+
+    used = [r.headers['Authorization'] for r in adapter.sent]
+    assert used[0] != used[1]
+    assert used[2] == used[1]
+
+
+def test_token_pool_sends_writes_to_a_token_with_the_scopes_they_need():
+    client, adapter = client_with([
+        (200, {'X-RateLimit-Remaining': '4000', 'X-OAuth-Scopes': 'read:org'}, '{}'),
+        (200, {'X-RateLimit-Remaining': '10', 'X-OAuth-Scopes': 'repo, admin:org'}, '{}'),
+        (200, {}, '{}'),
+        (200, {}, '{}'),
+        (200, {}, '{}'),
+    ], token=['someone:reader', 'someone:admin'])
+    client.get('/one')
+    client.get('/two')
+
+    client.put('/repos/acme/widget/branches/main/protection', json={}, scopes=('repo',))
+    client.get('/three')
+    client.put('/repos/acme/widget/topics', json={}, scopes=('public_repo',))  # Comes with "repo"
+
+    used = [r.headers['Authorization'] for r in adapter.sent]
+    assert used[2] == used[1]
+    assert used[3] == used[0]
+    assert used[4] == used[1]
+
+
+def test_rejected_token_is_dropped_and_call_replayed():
+    client, adapter = client_with([
+        (401, {}, '{"message": "Bad credentials"}'),
+        (200, {}, '{}'),
+    ], token=['someone:revoked', 'x-access-token:installation'])
+
+    resp = client.get('/orgs/example')
+
+    assert resp.status_code == 200
+    assert len(client.tokens) == 1
+    assert client.stats['dropped_tokens'] == 1
+
+
+def test_switching_from_spent_tokens_is_bounded():
+    # GitHub says the window reset a minute ago by our clock, but it hasn't on GitHub's
+    spent = (403, {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': str(int(time.time()) - 60)}, '{}')
+    client, adapter = client_with([spent] * 20, token=['someone:first', 'someone:second'], max_retries=2)
+
+    assert client.get('/orgs/example').status_code == 403
+    # One switch to the other token, then retries up to max_retries as neither has budget left
+    assert len(adapter.sent) == 4
+    assert client.stats['retries'] == 3
+
+
+def test_token_switches_count_against_the_retry_budget():
+    spent = (403, {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': str(int(time.time()) + 3600)}, '{}')
+    client, adapter = client_with([spent, (200, {}, '{}')], token=['someone:first', 'someone:second'], retry_budget=0)
+    assert client.get('/orgs/example').status_code == 403
+    assert len(adapter.sent) == 1
+
+    client, adapter = client_with([(401, {}, '{}'), (200, {}, '{}')], token=['someone:revoked', 'someone:other'],
+                                  retry_budget=0)
+    assert client.get('/orgs/example').status_code == 401
+    assert len(adapter.sent) == 1
+
+
+def test_listings_follow_next_links_a_page_at_a_time():
+    client, adapter = client_with([
+        (200, {'Link': '<https://api.github.com/orgs/acme/repos?per_page=100&page=2>; rel="next"'}, '[1, 2]'),
+        (200, {'Link': '<https://api.github.com/orgs/acme/repos?per_page=100&page=1>; rel="prev"'}, '[3]'),
+    ])
+
+    items = client.paginate('/orgs/acme/repos', params={'type': 'sources'})
+    assert next(items) == 1
+    assert len(adapter.sent) == 1  # The next page isn't asked for until it's needed
+    assert list(items) == [2, 3]
+    assert [r.url for r in adapter.sent] == ['https://api.github.com/orgs/acme/repos?type=sources&per_page=100',
+                                             'https://api.github.com/orgs/acme/repos?per_page=100&page=2']
+
+
+def test_listings_that_are_missing_are_empty_but_a_page_that_fails_is_raised():
+    client, adapter = client_with([(404, {}, '{"message": "Not Found"}')])
+    assert list(client.paginate('/orgs/gone/repos')) == []
+
+    client, adapter = client_with([
+        (200, {'Link': '<https://api.github.com/orgs/acme/repos?page=2>; rel="next"'}, '[1]'),
+        (404, {}, '{"message": "Not Found"}'),
+    ])
+    items = client.paginate('/orgs/acme/repos')
+    assert next(items) == 1
+    with pytest.raises(requests.HTTPError):
+        next(items)
+
+
+def test_concurrency_starts_at_the_pool_size_and_backs_off_when_the_server_pushes_back():
+    client, adapter = client_with([(200, {}, '{}')] * 4 + [(502, {}, 'bad gateway'), (200, {}, '{}')], pool_size=20)
+    for _ in range(4):
+        client.get('/orgs/example')
+    assert client.concurrency.limit == 20
+
+    client.get('/orgs/example')
+    assert int(client.concurrency.limit) == 10  # Then grows back a little with the retry that went through
+    assert client.concurrency.backoffs == 1
+
+
+def test_concurrency_holds_on_a_dropped_connection():
+    client, adapter = client_with([
+        (requests.exceptions.ConnectionError('reset by peer'), None, None),
+        (requests.exceptions.ReadTimeout('read timed out'), None, None),
+        (200, {}, '{}'),
+    ], pool_size=20)
+
+    assert client.get('/orgs/example').status_code == 200
+    assert client.concurrency.limit == 20
+    assert client.concurrency.backoffs == 0
+
+
+def test_connection_pool_is_sized_for_every_scheme():
+    client = GithubHttp('someone', 'sometoken', pool_size=32)
+
+    for url in ('https://api.github.com/orgs/acme', 'http://ghe.example.com/api/v3'):
+        adapter = client.get_adapter(url)
+        assert type(adapter) is HTTPAdapter
+        assert adapter.poolmanager.connection_pool_kw['maxsize'] == 32
+        assert adapter.poolmanager.pools._maxsize == 32
+    assert client.get_adapter('https://api.github.com') is client.get_adapter('http://api.github.com')
+
+
+def test_proxy_socket_is_mounted_with_the_pool_size():
+    client = GithubHttp('someone', 'sometoken', pool_size=16, proxy_socket='/run/gh-proxy.sock')
+
+    adapter = client.get_adapter('https://api.github.com/orgs/acme')
+    assert isinstance(adapter, UnixSocketAdapter)
+    assert adapter.poolmanager.connection_pool_kw['maxsize'] == 16
+
+
+def test_timeouts_and_headers_are_applied_to_every_call():
+    client, adapter = client_with([(200, {}, '{}')] * 2, connect_timeout=3.0, read_timeout=30.0,
+                                  compression=False, keep_alive=False)
+
+    client.get('/orgs/acme')
+    client.get('/orgs/acme', timeout=5)
+
+    assert [o['timeout'] for o in adapter.options] == [(3.0, 30.0), 5]
+    assert adapter.sent[0].headers['Accept-Encoding'] == 'identity'
+    assert adapter.sent[0].headers['Connection'] == 'close'
+
+
+def test_no_call_outlives_the_deadline():
+    client, adapter = client_with([(200, {}, '{}')], read_timeout=600.0, deadline=60)
+
+    client.get('/orgs/acme')
+
+    connect, read = adapter.options[0]['timeout']
+    assert connect == 10.0
+    assert 55 < read <= 60
@@ -0,0 +1,61 @@
+import pytest
+
+from github_macros.inventory import Snapshot, SnapshotMiss, offline_client
+from github_macros.models.github import GithubOrganization, GithubRepository
+
+PROTECTION = {
+    'required_pull_request_reviews': {'dismiss_stale_reviews': True},
+    'enforce_admins': {'enabled': True},
+    'required_status_checks': {'strict': True, 'contexts': ['ci/jenkins']},
+    'restrictions': None,
+}
+
+
+def repo(name, pushed_at, fork=False):
+    return GithubRepository.deserialize(None, {
+        'name': name.split('/')[1], 'full_name': name, 'owner': {'login': name.split('/')[0], 'type': 'Organization'},
+        'ssh_url': 'git@github.com:{}.git'.format(name), 'pushed_at': pushed_at, 'fork': fork, 'size': 10,
+    })
+
+
+@pytest.fixture
+def client(tmpdir):
+    snapshot = Snapshot()
+    snapshot.add_owner('acme', 'Organization', teams=True)
+    widget = snapshot.add_repository(repo('acme/widget', '2026-03-01T00:00:00Z'))
+    snapshot.add_repository(repo('acme/gadget', '2026-05-01T00:00:00Z', fork=True))
+    snapshot.add_branch(widget, {'name': 'master', 'protected': True}, PROTECTION)
+    snapshot.add_branch(widget, {'name': 'feature/x', 'protected': False})
+    team = snapshot.add_team('acme', {'id': 7, 'slug': 'devs', 'name': 'Devs'})
+    snapshot.add_team_repository(team, widget, 'push')
+
+    path = str(tmpdir.join('inventory.json.gz'))
+    snapshot.save(path)
+    return offline_client(path)
+
+
+def test_models_read_from_the_snapshot(client):
+    org = GithubOrganization(client, 'acme')
+    assert [r.full_name for r in org.iter_repositories(params={'sort': 'pushed', 'direction': 'desc'})] == \
+        ['acme/gadget', 'acme/widget']
+    assert [r.full_name for r in org.iter_repositories(params={'type': 'sources'})] == ['acme/widget']
+
+    widget = GithubRepository.fetch(client, 'acme/widget')
+    assert widget.clone_url == 'git@github.com:acme/widget.git'
+    protections = dict((branch.name, branch.protection) for branch in widget.branches)
+    assert protections['master'].contexts == ['ci/jenkins']
+    assert protections['master'].except_admins is False
+    assert protections['feature/x'].required_code_review is False
+
+
+def test_team_permissions_are_answered_like_the_api(client):
+    headers = {'Accept': 'application/vnd.github.v3.repository+json'}
+    assert client.get('/teams/7/repos/acme/widget', headers=headers).json()['permissions']['push'] is True
+    assert client.get('/teams/7/repos/acme/gadget', headers=headers).status_code == 404
+
+
+def test_nothing_leaves_the_snapshot(client):
+    with pytest.raises(SnapshotMiss):
+        client.get('/orgs/someone-else/repos')
+    with pytest.raises(SnapshotMiss):
+        client.put('/teams/7/repos/acme/gadget', json={'permission': 'push'})
@@ -0,0 +1,30 @@
+from github_macros.journal import Journal
+
+
+def test_resumed_journal_remembers_finished_work(tmpdir):
+    path = str(tmpdir.join('journal'))
+    with Journal(path, resume=False) as journal:
+        journal.record('refresh', 'acme/widget', '2019-01-01')
+        journal.record('permit', '42:acme/widget', 'push')
+
+    with open(path, 'a') as f:
+        f.write('{"op": "refresh", "key": "acme/gadget", "fing')  # torn by a crash
+
+    with Journal(path, resume=True) as journal:
+        assert journal.done('refresh', 'acme/widget', '2019-01-01')
+        assert not journal.done('refresh', 'acme/widget', '2019-02-02')
+        assert not journal.done('refresh', 'acme/gadget', '2019-01-01')
+        assert journal.done('permit', '42:acme/widget', 'push')
+        journal.record('refresh', 'acme/gadget', '2019-01-01')
+
+    with Journal(path, resume=True) as journal:
+        assert journal.done('refresh', 'acme/gadget', '2019-01-01')
+
+
+def test_fresh_journal_starts_over(tmpdir):
+    path = str(tmpdir.join('journal'))
+    with Journal(path, resume=False) as journal:
+        journal.record('refresh', 'acme/widget', '2019-01-01')
+
+    with Journal(path, resume=False) as journal:
+        assert not journal.done('refresh', 'acme/widget', '2019-01-01')
@@ -0,0 +1,62 @@
+import os
+
+from github_macros import maintenance
+
+from sh.contrib import git
+
+
+def make_repo(path, fetches):
+    """
+    A repository the way a mirror ends up after a few updates: one new pack per fetch
+    """
+    git('init', '-q', path)
+    for n in range(fetches):
+        with open(os.path.join(path, 'file'), 'w') as f:
+            f.write(str(n))
+        git('-C', path, 'add', 'file')
+        git('-C', path, '-c', 'user.name=t', '-c', 'user.email=t@example.com', 'commit', '-q', '-m', str(n))
+        git('-C', path, 'repack', '-d', '-q')
+    return path
+
+
+def packs(path):
+    return set(os.listdir(os.path.join(path, '.git', 'objects', 'pack')))
+
+
+def test_repository_with_many_packs_is_repacked_incrementally(tmpdir):
+    path = make_repo(str(tmpdir.join('widget')), fetches=4)
+    counts = maintenance.count_objects(path)
+    assert counts.packs == 4
+    assert counts.loose == 0
+
+    tasks = maintenance.plan(path, counts, max_packs=3)
+    assert tasks == ['incremental-repack', 'commit-graph']
+    before = packs(path)
+    for task in tasks:
+        maintenance.run(path, task)
+    # The packs rolled together stay for anything still reading them, until the next run
+    assert before < packs(path)
+    for task in tasks:
+        maintenance.run(path, task)
+
+    assert not before <= packs(path)
+    assert os.path.exists(os.path.join(path, '.git', 'objects', 'info', 'commit-graphs', 'commit-graph-chain'))
+    assert maintenance.plan(path, maintenance.count_objects(path), max_packs=5) == []
+
+
+def test_loose_objects_are_packed(tmpdir):
+    path = make_repo(str(tmpdir.join('widget')), fetches=0)
+    for n in range(5):
+        git('-C', path, 'hash-object', '-w', '--stdin', _in='blob {}'.format(n))
+
+    counts = maintenance.count_objects(path)
+    assert counts.loose == 5
+    assert maintenance.plan(path, counts, max_loose=10) == []
+    assert maintenance.plan(path, counts, max_loose=5) == ['loose-objects']
+    # Too few of them, but too big
+    assert counts.loose_kb > 0
+    assert maintenance.plan(path, counts, max_loose=10, max_loose_kb=counts.loose_kb) == ['loose-objects']
+    assert maintenance.plan(path, counts, max_loose=10, max_loose_kb=0) == []
+
+    maintenance.run(path, 'loose-objects')
+    assert maintenance.count_objects(path).loose == 0
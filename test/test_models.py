@@ -0,0 +1,132 @@
+import json
+
+import pytest
+
+from github_macros.http import GraphQLError
+from github_macros.models.github import GithubOrganization, GithubUser
+
+from test.test_http import client_with
+
+NEXT = '<https://api.github.com/orgs/acme/events?per_page=100&page={}>; rel="next"'
+
+
+def events(*ids):
+    return json.dumps([{'id': str(n), 'type': 'PushEvent', 'repo': {'name': 'acme/widget'}} for n in ids])
+
+
+def test_the_first_poll_only_finds_where_the_feed_is():
+    client, adapter = client_with([
+        (200, {'ETag': 'W/"one"', 'X-Poll-Interval': '90', 'Link': NEXT.format(2)}, events(12, 11)),
+    ])
+
+    poll = GithubOrganization(client, 'acme').poll_events()
+
+    assert [e['id'] for e in poll.events] == ['12', '11']
+    assert (poll.etag, poll.poll_interval, poll.complete) == ('W/"one"', 90, True)
+    assert len(adapter.sent) == 1
+    assert adapter.sent[0].url == 'https://api.github.com/orgs/acme/events?per_page=100'
+    assert 'If-None-Match' not in adapter.sent[0].headers
+
+
+def test_an_unchanged_feed_is_a_cheap_not_modified():
+    client, adapter = client_with([(304, {'X-Poll-Interval': '120'}, '')])
+
+    poll = GithubUser(client, 'someone').poll_events(etag='W/"one"', since=12)
+
+    assert poll == ([], 'W/"one"', 120, True)
+    assert adapter.sent[0].headers['If-None-Match'] == 'W/"one"'
+    assert adapter.sent[0].url == 'https://api.github.com/users/someone/events?per_page=100'
+
+
+def test_new_events_are_read_back_to_the_last_one_seen():
+    client, adapter = client_with([
+        (200, {'ETag': 'W/"two"', 'Link': NEXT.format(2)}, events(16, 15)),
+        (200, {'Link': NEXT.format(3)}, events(14, 13, 12, 11)),
+    ])
+
+    poll = GithubOrganization(client, 'acme').poll_events(etag='W/"one"', since=12)
+
+    assert [e['id'] for e in poll.events] == ['16', '15', '14', '13']
+    assert (poll.etag, poll.poll_interval, poll.complete) == ('W/"two"', 60, True)
+    assert len(adapter.sent) == 2
+
+
+def test_running_out_of_feed_before_the_last_event_seen_is_incomplete():
+    client, adapter = client_with([
+        (200, {'ETag': 'W/"two"', 'Link': NEXT.format(2)}, events(400, 399)),
+        (200, {}, events(398)),
+    ])
+
+    poll = GithubOrganization(client, 'acme').poll_events(since=12)
+
+    assert [e['id'] for e in poll.events] == ['400', '399', '398']
+    assert not poll.complete
+
+
+def test_an_owner_without_a_feed_has_no_events():
+    client, adapter = client_with([(404, {}, '{"message": "Not Found"}')])
+
+    assert GithubOrganization(client, 'gone').poll_events(etag='W/"one"') == ([], None, 60, True)
+
+
+def node(name, disk_usage=10):
+    return {'name': name.split('/')[1], 'nameWithOwner': name, 'diskUsage': disk_usage,
+            'owner': {'login': name.split('/')[0], '__typename': 'Organization'}}
+
+
+def page(names, cursor=None):
+    return json.dumps({'data': {'repositoryOwner': {'repositories': {
+        'pageInfo': {'hasNextPage': cursor is not None, 'endCursor': cursor},
+        'nodes': [node(name) for name in names],
+    }}}})
+
+
+def sent(request):
+    return json.loads(request.body.decode('utf-8'))
+
+
+def test_graphql_listings_follow_the_cursor_asking_for_only_the_fields_given():
+    client, adapter = client_with([
+        (200, {}, page(['acme/widget', 'acme/gadget'], cursor='Y3Vyc29yOjI=')),
+        (200, {}, page(['acme/sprocket'])),
+    ])
+
+    repos = list(GithubOrganization(client, 'acme').iter_repositories(fields=['size'], params={'type': 'sources'}))
+
+    assert [(r.full_name, r.size, r.owner.name) for r in repos] == [
+        ('acme/widget', 10, 'acme'), ('acme/gadget', 10, 'acme'), ('acme/sprocket', 10, 'acme')]
+    assert repos[0].description is None  # Not asked for
+    assert [r.url for r in adapter.sent] == ['https://api.github.com/graphql'] * 2
+    assert [sent(r)['variables'] for r in adapter.sent] == [{'login': 'acme', 'cursor': None},
+                                                           {'login': 'acme', 'cursor': 'Y3Vyc29yOjI='}]
+    query = sent(adapter.sent[0])['query']
+    assert 'diskUsage' in query and 'nameWithOwner' in query and 'isFork: false' in query
+    assert 'description' not in query
+
+
+def test_graphql_listing_of_an_unknown_owner_is_empty():
+    client, adapter = client_with([(200, {}, json.dumps({'data': {'repositoryOwner': None}}))])
+
+    assert list(GithubUser(client, 'gone').iter_repositories(fields=['size'])) == []
+
+
+def test_graphql_errors_are_raised_part_way_through_a_listing():
+    client, adapter = client_with([
+        (200, {}, page(['acme/widget'], cursor='Y3Vyc29yOjE=')),
+        (200, {}, json.dumps({'data': None, 'errors': [{'type': 'RATE_LIMITED', 'message': 'API rate limit exceeded'}]})),
+    ])
+    repos = GithubOrganization(client, 'acme').iter_repositories(fields=['size'])
+
+    assert next(repos).full_name == 'acme/widget'
+    with pytest.raises(GraphQLError) as e:
+        next(repos)
+    assert e.value.errors[0]['type'] == 'RATE_LIMITED'
+    assert str(e.value) == 'API rate limit exceeded'
+
+
+def test_graphql_listings_refuse_fields_they_cant_fetch():
+    client, adapter = client_with([])
+
+    with pytest.raises(ValueError):
+        list(GithubOrganization(client, 'acme').iter_repositories(fields=['size', 'permissions']))
+    assert adapter.sent == []
@@ -0,0 +1,51 @@
+import argparse
+import json
+
+import pytest
+
+from github_macros.models.github import GithubRepository
+from github_macros.policy import PolicySet
+
+
+def load(tmpdir, policies):
+    path = tmpdir.join('policy.json')
+    path.write(json.dumps({'policies': policies}))
+    return PolicySet.load(str(path))
+
+
+def test_policies_cover_matching_repositories_and_branches(tmpdir):
+    policies = load(tmpdir, [
+        {'name': 'services', 'repositories': ['acme/svc-*'], 'branches': ['master', 'release/*'], 'code-review': True},
+        {'name': 'all', 'branches': ['master'], 'enforce-for-admins': True},
+    ])
+    service = policies.for_repository(GithubRepository(None, 'Acme/svc-billing'))
+    library = policies.for_repository(GithubRepository(None, 'acme/lib'))
+
+    assert [p.name for p in service] == ['services', 'all']
+    assert [p.name for p in library] == ['all']
+    assert [p.name for p in policies.for_branch(service, 'release/2.0')] == ['services']
+    assert policies.for_branch(library, 'feature/x') == []
+    # Branch names are git's, where case matters, unlike GitHub's repository names
+    assert policies.for_branch(service, 'Release/2.0') == []
+    assert [p.name for p in policies.for_branch(library, 'master')] == ['all']
+    assert policies.for_branch(library, 'Master') == []
+
+
+def test_rules_read_like_the_command_line_flags(tmpdir):
+    services = list(load(tmpdir, [{'name': 'services', 'branches': ['master'], 'ci-check': 'ci/jenkins',
+                                   'enforce_for_admins': True}]))[0]
+    # Rules checked exactly as --ci-check ci/jenkins --enforce-for-admins would be
+    assert services.options.contexts == ['ci/jenkins']
+    assert services.options.except_admins is False
+    assert services.options.require_code_review is None
+
+
+@pytest.mark.parametrize('policy', [
+    {'name': 'typo', 'branches': ['master'], 'code-reveiw': True},
+    {'name': 'no branches', 'code-review': True},
+    {'name': 'not a flag', 'branches': ['master'], 'restrict-push': 'yes'},
+])
+def test_mistakes_are_reported_up_front(tmpdir, policy):
+    with pytest.raises(argparse.ArgumentTypeError) as e:
+        load(tmpdir, [policy])
+    assert policy['name'] in str(e.value)
@@ -0,0 +1,111 @@
+import json
+import threading
+import time
+
+import pytest
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from github_macros.http import GithubHttp
+from github_macros.proxy import ProxyServer
+
+
+class GithubLike(BaseHTTPRequestHandler):
+    """
+    Answers with ETags (and 304s for a matching one), slowly, counting what it's sent
+    """
+    protocol_version = 'HTTP/1.1'
+    calls = []
+    remaining = 5000
+
+    def do_GET(self):
+        GithubLike.calls.append((self.path, self.headers.get('If-None-Match')))
+        time.sleep(0.1)
+        etag = '"{}"'.format(self.path)
+        headers = {'X-RateLimit-Remaining': str(GithubLike.remaining), 'X-RateLimit-Reset': str(int(time.time()) + 3600)}
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            body = b''
+        else:
+            self.send_response(200)
+            body = json.dumps({'path': self.path}).encode('utf-8')
+            headers.update({'ETag': etag, 'Content-Type': 'application/json'})
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(server):
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+
+@pytest.fixture
+def upstream():
+    GithubLike.calls = []
+    GithubLike.remaining = 5000
+    httpd = HTTPServer(('127.0.0.1', 0), GithubLike)
+    serve(httpd)
+    yield 'http://127.0.0.1:{}'.format(httpd.server_port)
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def proxy(tmpdir):
+    server = ProxyServer(str(tmpdir.join('gh-proxy.sock')))
+    serve(server)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def client_of(proxy):
+    return GithubHttp('someone', 'sometoken', max_retries=0, proxy_socket=proxy.path)
+
+
+def test_repeated_reads_are_revalidated(upstream, proxy):
+    first = client_of(proxy).get(upstream + '/orgs/acme')
+    second = client_of(proxy).get(upstream + '/orgs/acme')
+
+    assert first.json() == second.json() == {'path': '/orgs/acme'}
+    assert second.status_code == 200
+    assert GithubLike.calls == [('/orgs/acme', None), ('/orgs/acme', '"/orgs/acme"')]
+    assert proxy.stats['revalidated'] == 1
+
+
+def test_identical_reads_in_flight_go_to_github_once(upstream, proxy):
+    results = []
+
+    def read():
+        results.append(client_of(proxy).get(upstream + '/orgs/acme/repos').json())
+
+    threads = [threading.Thread(target=read) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == [{'path': '/orgs/acme/repos'}] * 5
+    assert len(GithubLike.calls) == 1
+    assert proxy.stats['coalesced'] == 4
+
+
+def test_spent_tokens_are_held_back_for_every_process(upstream, proxy):
+    GithubLike.remaining = 0
+    assert client_of(proxy).get(upstream + '/orgs/acme').status_code == 200
+
+    stale = client_of(proxy).get(upstream + '/orgs/acme')
+    held = client_of(proxy).get(upstream + '/orgs/other')
+
+    assert stale.json() == {'path': '/orgs/acme'}
+    assert held.status_code == 403
+    assert held.headers['X-RateLimit-Remaining'] == '0'
+    assert len(GithubLike.calls) == 1
+    assert proxy.stats['held'] == 2
@@ -0,0 +1,101 @@
+import argparse
+
+from github_macros.models.github import GithubBranch, GithubBranchProtection, GithubRepository
+from github_macros.policy import Policy
+from github_macros.remediation import desired_settings, plan
+
+
+class NoHttp(object):
+    def get(self, url, **kwargs):
+        raise AssertionError('Unexpected request for {}'.format(url))
+
+
+def protection(**state):
+    branch = GithubBranch(NoHttp(), 'master', repository=GithubRepository(None, 'acme/widget'))
+    current = GithubBranchProtection.__new__(GithubBranchProtection)
+    current.branch = branch
+    for name, value in dict(dict(enabled=True, contexts=[], dismissal_users=[], dismissal_teams=[],
+                                 push_users=[], push_teams=[]), **state).items():
+        setattr(current, name, value)
+    return current
+
+
+def policy(name, **rules):
+    options = dict(contexts=[], require_code_review=None, auto_dismiss_review=None, restrict_dismiss_review=None,
+                   dismiss_review_users=[], dismiss_review_teams=[], except_admins=None, branch_up_to_date=None,
+                   restrict_push=None, allowed_push_users=[], allowed_push_teams=[])
+    options.update(rules)
+    return Policy(name, ['*'], ['master'], argparse.Namespace(**options))
+
+
+def test_compliant_branches_need_no_writes():
+    current = protection(required_status_checks=True, up_to_date=True, contexts=['ci'], except_admins=False)
+    settings, _ = desired_settings([policy('p', branch_up_to_date=True, contexts=['ci'], except_admins=False)])
+
+    assert plan(current, settings) == []
+
+
+def test_only_the_settings_that_are_off_are_changed():
+    current = protection(required_status_checks=True, up_to_date=False, contexts=['ci'], required_code_review=True,
+                         except_admins=True)
+    settings, _ = desired_settings([policy('p', branch_up_to_date=True, except_admins=False),
+                                    policy('q', require_code_review=True, contexts=['lint'])])
+    changes = plan(current, settings)
+
+    assert [(c.method, c.path.rsplit('/protection', 1)[1], c.body) for c in changes] == [
+        ('PATCH', '/required_status_checks', {'strict': True, 'contexts': ['ci', 'lint']}),
+        ('POST', '/enforce_admins', None),
+    ]
+
+    # Checks bound to the app they have to come from stay bound to it
+    current.document = {'required_status_checks': {'strict': False, 'contexts': ['ci'],
+                                                   'checks': [{'context': 'ci', 'app_id': 15368}]}}
+    assert plan(current, settings)[0].body == {
+        'strict': True, 'checks': [{'context': 'ci', 'app_id': 15368}, {'context': 'lint'}]}
+
+
+def test_switching_on_a_whole_section_replaces_the_protection():
+    current = protection(enabled=False, except_admins=True)
+    settings, _ = desired_settings([policy('p', require_code_review=True, auto_dismiss_review=True)])
+    changes = plan(current, settings)
+
+    assert [c.method for c in changes] == ['PUT']
+    assert changes[0].body['required_pull_request_reviews'] == {'dismiss_stale_reviews': True}
+    assert changes[0].body['enforce_admins'] is False
+
+
+def test_conflicting_policies_leave_the_setting_alone():
+    settings, conflicts = desired_settings([policy('p', restrict_push=True), policy('q', restrict_push=False)])
+
+    assert conflicts == ['restrict_push']
+    assert plan(protection(push_restrictions=True), settings) == []
+
+
+def test_a_replacement_keeps_the_settings_it_doesnt_change():
+    document = {
+        'required_status_checks': {'strict': False, 'contexts': ['ci'], 'checks': [{'context': 'ci', 'app_id': 15368}]},
+        'enforce_admins': {'enabled': True},
+        'required_pull_request_reviews': {'dismiss_stale_reviews': False, 'require_code_owner_reviews': True,
+                                          'required_approving_review_count': 2,
+                                          'dismissal_restrictions': {'users': [{'login': 'lead'}], 'teams': []}},
+        'required_linear_history': {'enabled': True},
+        'allow_force_pushes': {'enabled': False},
+        'required_conversation_resolution': {'enabled': True},
+    }
+    current = protection(required_status_checks=True, contexts=['ci'], required_code_review=True, except_admins=False,
+                         document=document)
+    settings, _ = desired_settings([policy('p', restrict_push=True, allowed_push_teams=['release'], contexts=['lint'])])
+    changes = plan(current, settings)
+
+    assert [c.method for c in changes] == ['PUT']
+    assert changes[0].body == {
+        'required_status_checks': {'strict': False, 'checks': [{'context': 'ci', 'app_id': 15368}, {'context': 'lint'}]},
+        'enforce_admins': True,
+        'required_pull_request_reviews': {'dismiss_stale_reviews': False, 'require_code_owner_reviews': True,
+                                          'required_approving_review_count': 2,
+                                          'dismissal_restrictions': {'users': ['lead'], 'teams': []}},
+        'restrictions': {'users': [], 'teams': ['release']},
+        'required_linear_history': True,
+        'allow_force_pushes': False,
+        'required_conversation_resolution': True,
+    }
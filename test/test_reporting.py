@@ -0,0 +1,45 @@
+import io
+import json
+import threading
+
+from github_macros.reporting import Reporter
+
+
+def test_text_goes_where_it_always_did():
+    out, err = io.StringIO(), io.StringIO()
+    reporter = Reporter('text', stdout=out, stderr=err)
+    reporter.emit('repo', ' REPO: acme/widget', repository='acme/widget')
+    reporter.emit('error', 'ERROR: acme/widget', error=True, repository='acme/widget')
+    reporter.emit('done')  # Nothing to say in text
+    assert out.getvalue() == ' REPO: acme/widget\n'
+    assert err.getvalue() == 'ERROR: acme/widget\n'
+
+
+def test_ndjson_is_one_record_per_line_on_stdout():
+    out, err = io.StringIO(), io.StringIO()
+    reporter = Reporter('ndjson', stdout=out, stderr=err)
+    reporter.emit('repo', ' REPO: acme/widget', repository='acme/widget', action='update', seconds=None)
+    reporter.emit('error', 'ERROR: acme/widget', error=True, repository='acme/widget', status=404)
+
+    lines = out.getvalue().splitlines()
+    assert lines[0] == '{"type": "repo", "action": "update", "repository": "acme/widget"}'
+    assert json.loads(lines[1]) == {'type': 'error', 'repository': 'acme/widget', 'status': 404}
+    assert err.getvalue() == ''
+
+
+def test_records_from_many_threads_stay_whole():
+    out = io.StringIO()
+    reporter = Reporter('ndjson', stdout=out)
+
+    def work(n):
+        for i in range(50):
+            reporter.emit('repo', repository='acme/repo-{}'.format(n), index=i, padding='x' * 500)
+
+    threads = [threading.Thread(target=work, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    records = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert len(records) == 400
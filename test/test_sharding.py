@@ -0,0 +1,60 @@
+from github_macros.models.github import GithubRepository
+from github_macros.sharding import Shard
+
+
+def repos(*sizes):
+    return [GithubRepository(None, 'acme/repo-{}'.format(i), size=size) for i, size in enumerate(sizes)]
+
+
+def test_every_repository_lands_in_exactly_one_shard():
+    listing = repos(*range(50))
+    shards = [Shard(i, 3).select(listing) for i in (1, 2, 3)]
+
+    names = [repo.full_name for shard in shards for repo in shard]
+    assert sorted(names) == sorted(repo.full_name for repo in listing)
+    assert all(shard for shard in shards)
+
+
+def test_assignment_is_stable_regardless_of_listing_order():
+    listing = repos(*range(20))
+    forward = Shard(2, 4).select(listing)
+    backward = Shard(2, 4).select(reversed(listing))
+
+    assert set(r.full_name for r in forward) == set(r.full_name for r in backward)
+
+
+def test_size_balancing_evens_out_the_load():
+    listing = repos(1000, 10, 990, 20, 5, 5)
+    loads = [sum(r.size for r in Shard(i, 2, balance='size').select(listing)) for i in (1, 2)]
+
+    assert loads == [1015, 1015]
+
+
+class Host(object):
+    def __init__(self, domain):
+        self.domain = domain
+
+
+def test_the_same_name_on_different_hosts_is_a_different_repository():
+    listing = [GithubRepository(Host('github.com'), 'acme/widget', size=1000),
+               GithubRepository(Host('ghe.example.com'), 'acme/widget', size=1000),
+               GithubRepository(Host('github.com'), 'acme/gadget', size=10),
+               GithubRepository(Host('ghe.example.com'), 'acme/gadget', size=10)]
+    shards = [Shard(i, 2, balance='size') for i in (1, 2)]
+    selected = [shard.select(listing) for shard in shards]
+
+    assert [sum(r.size for r in repos) for repos in selected] == [1010, 1010]
+    for repo in listing:
+        assert [shard.contains(repo) for shard in shards].count(True) == 1
+
+
+def test_size_balancing_spreads_many_owners_across_every_shard():
+    # One repository each, as e.g. gh-refresh -o one -o two ... lists them
+    listing = [GithubRepository(None, 'owner-{}/repo'.format(i), size=100 + i) for i in range(20)]
+    shards = [Shard(i, 4, balance='size') for i in (1, 2, 3, 4)]
+    selected = [shard.select(listing if n % 2 else reversed(listing)) for n, shard in enumerate(shards)]
+
+    assert [len(repos) for repos in selected] == [5, 5, 5, 5]
+    assert sorted(r.full_name for repos in selected for r in repos) == sorted(r.full_name for r in listing)
+    for repo in listing:
+        assert [shard.contains(repo) for shard in shards].count(True) == 1
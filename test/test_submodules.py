@@ -0,0 +1,46 @@
+import os
+
+from github_macros import submodules
+
+from sh.contrib import git
+
+COMMIT = ('-c', 'user.name=t', '-c', 'user.email=t@example.com', 'commit', '-q')
+
+
+def test_urls_name_the_repository_they_point_at():
+    assert submodules.split_url('git@github.com:acme/lib.git') == ('github.com', 'acme/lib')
+    assert submodules.split_url('https://GHE.example.com/platform/api') == ('ghe.example.com', 'platform/api')
+    assert submodules.split_url('ssh://git@github.com/acme/lib.git/') == ('github.com', 'acme/lib')
+    assert submodules.split_url('/srv/git/lib.git') is None
+
+    assert submodules.resolve_url('../lib.git', 'git@github.com:acme/app.git') == 'git@github.com:acme/lib.git'
+    assert submodules.resolve_url('../../vendor/zlib', 'https://github.com/acme/app') == 'https://github.com/vendor/zlib'
+    assert submodules.resolve_url('git@github.com:x/y', 'git@github.com:acme/app.git') == 'git@github.com:x/y'
+
+
+def test_mirrored_submodules_are_borrowed_from_the_mirror(tmpdir, monkeypatch):
+    monkeypatch.delenv('GITHUB_DOMAIN', raising=False)
+    remote = str(tmpdir.join('remote'))
+    # Stands in for GitHub: "git@github.com:acme/..." is fetched from `remote`
+    for n, (key, value) in enumerate([('url.{}/.insteadOf'.format(remote), 'git@github.com:'),
+                                      ('protocol.file.allow', 'always')]):
+        monkeypatch.setenv('GIT_CONFIG_KEY_{}'.format(n), key)
+        monkeypatch.setenv('GIT_CONFIG_VALUE_{}'.format(n), value)
+    monkeypatch.setenv('GIT_CONFIG_COUNT', '2')
+
+    for name in ('lib', 'app'):
+        git('init', '-q', os.path.join(remote, 'acme', name))
+    git('-C', os.path.join(remote, 'acme', 'lib'), *(COMMIT + ('--allow-empty', '-m', 'lib')))
+    app = os.path.join(remote, 'acme', 'app')
+    git('-C', app, 'remote', 'add', 'origin', 'git@github.com:acme/app.git')
+    git('-C', app, 'submodule', 'add', '-q', '../lib', 'vendor/lib')
+    git('-C', app, *(COMMIT + ('-m', 'app')))
+
+    base = str(tmpdir.join('mirror'))
+    for name in ('lib', 'app'):
+        git('clone', '-q', 'git@github.com:acme/{}'.format(name), os.path.join(base, 'Acme', name))
+
+    mirrored = os.path.join(base, 'Acme', 'app')
+    assert submodules.update(mirrored, base) == (1, 1)
+    assert not os.path.exists(os.path.join(mirrored, '.git', 'modules', 'vendor', 'lib', 'objects', 'info', 'alternates'))
+    assert str(git('-C', os.path.join(mirrored, 'vendor', 'lib'), 'log', '--format=%s')).strip() == 'lib'
@@ -0,0 +1,78 @@
+import json
+import threading
+
+import requests
+
+from github_macros.cli.refresh import CloneScheduler, webhook_receiver
+from github_macros.hosts import HostClients
+from github_macros.webhook import WebhookServer, sign
+
+SECRET = 'not-so-secret'
+
+PUSH = {
+    'ref': 'refs/heads/master',
+    'repository': {
+        'name': 'widget',
+        'full_name': 'acme/widget',
+        'owner': {'name': 'acme', 'login': 'acme', 'type': 'Organization'},
+        'ssh_url': 'git@github.com:acme/widget.git',
+        'pushed_at': 1760000000,
+        'size': 120,
+    },
+}
+
+
+def serve(on_event):
+    server = WebhookServer(('127.0.0.1', 0), on_event, secret=SECRET)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:{}/'.format(server.server_address[1])
+
+
+def deliver(url, event, payload, secret=SECRET):
+    """
+    Stands in for GitHub sending a webhook delivery
+    """
+    body = json.dumps(payload).encode('utf-8')
+    return requests.post(url, data=body, headers={
+        'X-GitHub-Event': event,
+        'X-Hub-Signature-256': sign(secret, body),
+        'Content-Type': 'application/json',
+    })
+
+
+def test_signed_deliveries_are_handed_off():
+    received = []
+    server, url = serve(lambda event, payload: received.append((event, payload)) or True)
+    try:
+        assert deliver(url, 'ping', {}).status_code == 200
+        assert deliver(url, 'push', PUSH).status_code == 202
+        assert deliver(url, 'push', PUSH, secret='wrong').status_code == 401
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert [event for event, _ in received] == ['push']
+
+
+def test_duplicate_events_for_a_repository_are_coalesced():
+    work = CloneScheduler()
+    clients = HostClients(lambda host: None)
+    clients.get('github.com')
+    on_event = webhook_receiver(clients=clients, work=work, owner_names=set(['acme']))
+    server, url = serve(on_event)
+    try:
+        deliver(url, 'push', PUSH)
+        deliver(url, 'create', PUSH)
+        deliver(url, 'push', dict(PUSH, repository=dict(PUSH['repository'], owner={'login': 'someone-else', 'type': 'User'})))
+        # Not a host being mirrored
+        deliver(url, 'push', dict(PUSH, repository=dict(PUSH['repository'], html_url='https://ghe.example.com/acme/widget')))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    repo = work.get()
+    assert repo.full_name == 'acme/widget'
+    assert repo.clone_url == 'git@github.com:acme/widget.git'
+    assert work._queue.empty()